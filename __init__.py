@@ -1,7 +1,5 @@
-from flask import Flask, g, request, current_app, render_template, send_file
-from flasgger import Swagger, LazyString, LazyJSONEncoder
+from flask import Flask, request, render_template, send_file
 
-import sqlite3
 import json
 import os
 
@@ -11,31 +9,6 @@ import os
 def create_app(test_config=None):
 
     app = Flask(__name__, instance_relative_config=True)
-    app.json_encoder = LazyJSONEncoder
-    app.config['SWAGGER'] = {
-            'title': 'Beanbot API',
-            'uiversion': 3,
-            'templates': 'templates/flasgger/swagger_ui.html'
-            }
-
-    template = {
-            "info": {
-                "title": "Beanbot API",
-                "description": "API for accessing data pertaining to TCM's coffee habits",
-                "contact": {
-                    "responsibleOrganization": "als217",
-                    "responsibleDeveloper": "als217",
-                    "email": "CRSID AT CAM DOT AC DOT UK",
-                    "url": "spuriosity1.github.io",
-                    },
-                "termsOfService": "http://me.com/terms",
-                "version": "0.0.1"
-                },
-            # 'swaggerUiPrefix': LazyString(  lambda : request.environ.get('HTTP_X_SCRIPT_NAME', '')),
-            "basePath": "/api",  # base bash for blueprint registration
-            }
-    swagger = Swagger(app, template=template)
-
 
     @app.route('/helloworld', methods=['GET', 'POST'])
     def ping():
@@ -43,6 +16,8 @@ def create_app(test_config=None):
 
     if test_config is None:
         app.config.from_file("config.json", load=json.load)
+    else:
+        app.config.from_mapping(test_config)
 
     # ensure the instance folder exists
     try:
@@ -60,6 +35,37 @@ def create_app(test_config=None):
     from beanserver.db import init_app
     init_app(app)
 
+    # before anything opens a connection, so that all of them are instrumented
+    from beanserver import metrics
+    metrics.init_app(app)
+
+    from beanserver import reconcile
+    reconcile.init_app(app)
+
+    from beanserver import backup
+    backup.init_app(app)
+
+    from beanserver import replication
+    replication.init_app(app)
+
+    from beanserver import archive
+    archive.init_app(app)
+
+    from beanserver import cache
+    cache.init_app(app)
+
+    from beanserver import directory
+    directory.init_app(app)
+
+    from beanserver import compress
+    compress.init_app(app)
+
+    from beanserver import apidocs
+    apidocs.init_app(app)
+
+    from beanserver import assets
+    assets.init_app(app)
+
     @app.route('/favicon.ico')
     def faviconIt():
         return app.send_from_directory('static','favicon.ico')
@@ -95,7 +101,9 @@ def create_app(test_config=None):
     @app.route('/backup')
     def send_db_copy():
         if (os.path.isfile(app.config['PRIMARYDB'])):
-            return send_file(app.config['PRIMARYDB'], as_attachment=True)
+            # a consistent snapshot, never the live file
+            path = backup.latest(max_age=app.config.get('BACKUP_MAX_AGE', 3600))
+            return send_file(path, as_attachment=True)
         else:
             s = "database is misconfigured (this is very bad)"
             s += f"No file at {app.config['PRIMARYDB']}"
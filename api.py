@@ -1,32 +1,76 @@
-from flask import Blueprint, g, request, render_template, current_app
+from flask import (
+        Blueprint, g, request, render_template, current_app, Response,
+        after_this_request, stream_with_context)
 #from flask_limiter import Limiter
 #from flask_limiter.util import get_remote_address
 
 import datetime as dt
-from flasgger import Swagger, LazyString, LazyJSONEncoder
+import json
 import re
 import sqlite3
 
 
-from beanserver.db import open_db
+from beanserver import archive, feed, formats, ingest, ledger
+from beanserver.db import DatabaseUnavailable, open_db, pool_stats, health_stats
+from beanserver.cache import cached
+from beanserver.directory import get_directory, invalidate as invalidate_directory
+from beanserver.conditional import conditional
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 
 
-# @bp.route('/userstats/')
-# def user_all_stats():
-#     db.open_db()
-#     total_shots = g.db.execute(
-#             "SELECT crsid, sum(ncoffee) FROM transactions GROUP BY crsid").fetchall()
-#     res = {}
-#     for row in total_shots:
-#         res[row[0]] = {
-#                 "total_shots": row[1],
-#                 "totals": g.db.execute(
-#             "SELECT type, count(ts) FROM transactions \
-#                     WHERE crsid=? GROUP BY type",(row[0],)).fetchall()
-#                 }
-#     return res
+def leaderboard_sql(days):
+    '''
+    A statement tallying shots per crsid for several windows at once, where
+    `days` are the first midnights after the start of each window. Its
+    parameters are :b<i> (the start of window i), :d<i> (= days[i]) and
+    :first (the earliest of the days).
+    '''
+    # whole days come from the daily_totals rollup, only the partial day
+    # at the start of each window is read from transactions. Each window is
+    # a conditional sum over the same rows, so one scan serves them all,
+    # and the windows reaching back furthest need no condition at all
+    first = min(days)
+    daily = ", ".join("sum(shots)" if d == first else f"sum(CASE WHEN day >= :d{i} THEN shots END)"
+                      for i, d in enumerate(days))
+    partial = ", ".join(f"sum(CASE WHEN ts > :b{i} AND ts < :d{i} THEN ncoffee END)"
+                        for i in range(len(days)))
+    ranges = " OR ".join(f"(ts > :b{i} AND ts < :d{i})" for i in range(len(days)))
+    cols = ", ".join(f"w{i}" for i in range(len(days)))
+    return f"WITH parts (crsid, {cols}) AS ( \
+                SELECT crsid, {daily} FROM daily_totals \
+                WHERE day >= :first GROUP BY crsid \
+                UNION ALL \
+                SELECT crsid, {partial} FROM transactions \
+                WHERE {ranges} GROUP BY crsid) \
+            SELECT crsid, {', '.join(f'sum(w{i})' for i in range(len(days)))} \
+            FROM parts GROUP BY crsid"
+
+
+def leaderboards_dt(begins):
+    '''
+    Shot leaderboards since each of the datetimes `begins`, most shots first,
+    computed in a single query. Users without any transaction in a window
+    are left out of it.
+    '''
+    params = {}
+    days = []
+    for i, begin_dt in enumerate(begins):
+        begin = int(begin_dt.strftime('%s'))
+        days.append(begin - begin % 86400 + 86400)
+        params[f"b{i}"] = begin
+        params[f"d{i}"] = days[-1]
+    params["first"] = min(days)
+    rows = open_db().execute(leaderboard_sql(days), params).fetchall()
+
+    boards = []
+    for i in range(len(begins)):
+        data = [{"crsid": r[0], "shots": r[i + 1]} for r in rows if r[i + 1] is not None]
+        data.sort(key=lambda d: -d["shots"])
+        boards.append(data)
+    return boards
+
+
 # TODO: this is needlessly overcomplicated- get_leaderboard_dt should be the
 # only endpoint. The user should be responsible for generating unix time.
 
@@ -53,22 +97,81 @@ def get_leaderboard_dt(begin_dt):
                             ]
                         }
     """
-    db = open_db()
-    total_shots = db.execute(
-            "SELECT sum(ncoffee), crsid FROM transactions \
-                    WHERE ts > ? \
-                    GROUP BY crsid \
-                    ORDER BY -sum(ncoffee)",
-            (begin_dt.strftime('%s'),)
-            ).fetchall()
-    data = [{"crsid": r[1], "shots": r[0]} for r in total_shots]
     return {"success": True,
-            "data": data}
+            "data": leaderboards_dt([begin_dt])[0]}
+
+
+# Leaderboard windows. Each helper returns the datetime a window starts at,
+# or None if its argument is malformed.
+
+DEFAULT_BEGIN = '2023-01-01T00:00:00'
+
+def parse_begin(begin):
+    '''ISO 8601 time, `YYYY-MM-DDThh:mm:ss` or `YYYY-MM-DD`.'''
+    if 'T' not in begin:
+        begin = begin + "T00:00:00"
+    try:
+        return dt.datetime.strptime(begin, "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+
+def since_weekday(day):
+    '''Just after the start of the last <day> of the week (0-6).'''
+    try:
+        day = int(day)
+    except ValueError:
+        return None
+    today = dt.datetime.today()
+    dest = today - dt.timedelta(days=(today.weekday() - day - 1) % 7 + 1)
+    return dest.replace(hour=0, minute=0, second=1)
+
+def parse_interval(spec):
+    '''The time an `N#M#O#` interval spec (see get_leaderboard_interval) ago.'''
+    spec = spec.replace(' ', '').lower()
+    specifiers = re.findall(r'\D+', spec)
+    quantifiers = re.findall(r'\d+', spec)
+    if len(specifiers) != len(quantifiers):
+        return None
+    lmap = {
+            'd': 'days',
+            's': 'seconds',
+            'm': 'minutes',
+            'h': 'hours',
+            'w': 'weeks'
+            }
+    timespec = {}
+    for s, q in zip(specifiers, quantifiers):
+        lhs = lmap.get(s)
+        if lhs is None:
+            return None
+        timespec[lhs] = int(q)
+    if len(timespec) == 0:
+        return None
+    return dt.datetime.now() - dt.timedelta(**timespec)
+
+def _resolved(begin_dt):
+    return None if begin_dt is None else begin_dt.strftime("%Y-%m-%dT%H:%M:%S")
+
+WINDOWS = {
+        'after': parse_begin,
+        'sinceday': since_weekday,
+        'interval': parse_interval,
+        }
+
+def parse_window(window):
+    '''`all`, `after:<begin>`, `sinceday:<day>` or `interval:<spec>`.'''
+    if window == 'all':
+        return parse_begin(DEFAULT_BEGIN)
+    kind, _, arg = window.partition(':')
+    parse = WINDOWS.get(kind)
+    return None if parse is None or not arg else parse(arg)
 
 
 @bp.route('/leaderboard/',
-          defaults={'begin': '2023-01-01T00:00:00'})
+          defaults={'begin': DEFAULT_BEGIN})
 @bp.route('/leaderboard/after/<begin>')
+@conditional
+@cached
 def get_leaderboard(begin):
     """
     Returns a tally of shots taken from <begin> to now.
@@ -98,17 +201,15 @@ def get_leaderboard(begin):
         400:
             descripton: malformed request
     """
-    if 'T' not in begin:
-        begin = begin + "T00:00:00"
-
-    try:
-        begin_dt = dt.datetime.strptime(begin, "%Y-%m-%dT%H:%M:%S")
-    except ValueError:
+    begin_dt = parse_begin(begin)
+    if begin_dt is None:
         return {"success": False, "reason": "Malformed request"}
     return get_leaderboard_dt(begin_dt)
 
 
 @bp.route('/leaderboard/sinceday/<day>')
+@conditional(extra=lambda: [dt.date.today()])
+@cached(extra=lambda day: _resolved(since_weekday(day)))
 def get_leaderboard_day(day):
     """
     Returns a tally of shots taken since the last <day> of thw week.
@@ -133,15 +234,17 @@ def get_leaderboard_day(day):
                         "datesince": "2024-05-06T00:11:02"
                         }
     """
-    today = dt.datetime.today()
-    dest = today - dt.timedelta(days=(today.weekday() - int(day) - 1) % 7 + 1)
-    dest = dest.replace(hour=0, minute=0, second=1)
+    dest = since_weekday(day)
+    if dest is None:
+        return {"success": False, "reason": "Malformed request"}
 
     payload = get_leaderboard_dt(dest)
     payload['datesince'] = dest.strftime("%Y-%m-%dT%H:%M:%S")
     return payload
 
 
+# Not cached: the window starts at the current second, so no two requests
+# would share an entry. The daily rollup keeps it cheap regardless.
 @bp.route('/leaderboard/interval/<spec>')
 def get_leaderboard_interval(spec):
     """
@@ -187,44 +290,95 @@ def get_leaderboard_interval(spec):
                         "datesince": "2024-05-06T00:11:02"
                         }
     """
-    spec = spec.replace(' ', '').lower()
-    specifiers = re.findall(r'\D+', spec)
-    quantifiers = re.findall(r'\d+', spec)
-
-    bad_retval = {"success": False, "bad_request": "malformed query"}
-    if len(specifiers) != len(quantifiers):
-        return bad_retval
-    timespec = {}
-    lmap = {
-            'd': 'days',
-            's': 'seconds',
-            'm': 'minutes',
-            'h': 'hours',
-            'w': 'weeks'
-            }
-    lhs = []
-    for s, q in zip(specifiers, quantifiers):
-        lhs = lmap.get(s)
-        if lhs is None:
-            return bad_retval
-        timespec[lhs] = int(q)
-
-    if len(lhs) == 0:
-        return bad_retval
-
-    d = dt.timedelta(**timespec)
-
-    tod = dt.datetime.now()
-    a = tod - d
+    a = parse_interval(spec)
+    if a is None:
+        return {"success": False, "bad_request": "malformed query"}
 
     payload = get_leaderboard_dt(a)
     payload['datesince'] = a.strftime("%Y-%m-%dT%H:%M:%S")
     return payload
 
 
+def _window_starts():
+    # sinceday and interval windows move with the clock
+    return tuple(_resolved(parse_window(name.strip()))
+                 for name in request.args.get('windows', '').split(','))
+
+@bp.route('/leaderboard/windows')
+@conditional(extra=_window_starts)
+@cached(extra=_window_starts)
+def get_leaderboard_windows():
+    """
+    Tallies shots over several windows at once, from a single scan.
+    ---
+    parameters:
+        - name: windows
+          in: query
+          type: string
+          required: true
+          description: |
+            Comma-separated list of up to 16 windows, each one of
+            * `all`, every record (as /leaderboard/);
+            * `after:<begin>`, since an ISO 8601 time (as /leaderboard/after/);
+            * `sinceday:<day>`, since the last <day> of the week (as /leaderboard/sinceday/);
+            * `interval:<spec>`, since an `N#M#` interval ago (as /leaderboard/interval/).
+          example: all,sinceday:6,interval:1d
+    responses:
+        200:
+            description: >
+              Successful response, with the tally of each window under its
+              name, as the single-window endpoints return it
+            examples:
+                application/json: {
+                        "success": True,
+                        "windows": {
+                            "all": {
+                                "success": True,
+                                "data": [
+                                    {"crsid": "aaa001", "shots": 51},
+                                    {"crsid": "abc001", "shots": 11}
+                                    ],
+                                "datesince": "2023-01-01T00:00:00"
+                                },
+                            "sinceday:6": {
+                                "success": True,
+                                "data": [
+                                    {"crsid": "abc001", "shots": 4}
+                                    ],
+                                "datesince": "2024-05-05T00:00:01"
+                                }
+                            }
+                        }
+    """
+    names = []
+    for name in request.args.get('windows', '').split(','):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    if len(names) == 0 or len(names) > 16:
+        return {"success": False, "bad_request": "expected 1 to 16 windows"}
+
+    begins = []
+    for name in names:
+        begin = parse_window(name)
+        if begin is None:
+            return {"success": False, "bad_request": f"malformed window {name}"}
+        begins.append(begin)
+
+    boards = leaderboards_dt(begins)
+    return {
+            "success": True,
+            "windows": {name: {"success": True, "data": data,
+                               "datesince": begin.strftime("%Y-%m-%dT%H:%M:%S")}
+                        for name, begin, data in zip(names, begins, boards)}
+            }
+
+
 @bp.route('/userstats/<crsid>',
           defaults={'begin': '2023-01-01T00:00:00'})
 @bp.route('/userstats/<crsid>/after/<begin>')
+@conditional
+@cached
 def user_stats(crsid, begin):
     """
     Gets the coffee habits of a particular user.
@@ -282,11 +436,7 @@ def user_stats(crsid, begin):
         begin = begin + "T00:00:00"
 
     # check that user exists
-    r1 = db.execute(
-            "SELECT count(crsid) FROM users WHERE crsid=?", (crsid,))
-
-    found_id, = r1.fetchone()
-    if found_id == 0:
+    if not get_directory().exists(crsid):
         return {
                 "success": False,
                 "reason": f"CRSID '{crsid}' is not registered"
@@ -312,7 +462,132 @@ def user_stats(crsid, begin):
             }
 
 
+STREAM_FORMATS = {
+        'tsv': 'text/tab-separated-values',
+        'ndjson': 'application/x-ndjson',
+        }
+
+def stream_rows(cursor, hdr, fmt, chunk):
+    '''
+    Generator emitting the rows of `cursor` in `fmt`, `chunk` rows at a time,
+    so that the full result set is never held in memory.
+    '''
+    if fmt == 'tsv':
+        yield "\t".join(hdr) + "\n"
+    else:
+        yield json.dumps({"headers": hdr}) + "\n"
+
+    while True:
+        rows = cursor.fetchmany(chunk)
+        if not rows:
+            break
+        if fmt == 'tsv':
+            yield "".join("\t".join(map(str, r)) + "\n" for r in rows)
+        else:
+            yield "".join(json.dumps(r) + "\n" for r in rows)
+
+
+@bp.route('/userstats/')
+@conditional
+@cached
+def user_all_stats():
+    """
+    Gets the coffee habits of many users at once, in the same form as
+    /userstats/<crsid>.
+    ---
+    parameters:
+        - name: crsids
+          in: query
+          type: string
+          required: false
+          description: >
+            Comma-separated list of crsids, or `all` (the default) for every
+            registered user.
+        - name: after
+          in: query
+          type: string
+          required: false
+          description: >
+            ISO 8601 time (`YYYY-MM-DDThh:mm:ss` or `YYYY-MM-DD`)
+            from which to begin aggregating.
+    responses:
+        200:
+            description: >
+              successful response. Requested crsids that are not registered
+              are listed under "unknown".
+            examples:
+                application/json: {
+                        "success": true,
+                        "users": {
+                            "abc123": {
+                                "total_shots": 35,
+                                "totals": {"cappuccino2": 1, "espresso": 20},
+                                "spend": 1250
+                                },
+                            "abc183": {
+                                "total_shots": 0,
+                                "totals": {},
+                                "spend": 0
+                                }
+                            },
+                        "unknown": ["idontexist"]
+                        }
+        400:
+            description: malformed request
+    """
+    crsids = request.args.get('crsids', 'all')
+    begin = request.args.get('after', '2023-01-01T00:00:00')
+    if 'T' not in begin:
+        begin = begin + "T00:00:00"
+    try:
+        begin_posix = dt.datetime.strptime(begin, "%Y-%m-%dT%H:%M:%S").strftime('%s')
+    except ValueError:
+        return {"success": False, "reason": "Malformed request"}, 400
+
+    db = open_db()
+    if crsids == 'all':
+        wanted = None
+        users = db.execute("SELECT crsid FROM users ORDER BY crsid").fetchall()
+        in_list = ""
+        params = (begin_posix,)
+    else:
+        wanted = [c.strip().lower() for c in crsids.split(',') if c.strip()]
+        users = db.execute(
+                "SELECT crsid FROM users \
+                        WHERE crsid IN (SELECT value FROM json_each(?)) ORDER BY crsid",
+                (json.dumps(wanted),)).fetchall()
+        in_list = " AND crsid IN (SELECT value FROM json_each(?))"
+        params = (begin_posix, json.dumps(wanted))
+
+    res = {r[0]: {"total_shots": 0, "totals": {}, "spend": 0} for r in users}
+    rows = db.execute(
+            "SELECT crsid, type, count(ts), sum(ncoffee), sum(debit) \
+                    FROM transactions WHERE ts > ?" + in_list + " \
+                    GROUP BY crsid, type",
+            params)
+    for crsid, ty, n, shots, spend in rows:
+        stats = res.get(crsid)
+        if stats is None:
+            # transactions of an unregistered crsid
+            continue
+        stats["total_shots"] += shots
+        stats["spend"] += spend
+        stats["totals"][ty] = n
+
+    retval = {"success": True, "users": res}
+    if wanted is not None:
+        retval["unknown"] = sorted(set(wanted) - set(res))
+    return retval
+
+
+def _vary_accept(rv):
+    rv.vary.add('Accept')
+    return rv
+
+
 @bp.route('/timeseries')
+@conditional
+@cached
 def get_timeseries():
     """
     Returns the full time series of transactions.
@@ -346,6 +621,64 @@ def get_timeseries():
           required: false
           description: >
             Flag to include the 'debit' part of the transaction
+        - name: stream
+          in: query
+          type: string
+          enum: [tsv, ndjson]
+          required: false
+          description: >
+            Stream the rows as they are read instead of returning a single
+            JSON document. `tsv` sends a tab-separated header line followed by
+            one line per row; `ndjson` sends `{"headers": [...]}` followed by
+            one JSON array per row.
+        - name: since_cursor
+          in: query
+          type: string
+          required: false
+          description: >
+            Opaque cursor returned by a previous call. Only transactions
+            recorded after it are returned, in the order they were recorded.
+            Pass `0` to start from the beginning. Transaction ids are never
+            reused, so no new transaction is skipped, but transactions edited
+            or deleted after they were fetched are not reported again.
+        - name: limit
+          in: query
+          type: integer
+          required: false
+          description: >
+            Maximum number of rows per page (at most `TIMESERIES_MAX_PAGE`,
+            10000 by default). Implies cursor paging.
+        - name: format
+          in: query
+          type: string
+          enum: [json, columns, packed, arrow]
+          required: false
+          description: >
+            Output format. If omitted it is negotiated from the Accept header
+            (`application/x-beanserver-packed` or
+            `application/vnd.apache.arrow.stream`) when one is preferred
+            strictly over `application/json`, and is `json` otherwise
+            (including for `*/*` or no Accept header).
+            `columns` is a JSON object of per-column arrays, `packed` the
+            same data as little-endian binary arrays (see `formats.py`) and
+            `arrow` an Arrow IPC stream (only if pyarrow is installed). These
+            formats give timestamps as unix times and dictionary-encode the
+            `type` and `crsid` columns.
+    responses:
+        200:
+            description: >
+              successful response. With cursor paging, `next_cursor` is
+              passed as `since_cursor` to fetch the following page (or, once
+              `more` is false, to poll for new transactions later).
+            examples:
+                application/json: {
+                        "headers": ["timestamp", "type", "crsid"],
+                        "table": [["2024-05-06 09:12:44", "espresso2", "abc123"]],
+                        "next_cursor": "5121",
+                        "more": false
+                        }
+        400:
+            description: malformed request
             """
     db = open_db()
     hdr = ["DATETIME(ts,'unixepoch')", "type", "crsid"]
@@ -353,9 +686,40 @@ def get_timeseries():
     after = request.args.get('after')
     before = request.args.get('before')
     include_debit = request.args.get('include_debit') is not None
+    stream = request.args.get('stream')
+    since_cursor = request.args.get('since_cursor')
+    limit = request.args.get('limit')
+    paged = since_cursor is not None or limit is not None
+    fmt = formats.negotiate(request.args.get('format'), request.accept_mimetypes)
+
+    if stream is not None and stream not in STREAM_FORMATS:
+        return {"success": False,
+                "reason": f"stream must be one of {', '.join(STREAM_FORMATS)}"}, 400
+    if fmt is None:
+        return {"success": False,
+                "reason": f"format must be one of {', '.join(formats.available())}"}, 400
+    if stream is not None and fmt != 'json':
+        return {"success": False,
+                "reason": "stream cannot be combined with format"}, 400
+    if 'format' not in request.args:
+        after_this_request(_vary_accept)
 
     conds = []
 
+    if paged:
+        if stream is not None:
+            return {"success": False,
+                    "reason": "stream cannot be combined with since_cursor/limit"}, 400
+        max_page = current_app.config.get('TIMESERIES_MAX_PAGE', 10000)
+        try:
+            since_cursor = int(since_cursor or 0)
+            limit = min(int(limit or max_page), max_page)
+            if limit <= 0 or since_cursor < 0:
+                raise ValueError
+        except ValueError:
+            return {"success": False, "reason": "Malformed cursor or limit"}, 400
+        conds += [("id > ?", since_cursor)]
+
     if crsid is not None:
         hdr.remove('crsid')
         conds += [("crsid=?", crsid)]
@@ -371,26 +735,324 @@ def get_timeseries():
     if include_debit:
         hdr += ['debit']
 
+    if fmt != 'json':
+        # leave the date formatting to the client
+        hdr[0] = "CAST(ts AS INTEGER)"
+
     condstring = " AND ".join([x[0] for x in conds])
 
     q = "SELECT " + ", ".join(hdr) + " FROM transactions"
+    if paged:
+        # keyset paging on the AUTOINCREMENT ids of transaction_ids (migration
+        # 0013), which only grow, so a cursor never skips a newly recorded row
+        q = q.replace("SELECT ", "SELECT id, ", 1)
+        q += " JOIN transaction_ids ON tx = transactions.rowid"
     if len(conds) > 0:
         q += " WHERE " + condstring
-    q += " ORDER BY ts"
+    params = [x[1] for x in conds]
+    if paged:
+        q += " ORDER BY id LIMIT ?"
+        params.append(limit + 1)
+    else:
+        q += " ORDER BY ts"
     # print(q)
-    r = db.execute(q, tuple([x[1] for x in conds]))
-
-    data = r.fetchall()
+    r = db.execute(q, tuple(params))
     hdr[0] = 'timestamp'
 
+    if stream is not None:
+        rows = stream_rows(r, hdr, stream,
+                           current_app.config.get('STREAM_CHUNK_ROWS', 500))
+        return Response(stream_with_context(rows),
+                        mimetype=STREAM_FORMATS[stream])
+
+    meta = {}
+    if paged:
+        rows = r.fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        meta = {
+                "next_cursor": str(rows[-1][0] if len(rows) > 0 else since_cursor),
+                "more": more
+                }
+        data = [row[1:] for row in rows]
+    else:
+        data = r.fetchall()
+
+    if fmt == 'columns':
+        return formats.encode_columns(hdr, data, meta)
+    if fmt == 'packed':
+        return Response(formats.encode_packed(hdr, data, meta),
+                        mimetype=formats.MIMETYPES[fmt])
+    if fmt == 'arrow':
+        return Response(formats.encode_arrow(hdr, data, meta),
+                        mimetype=formats.MIMETYPES[fmt])
+
     retval = {
             "headers": hdr,
             "table": data
             };
+    retval.update(meta)
     
     return retval;
 
 
+# bin start, as unix time, for each /histogram bin width
+HISTOGRAM_BINS = {
+        'hour': "ts - ts % 3600",
+        'day': "ts - ts % 86400",
+        'week': "CAST(strftime('%s', ts, 'unixepoch', 'start of day', \
+                '-6 days', 'weekday 1') AS INTEGER)",
+        'month': "CAST(strftime('%s', ts, 'unixepoch', 'start of month') AS INTEGER)",
+        # Michaelmas (Oct 1), Lent (Jan 5) and Easter (Apr 10) periods,
+        # each running up to the start of the next one
+        'term': "CAST(CASE \
+                WHEN strftime('%m-%d', ts, 'unixepoch') >= '10-01' \
+                    THEN strftime('%s', ts, 'unixepoch', 'start of year', '+9 months') \
+                WHEN strftime('%m-%d', ts, 'unixepoch') < '01-05' \
+                    THEN strftime('%s', ts, 'unixepoch', 'start of year', '-3 months') \
+                WHEN strftime('%m-%d', ts, 'unixepoch') < '04-10' \
+                    THEN strftime('%s', ts, 'unixepoch', 'start of year', '+4 days') \
+                ELSE strftime('%s', ts, 'unixepoch', 'start of year', '+3 months', '+9 days') \
+                END AS INTEGER)",
+        }
+
+
+@bp.route('/histogram')
+@conditional
+@cached
+def get_histogram():
+    """
+    Returns transaction counts binned by time and grouped by type, along with
+    a time-of-day (UTC) histogram.
+    ---
+    parameters:
+        - name: bin
+          in: query
+          type: string
+          enum: [hour, day, week, month, term]
+          required: false
+          description: >
+            Bin width (default `day`). Weeks start on Monday; terms are the
+            Michaelmas, Lent and Easter periods starting on Oct 1, Jan 5 and
+            Apr 10 respectively, and include the following vacation.
+        - name: tod
+          in: query
+          type: integer
+          required: false
+          description: >
+            Size of the time-of-day buckets in seconds (default 3600).
+        - name: crsid
+          in: query
+          type: string
+          required: false
+          description: Only count the transactions of this crsid.
+        - name: by_crsid
+          in: query
+          type: bool
+          required: false
+          description: Flag to also group the counts by crsid.
+        - name: after
+          in: query
+          type: string
+          required: false
+          description: >
+            ISO 8601 time (`YYYY-MM-DDThh:mm:ss`) from which to begin aggregating.
+        - name: before
+          in: query
+          type: string
+          required: false
+          description: >
+            ISO 8601 time (`YYYY-MM-DDThh:mm:ss`) at which to stop aggregating.
+    responses:
+        200:
+            description: successful response. Bins are given as unix times.
+            examples:
+                application/json: {
+                        "success": true,
+                        "bin": "day",
+                        "headers": ["bin", "type", "count", "shots"],
+                        "table": [
+                            [1715212800, "espresso", 4, 4],
+                            [1715212800, "cappuccino2", 1, 2]
+                            ],
+                        "timeofday": {
+                            "bucket": 3600,
+                            "headers": ["bucket", "type", "count", "shots"],
+                            "table": [[28800, "espresso", 31, 31]]
+                            }
+                        }
+        400:
+            description: malformed request
+    """
+    binning = request.args.get('bin', 'day')
+    crsid = request.args.get('crsid')
+    by_crsid = request.args.get('by_crsid') is not None
+    after = request.args.get('after')
+    before = request.args.get('before')
+
+    if binning not in HISTOGRAM_BINS:
+        return {"success": False,
+                "reason": f"bin must be one of {', '.join(HISTOGRAM_BINS)}"}, 400
+    try:
+        tod = int(request.args.get('tod', 3600))
+        if tod <= 0:
+            raise ValueError
+        if after is not None:
+            after = dt.datetime.strptime(after, "%Y-%m-%dT%H:%M:%S").strftime('%s')
+        if before is not None:
+            before = dt.datetime.strptime(before, "%Y-%m-%dT%H:%M:%S").strftime('%s')
+    except ValueError:
+        return {"success": False, "reason": "Malformed request"}, 400
+
+    conds = []
+    if crsid is not None:
+        conds += [("crsid=?", crsid)]
+    if after is not None:
+        conds += [('ts >= ?', after)]
+    if before is not None:
+        conds += [('ts <= ?', before)]
+
+    where = ""
+    if len(conds) > 0:
+        where = " WHERE " + " AND ".join([x[0] for x in conds])
+    params = tuple([x[1] for x in conds])
+    group = "type, crsid" if by_crsid else "type"
+
+    db = open_db()
+    table = db.execute(
+            f"SELECT {HISTOGRAM_BINS[binning]} AS bin, {group}, \
+                    count(*), sum(ncoffee) FROM transactions{where} \
+                    GROUP BY bin, {group} ORDER BY bin",
+            params).fetchall()
+    timeofday = db.execute(
+            f"SELECT ts % 86400 / ? * ? AS bucket, {group}, \
+                    count(*), sum(ncoffee) FROM transactions{where} \
+                    GROUP BY bucket, {group} ORDER BY bucket",
+            (tod, tod) + params).fetchall()
+
+    hdr = group.split(", ") + ["count", "shots"]
+    return {
+            "success": True,
+            "bin": binning,
+            "headers": ["bin"] + hdr,
+            "table": table,
+            "timeofday": {
+                "bucket": tod,
+                "headers": ["bucket"] + hdr,
+                "table": timeofday
+                }
+            }
+
+
+@bp.route('/auditlog')
+def get_auditlog():
+    """
+    Searches the transaction audit log, including the rows already moved to
+    the yearly archives, newest first.
+    ---
+    parameters:
+        - name: crsid
+          in: query
+          type: string
+          required: false
+          description: Only rows for transactions of this crsid (before or after the change).
+        - name: after
+          in: query
+          type: string
+          required: false
+          description: ISO 8601 time (`YYYY-MM-DDThh:mm:ss`, UTC) of the earliest change.
+        - name: before
+          in: query
+          type: string
+          required: false
+          description: ISO 8601 time (`YYYY-MM-DDThh:mm:ss`, UTC) of the latest change.
+        - name: before_id
+          in: query
+          type: integer
+          required: false
+          description: >
+            Only rows older than this id. Pass `next_cursor` of the previous
+            page to continue.
+        - name: limit
+          in: query
+          type: integer
+          required: false
+          description: Rows per page (default 100, at most 1000).
+    responses:
+        200:
+            description: successful response
+            examples:
+                application/json: {
+                        "success": true,
+                        "headers": ["id", "log_ts", "operation", "ts", "ts_new",
+                            "rfid", "rfid_new", "crsid", "crsid_new", "type",
+                            "type_new", "debit", "debit_new", "ncoffee", "ncoffee_new"],
+                        "table": [[9120, "2024-05-06 10:12:44", "INSERT", null,
+                            1715000000, null, 775545127858, null, "abc123",
+                            null, "espresso2", null, 50, null, 2]],
+                        "next_cursor": 9120
+                        }
+    """
+    crsid = request.args.get('crsid')
+    after = request.args.get('after')
+    before = request.args.get('before')
+    try:
+        before_id = request.args.get('before_id', type=int)
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        if limit <= 0:
+            raise ValueError
+        # log_ts is stored as 'YYYY-MM-DD hh:mm:ss'
+        if after is not None:
+            after = dt.datetime.strptime(after, "%Y-%m-%dT%H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+        if before is not None:
+            before = dt.datetime.strptime(before, "%Y-%m-%dT%H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return {"success": False, "reason": "Malformed request"}, 400
+
+    rows = archive.search(open_db(), archive.archive_dir(), crsid=crsid,
+                          after=after, before=before, before_id=before_id,
+                          limit=limit)
+    return {
+            "success": True,
+            "headers": ["id"] + archive.LOG_COLUMNS,
+            "table": rows,
+            "next_cursor": rows[-1][0] if len(rows) == limit else None
+            }
+
+
+@bp.route('/stream')
+def stream():
+    """
+    Server-sent event stream of changes to the transactions table, as they
+    are committed.
+    ---
+    description: >
+        Each insert, update or delete of a transaction is sent as a `tx` event
+        whose id is its transactionlog id. `shots` holds the change to
+        each affected crsid's shot count, `new` and `old` the transaction
+        after and before the change. Reconnecting clients send Last-Event-ID
+        and are replayed what they missed; if that is no longer held, or a
+        client falls too far behind, a `reset` event is sent instead and the
+        client should refetch its data. Comment lines are sent as keepalives.
+    responses:
+        200:
+            description: text/event-stream
+            examples:
+                text/event-stream: |
+                    id: 9120
+                    event: tx
+                    data: {"op": "insert", "shots": {"abc123": 2},
+                        "new": {"ts": 1715000000, "crsid": "abc123",
+                        "type": "espresso2", "debit": 50, "ncoffee": 2}}
+    """
+    last = request.headers.get('Last-Event-ID', type=int)
+    sub = feed.get_feed().subscribe(last)
+    # the stream holds no request context, so no database connection either
+    return Response(sub.stream(current_app.config.get('FEED_KEEPALIVE', 15.0)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @bp.route('/balance/<crsid>')
 def get_balance(crsid):
     """
@@ -427,23 +1089,15 @@ def get_balance(crsid):
     """
     db = open_db()
 
-
-    r1 = db.execute(
-            "SELECT count(crsid) FROM users WHERE crsid=?", (crsid,))
-
-    found_id, = r1.fetchone()
-    if found_id == 0:
+    # a stale directory can still list a user who has since been removed
+    balance = get_directory().exists(crsid) and ledger.verify(db, crsid)
+    if not balance:
         return {
                 "success": False,
                 "reason": f"CRSID '{crsid}' is not registered"
                 }, 201
 
-    debt, = db.execute(
-            "SELECT debt FROM users WHERE crsid = ?", 
-            (crsid,)).fetchone()
-    expected_debt, = db.execute(
-            "SELECT IFNULL(SUM(debit), 0) FROM transactions WHERE crsid = ?",
-            (crsid,)).fetchone()
+    debt, expected_debt = balance
 
     if debt == expected_debt:
         return {
@@ -493,18 +1147,17 @@ def exists_user(crsid):
 
     """
     # check if user exists at all
-    db = open_db()
-    r1 = db.execute(
-            "SELECT count(crsid), rfid FROM users WHERE crsid=?", (crsid,))
-    found_id, rfid = r1.fetchone()
-    if found_id != 0:
-        return {"user-exists": True, "rfid": rfid}, 200
+    directory = get_directory()
+    if directory.exists(crsid):
+        return {"user-exists": True, "rfid": directory.rfid(crsid)}, 200
 
     return {"user-exists": False}, 201
 
 
 
 @bp.route('/listusers')
+@conditional
+@cached
 def listusers():
     """
     Returns a list of all users in the system as a dict, with values showing if a non-null RFID is associated
@@ -523,15 +1176,9 @@ def listusers():
                         }
 
     """
-    # check if user exists at all
-    db = open_db()
-    res = db.execute(
-            "SELECT crsid, rfid is not null FROM users ORDER BY crsid")
     return {
             "success": True,
-            "users": {
-                k: r for k,r in res.fetchall()
-                }
+            "users": get_directory().listing()
             }
 
 
@@ -548,13 +1195,14 @@ def create_user():
     if len(crsid) > 8:
         return render_template('newuser.html', error="CRSId must be <= 8 characters"), 400
     
-    _db = open_db()
+    _db = open_db(write=True)
 
     try:
         _db.execute(
             "INSERT INTO users (crsid, debt) VALUES (?, ?)",
             (crsid, 0))
         _db.commit()
+        invalidate_directory()
 
         current_app.logger.info(f"Successfully added new user {crsid}")
         return render_template('newuser.html', 
@@ -592,15 +1240,10 @@ def create_payment():
         return render_template('newpayment.html', error="Payment must be a positive number"), 400
 
 
-    _db=open_db()
-
-    user_exists= _db.execute("SELECT COUNT(*) FROM users WHERE crsid = ?",
-            (crsid,)
-        ).fetchone()[0]
-
-    if user_exists == 0:
+    if not get_directory().exists(crsid):
         return render_template('newpayment.html', error=f"No user found with CRSid '{crsid}'"), 400
 
+    _db=open_db(write=True)
     ts = int(dt.datetime.utcnow().timestamp())
 
     try:
@@ -624,22 +1267,255 @@ def create_payment():
         current_app.logger.error(f"Failed to record payment for {crsid}: {e}")
         return render_template('newpayment.html', error="Database error"), 500
 
+    # the ledger is audited by the reconciliation job (see reconcile.py)
+    return render_template('newpayment.html', success=f"Successfully recorded payment of {payment} pence for {crsid}"), 400
 
 
-    total_debit = _db.execute(
-        "SELECT IFNULL(SUM(debit), 0) FROM transactions WHERE crsid = ?",
-        (crsid,)
-    ).fetchone()[0]
 
-    current_debt = _db.execute(
-        "SELECT debt FROM users WHERE crsid = ?",
-        (crsid,)
-    ).fetchone()[0]
+@bp.route('/taps', methods=['POST'])
+def ingest_taps():
+    """
+    Records a batch of card taps (or other transactions) from the box.
+    Each tap is charged to the user holding the card, or to the given crsid.
+    Concurrent requests are committed together by a single writer.
+    ---
+    parameters:
+        - name: body
+          in: body
+          required: true
+          schema:
+            type: object
+            properties:
+                password:
+                    type: string
+                taps:
+                    type: array
+                    items:
+                        type: object
+                        properties:
+                            rfid:
+                                type: integer
+                            crsid:
+                                type: string
+                            type:
+                                type: string
+                            debit:
+                                type: integer
+                                description: pence charged (negative for a payment)
+                            ncoffee:
+                                type: integer
+                            ts:
+                                type: integer
+                                description: unix time of the tap, defaults to now
+                            key:
+                                type: string
+                                description: >
+                                  idempotency key; a retried tap with the same
+                                  key is not recorded twice
+          examples:
+            application/json: {
+                "password": "...",
+                "taps": [
+                    {"rfid": 775545127858, "type": "espresso2", "debit": 50,
+                     "ncoffee": 2, "key": "box1-000172"}
+                    ]
+                }
+    responses:
+        200:
+            description: >
+              taps processed. Results are in the order of the request;
+              `duplicate` marks a key that had already been recorded.
+            examples:
+                application/json: {
+                        "success": true,
+                        "results": [
+                            {"status": "ok", "crsid": "abc123", "id": 5121},
+                            {"status": "ok", "crsid": "abc123", "id": 5117, "duplicate": true},
+                            {"status": "unknown_user"}
+                            ]
+                        }
+        400:
+            description: malformed request
+        403:
+            description: incorrect password
+        503:
+            description: >
+              the writer did not respond in time or the database is busy;
+              none of the taps was recorded. Retry after `Retry-After`
+              seconds, with the same `key` on every tap so that none is
+              charged twice.
+    """
+    cfg = current_app.config
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return {"success": False, "reason": "Expected a JSON object"}, 400
+    if cfg.get('TAP_PASSWORD') is None or body.get('password') != cfg['TAP_PASSWORD']:
+        return {"success": False, "reason": "Incorrect Password"}, 403
+
+    taps = body.get('taps')
+    if not isinstance(taps, list) or len(taps) == 0:
+        return {"success": False, "reason": "taps must be a non-empty list"}, 400
+    if len(taps) > cfg.get('INGEST_MAX_TAPS', 1000):
+        return {"success": False, "reason": "Too many taps in one request"}, 400
+    for i, tap in enumerate(taps):
+        error = ingest.validate_tap(tap)
+        if error is not None:
+            return {"success": False, "reason": f"tap {i}: {error}"}, 400
 
-    if total_debit != current_debt:
-        current_app.logger.error(f"Debt mismatch for {crsid}: total_debit={total_debit}, debt={current_debt}")
-        return render_template('newpayment.html', error="Debt mismatch after update, contact db985"), 500
-       
-    return render_template('newpayment.html', success=f"Successfully recorded payment of {payment} pence for {crsid}"), 400
+    try:
+        results = ingest.get_writer(current_app._get_current_object()).submit(
+                taps, cfg.get('INGEST_TIMEOUT', 10.0))
+    except DatabaseUnavailable:
+        raise
+    except sqlite3.Error as e:
+        current_app.logger.error(f"Failed to record taps: {e}")
+        return {"success": False, "reason": "Database error"}, 500
+    if results is None:
+        # nothing was recorded, so a retry (with the same keys) is safe
+        raise DatabaseUnavailable("Timed out waiting for the ingest writer")
+
+    return {"success": True, "results": results}
+
+
+@bp.route('/dbstats')
+def db_stats():
+    """
+    Returns usage counters for the database connection pools of this worker,
+    the database files it currently treats as unhealthy and the state of
+    primary to secondary replication.
+    ---
+    responses:
+        200:
+            description: successful response
+            examples:
+                application/json: {
+                        "success": true,
+                        "pools": {
+                            "/srv/beanbot/coffee.db": {
+                                "hits": 1520,
+                                "waits": 3,
+                                "opened": 4,
+                                "discarded": 0,
+                                "size": 4
+                                }
+                            },
+                        "unhealthy": {},
+                        "replication": {"copies": 12, "skipped": 340, "error": null}
+                        }
+    """
+    replication = current_app.extensions.get('beanserver.replication', {})
+    return {
+            "success": True,
+            "pools": pool_stats(current_app),
+            "unhealthy": health_stats(current_app),
+            "replication": {k: v for k, v in replication.items() if k != 'signature'}
+            }
 
 
+@bp.route('/cachestats')
+def cache_stats():
+    """
+    Returns hit/miss counters of the response cache and user directory of
+    this worker.
+    ---
+    responses:
+        200:
+            description: successful response
+            examples:
+                application/json: {
+                        "success": true,
+                        "cache": {
+                            "hits": 812,
+                            "misses": 40,
+                            "invalidations": 31,
+                            "evictions": 0,
+                            "entries": 9,
+                            "size": 256,
+                            "ttl": 60.0
+                            },
+                        "directory": {
+                            "loads": 3,
+                            "lookups": 517,
+                            "invalidations": 1,
+                            "users": 142,
+                            "cards": 120
+                            }
+                        }
+    """
+    return {
+            "success": True,
+            "cache": current_app.extensions['beanserver.cache'].info(),
+            "directory": current_app.extensions['beanserver.directory'].info()
+            }
+
+
+@bp.route('/slowqueries')
+def slow_queries():
+    """
+    Returns the most recent statements of this worker that took longer than
+    METRICS_SLOW_QUERY seconds, with their query plans.
+    ---
+    responses:
+        200:
+            description: successful response
+            examples:
+                application/json: {
+                        "success": true,
+                        "queries": [{
+                            "ts": 1715000000,
+                            "endpoint": "api.get_timeseries",
+                            "seconds": 0.1812,
+                            "rows": 48211,
+                            "sql": "SELECT DATETIME(ts,'unixepoch'), type, crsid FROM transactions ORDER BY ts",
+                            "plan": ["SCAN transactions USING COVERING INDEX idx_transactions_ts"]
+                            }]
+                        }
+    """
+    metrics = current_app.extensions.get('beanserver.metrics')
+    return {
+            "success": True,
+            "queries": [] if metrics is None else list(metrics.slow)
+            }
+
+
+@bp.route('/discrepancies')
+def list_discrepancies():
+    """
+    Lists accounts whose debt disagreed with the sum of their transactions
+    when the reconciliation job last checked them.
+    ---
+    parameters:
+        - name: all
+          in: query
+          type: bool
+          required: false
+          description: Flag to include discrepancies that have since been resolved.
+    responses:
+        200:
+            description: successful response. Times are unix times.
+            examples:
+                application/json: {
+                        "success": true,
+                        "discrepancies": [
+                            {
+                                "crsid": "abc123",
+                                "debt": 2100,
+                                "debit_sum": 2050,
+                                "detected_ts": 1715212800,
+                                "last_seen_ts": 1715299200,
+                                "resolved_ts": null
+                                }
+                            ]
+                        }
+    """
+    q = "SELECT crsid, debt, debit_sum, detected_ts, last_seen_ts, resolved_ts \
+            FROM ledger_discrepancies"
+    if request.args.get('all') is None:
+        q += " WHERE resolved_ts IS NULL"
+    q += " ORDER BY detected_ts"
+    hdr = ["crsid", "debt", "debit_sum", "detected_ts", "last_seen_ts", "resolved_ts"]
+    res = open_db().execute(q).fetchall()
+    return {
+            "success": True,
+            "discrepancies": [dict(zip(hdr, r)) for r in res]
+            }
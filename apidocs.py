@@ -0,0 +1,143 @@
+import click
+import json
+import os
+import threading
+from flask import Flask, current_app
+
+
+# The Swagger UI at /apidocs and the OpenAPI spec it reads. flasgger is slow
+# to import and parses every docstring in api.py, so by default neither
+# happens until the docs are first requested: a separate docs app with the
+# api blueprint is built then, and requests under DOC_PATHS are routed to it.
+#
+# SWAGGER_MODE is one of
+#   lazy   - build the docs app on first access (the default)
+#   static - like lazy, but serve the spec from SWAGGER_SPEC_FILE, written
+#            by `flask build-apispec`
+#   eager  - set up flasgger on the main app in create_app
+#   off    - no docs
+
+SWAGGER_CONFIG = {
+        'title': 'Beanbot API',
+        'uiversion': 3,
+        'templates': 'templates/flasgger/swagger_ui.html'
+        }
+
+TEMPLATE = {
+        "info": {
+            "title": "Beanbot API",
+            "description": "API for accessing data pertaining to TCM's coffee habits",
+            "contact": {
+                "responsibleOrganization": "als217",
+                "responsibleDeveloper": "als217",
+                "email": "CRSID AT CAM DOT AC DOT UK",
+                "url": "spuriosity1.github.io",
+                },
+            "termsOfService": "http://me.com/terms",
+            "version": "0.0.1"
+            },
+        # 'swaggerUiPrefix': LazyString(  lambda : request.environ.get('HTTP_X_SCRIPT_NAME', '')),
+        "basePath": "/api",  # base bash for blueprint registration
+        }
+
+SPEC_PATH = '/apispec_1.json'
+DOC_PATHS = ('/apidocs', SPEC_PATH, '/flasgger_static/', '/oauth2-redirect.html')
+
+
+def spec_file(app=None):
+    app = app or current_app
+    return app.config.get('SWAGGER_SPEC_FILE', os.path.join(app.instance_path, 'apispec.json'))
+
+
+def install(app):
+    '''Sets up flasgger on `app`. Returns the Swagger instance.'''
+    from flasgger import Swagger
+    return Swagger(app, template=TEMPLATE)
+
+
+def docs_app(app):
+    '''A minimal app serving the docs for the api blueprint of `app`.'''
+    from beanserver import api
+    docs = Flask(app.import_name, root_path=app.root_path, instance_path=app.instance_path)
+    docs.config.update(app.config)
+    docs.register_blueprint(api.bp)
+    swagger = install(docs)
+    return docs, swagger
+
+
+def build_spec(app):
+    '''The OpenAPI spec of the api blueprint, as a dict.'''
+    docs, swagger = docs_app(app)
+    with docs.app_context():
+        return swagger.get_apispecs()
+
+
+class LazyDocs:
+    '''
+    WSGI middleware sending requests for the docs to a docs app built on the
+    first of them, and everything else to the wrapped app.
+    '''
+    def __init__(self, app, wsgi_app, static_spec=None):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.static_spec = static_spec
+        self._docs = None
+        self._spec = None
+        self._lock = threading.Lock()
+
+    def docs(self):
+        if self._docs is None:
+            with self._lock:
+                if self._docs is None:
+                    self._docs, _swagger = docs_app(self.app)
+                    self.app.logger.info("Built the API docs app")
+        return self._docs
+
+    def spec(self):
+        '''The precompiled spec as bytes, or None to generate it instead.'''
+        if self._spec is None and self.static_spec is not None:
+            try:
+                with open(self.static_spec, 'rb') as f:
+                    self._spec = f.read()
+            except FileNotFoundError:
+                self.app.logger.warning(
+                        f"No API spec at {self.static_spec} (see flask build-apispec), "
+                        "generating it instead")
+                self.static_spec = None
+        return self._spec
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(DOC_PATHS):
+            return self.wsgi_app(environ, start_response)
+        if path == SPEC_PATH and self.spec() is not None:
+            start_response('200 OK', [('Content-Type', 'application/json'),
+                                      ('Content-Length', str(len(self._spec)))])
+            return [self._spec]
+        return self.docs().wsgi_app(environ, start_response)
+
+
+@click.command('build-apispec')
+@click.option('--out', default=None, help='Where to write the spec (default SWAGGER_SPEC_FILE).')
+def build_apispec_command(out):
+    '''Write the OpenAPI spec to a JSON file, for SWAGGER_MODE=static.'''
+    out = out or spec_file()
+    spec = build_spec(current_app)
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out + '.part', 'w') as f:
+        json.dump(spec, f)
+    os.replace(out + '.part', out)
+    click.echo(f"Wrote the API spec ({len(spec.get('paths', {}))} paths) to {out}")
+
+
+def init_app(app):
+    app.config.setdefault('SWAGGER', SWAGGER_CONFIG)
+    app.cli.add_command(build_apispec_command)
+    mode = app.config.get('SWAGGER_MODE', 'lazy')
+    if mode == 'eager':
+        install(app)
+    elif mode in ('lazy', 'static'):
+        app.wsgi_app = LazyDocs(app, app.wsgi_app,
+                                static_spec=spec_file(app) if mode == 'static' else None)
+    elif mode != 'off':
+        raise ValueError(f"Unknown SWAGGER_MODE {mode!r}")
@@ -0,0 +1,211 @@
+import click
+import datetime as dt
+import os
+import re
+import sqlite3
+from flask import current_app
+
+from beanserver import scheduler
+from beanserver.db import batch_writer, open_db
+
+
+# Archival of the transactionlog audit table. Rows older than
+# ARCHIVE_AFTER_DAYS move into one database per year of log_ts
+# (transactionlog-YYYY.db in ARCHIVE_DIR), keeping their `id`.
+# Rows are copied and committed to the archive before they are deleted from
+# the live table, so an interrupted run can never lose any, and rerunning
+# it finishes the job.
+
+LOG_COLUMNS = ['log_ts', 'operation', 'ts', 'ts_new', 'rfid', 'rfid_new',
+               'crsid', 'crsid_new', 'type', 'type_new', 'debit', 'debit_new',
+               'ncoffee', 'ncoffee_new']
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {db}transactionlog (
+	id INTEGER PRIMARY KEY,
+	{cols}
+	);
+CREATE INDEX IF NOT EXISTS {db}idx_archive_log_ts ON transactionlog (log_ts);
+CREATE INDEX IF NOT EXISTS {db}idx_archive_crsid ON transactionlog (crsid);
+CREATE INDEX IF NOT EXISTS {db}idx_archive_crsid_new ON transactionlog (crsid_new);
+"""
+
+ARCHIVE_FILE = re.compile(r'transactionlog-(\d{4})\.db')
+
+
+def archive_dir(app=None):
+    app = app or current_app
+    return app.config.get('ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+
+def archive_files(dest_dir):
+    '''Returns {year: path} of the archive databases in `dest_dir`.'''
+    if not os.path.isdir(dest_dir):
+        return {}
+    res = {}
+    for fname in os.listdir(dest_dir):
+        m = ARCHIVE_FILE.fullmatch(fname)
+        if m:
+            res[int(m.group(1))] = os.path.join(dest_dir, fname)
+    return res
+
+
+def archive(dest_dir, cutoff, batch_size=5000):
+    '''
+    Moves transactionlog rows logged before `cutoff` (a 'YYYY-MM-DD hh:mm:ss'
+    string) into the per-year archives, `batch_size` rows per transaction.
+    The writer is checked out for one batch at a time. Returns {year: rows
+    moved}.
+    '''
+    os.makedirs(dest_dir, exist_ok=True)
+    moved = {}
+    while True:
+        with batch_writer() as db:
+            n, year = _archive_batch(db, dest_dir, cutoff, batch_size)
+        if year is None:
+            break
+        moved[year] = moved.get(year, 0) + n
+    return moved
+
+def _archive_batch(db, dest_dir, cutoff, batch_size):
+    '''Moves one batch of rows of a single year. Returns (rows moved, year).'''
+    rows = db.execute(
+            "SELECT id, substr(log_ts, 1, 4) FROM transactionlog \
+                    WHERE log_ts < ? ORDER BY id LIMIT ?",
+            (cutoff, batch_size)).fetchall()
+    if len(rows) == 0:
+        return 0, None
+    year = int(rows[0][1])
+    ids = [r[0] for r in rows if int(r[1]) == year]
+    lo, hi = ids[0], ids[-1]
+
+    db.execute("ATTACH DATABASE ? AS archive", (archive_files(dest_dir).get(
+        year, os.path.join(dest_dir, f"transactionlog-{year}.db")),))
+    try:
+        cols = ', '.join(LOG_COLUMNS)
+        db.executescript(ARCHIVE_SCHEMA.format(db='archive.', cols=cols))
+        db.execute("BEGIN IMMEDIATE TRANSACTION;")
+        try:
+            db.execute(
+                f"INSERT OR IGNORE INTO archive.transactionlog (id, {cols}) \
+                        SELECT id, {cols} FROM main.transactionlog \
+                        WHERE id BETWEEN ? AND ? AND substr(log_ts, 1, 4) = ?",
+                (lo, hi, str(year)))
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+
+        # only what the archive now holds is deleted
+        db.execute("BEGIN IMMEDIATE TRANSACTION;")
+        try:
+            n = db.execute(
+                "DELETE FROM main.transactionlog WHERE id BETWEEN ? AND ? \
+                        AND id IN (SELECT id FROM archive.transactionlog \
+                            WHERE id BETWEEN ? AND ?)",
+                (lo, hi, lo, hi)).rowcount
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+    finally:
+        db.execute("DETACH DATABASE archive")
+    return n, year
+
+
+def incremental_vacuum(db, pages=1000):
+    '''
+    Returns up to `pages` free pages to the filesystem. Does nothing (and
+    returns False) unless the database has auto_vacuum=INCREMENTAL.
+    '''
+    mode, = db.execute("PRAGMA auto_vacuum").fetchone()
+    if mode != 2:
+        return False
+    db.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return True
+
+
+def search(db, dest_dir, crsid=None, after=None, before=None, before_id=None, limit=100):
+    '''
+    Audit rows matching the filters from the live table and the archives,
+    newest (highest id) first. `after` and `before` are log_ts strings, and
+    `before_id` continues from a previous page. Returns at most `limit` rows.
+    '''
+    conds, params = [], []
+    if crsid is not None:
+        conds.append("(crsid = ? OR crsid_new = ?)")
+        params += [crsid, crsid]
+    if after is not None:
+        conds.append("log_ts >= ?")
+        params.append(after)
+    if before is not None:
+        conds.append("log_ts <= ?")
+        params.append(before)
+    if before_id is not None:
+        conds.append("id < ?")
+        params.append(before_id)
+    where = (" WHERE " + " AND ".join(conds)) if conds else ""
+    cols = ', '.join(LOG_COLUMNS)
+
+    rows = db.execute(
+            f"SELECT id, {cols} FROM transactionlog{where} \
+                    ORDER BY id DESC LIMIT ?",
+            params + [limit]).fetchall()
+
+    first_year = int(after[:4]) if after else None
+    last_year = int(before[:4]) if before else None
+    for year, path in archive_files(dest_dir).items():
+        if (first_year is not None and year < first_year) \
+                or (last_year is not None and year > last_year):
+            continue
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows += conn.execute(
+                    f"SELECT id, {cols} FROM transactionlog{where} \
+                            ORDER BY id DESC LIMIT ?",
+                    params + [limit]).fetchall()
+        finally:
+            conn.close()
+    rows.sort(key=lambda r: r[0], reverse=True)
+    return rows[:limit]
+
+
+def run():
+    cfg = current_app.config
+    cutoff = dt.datetime.utcnow() - dt.timedelta(days=cfg.get('ARCHIVE_AFTER_DAYS', 365))
+    moved = archive(archive_dir(), cutoff.strftime("%Y-%m-%d %H:%M:%S"),
+                    batch_size=cfg.get('ARCHIVE_BATCH', 5000))
+    with batch_writer() as db:
+        incremental_vacuum(db, cfg.get('ARCHIVE_VACUUM_PAGES', 1000))
+    current_app.logger.info(f"Archived transactionlog rows: {moved}")
+    return moved
+
+
+@click.command('archive-log')
+@click.option('--days', type=int, default=None,
+              help='Archive rows older than this many days (default ARCHIVE_AFTER_DAYS).')
+@click.option('--enable-incremental-vacuum', is_flag=True,
+              help='Switch the database to auto_vacuum=INCREMENTAL. Runs a full VACUUM once.')
+def archive_log_command(days, enable_incremental_vacuum):
+    '''Move old transactionlog rows into the per-year archives.'''
+    if days is not None:
+        current_app.config['ARCHIVE_AFTER_DAYS'] = days
+    moved = run()
+    for year, n in sorted(moved.items()):
+        click.echo(f'{year}: {n} rows archived')
+    db = open_db(write=True)
+    if enable_incremental_vacuum:
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.execute("VACUUM")
+        click.echo('Enabled incremental vacuum')
+    elif db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        click.echo('auto_vacuum is not INCREMENTAL, freed pages stay in the file '
+                   '(see --enable-incremental-vacuum)')
+
+
+def init_app(app):
+    app.cli.add_command(archive_log_command)
+    interval = app.config.get('ARCHIVE_INTERVAL')
+    if interval:
+        # one worker archives, instead of all of them contending for the writer
+        scheduler.every(app, interval, run, 'archive',
+                        lock=os.path.join(archive_dir(app), '.schedule.lock'))
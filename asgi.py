@@ -0,0 +1,227 @@
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from beanserver import create_app, feed
+
+
+# ASGI entry point: `uvicorn --factory beanserver.asgi:create_asgi_app`
+#
+# The Flask app is run unchanged on a bounded pool of threads, so blocking
+# SQLite calls never run on the event loop, and an idle or slow client holds
+# no thread while its request body is read or its response is sent.
+
+
+class WSGIExecutor:
+    '''
+    ASGI adapter running a WSGI app in a ThreadPoolExecutor. At most
+    `threads` requests execute at once; the rest queue on the event loop.
+    Request bodies are buffered up to `max_body` bytes, and responses are
+    sent chunk by chunk as the WSGI iterable yields them.
+    '''
+    def __init__(self, wsgi_app, threads=16, max_body=1 << 20):
+        self.wsgi_app = wsgi_app
+        self.max_body = max_body
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='beanserver-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'websocket':
+            await self.websocket(receive, send)
+        # any other scope type is from a newer ASGI revision: returning without
+        # reading or sending anything turns it down
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def websocket(self, receive, send):
+        '''Nothing is served over websockets: refuse the handshake.'''
+        message = await receive()
+        if message['type'] == 'websocket.connect':
+            await send({'type': 'websocket.close', 'code': 1000})
+
+    async def read_body(self, receive):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body += message.get('body', b'')
+            if len(body) > self.max_body:
+                return False
+            if not message.get('more_body', False):
+                return bytes(body)
+
+    async def http(self, scope, receive, send):
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        if body is False:
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b'Request body too large'})
+            return
+
+        loop = asyncio.get_running_loop()
+        response = {}
+        # Flask keeps its request context in context variables, which a pool
+        # thread does not carry from one task to the next. The whole response
+        # is therefore produced in one context of its own, whichever threads
+        # the steps land on.
+        ctx = contextvars.Context()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and 'sent' in response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                    (k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]
+            return response.setdefault('written', []).append
+
+        def begin():
+            # start_response may be deferred until the first chunk is produced
+            chunks = self.wsgi_app(environ(scope, body), start_response)
+            it = iter(chunks)
+            first = next(it, None)
+            return chunks, it, first
+
+        chunks, it, chunk = await loop.run_in_executor(self.executor, ctx.run, begin)
+        try:
+            await send({'type': 'http.response.start',
+                        'status': response['status'],
+                        'headers': response['headers']})
+            response['sent'] = True
+            for early in response.get('written', []):
+                await send({'type': 'http.response.body', 'body': early, 'more_body': True})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, ctx.run, next, it, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(chunks, 'close'):
+                await loop.run_in_executor(self.executor, ctx.run, chunks.close)
+
+
+def environ(scope, body):
+    '''Builds the WSGI environ of an ASGI http scope.'''
+    root_path = scope.get('root_path', '')
+    path = scope.get('raw_path')
+    path = scope['path'].encode('utf8') if path is None else path.split(b'?', 1)[0]
+    path = path.decode('latin1')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    env = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path,
+            'PATH_INFO': path,
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE':
+            env['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = 'HTTP_' + name
+        env[key] = env[key] + ',' + value if key in env else value
+    return env
+
+
+class BeanserverASGI(WSGIExecutor):
+    '''
+    The beanserver app under ASGI. /api/stream is served natively on the
+    event loop, so that connected displays do not each hold a thread.
+    '''
+    def __init__(self, flask_app, **kwargs):
+        super().__init__(flask_app, **kwargs)
+        self.flask_app = flask_app
+
+    async def http(self, scope, receive, send):
+        path = scope['path'][len(scope.get('root_path', '')):]
+        if path == '/api/stream' and scope['method'] == 'GET':
+            await self.event_stream(scope, receive, send)
+        else:
+            await super().http(scope, receive, send)
+
+    async def event_stream(self, scope, receive, send):
+        if await self.read_body(receive) is None:
+            return
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        keepalive = self.flask_app.config.get('FEED_KEEPALIVE', 15.0)
+        last = dict(scope.get('headers', [])).get(b'last-event-id')
+        last = int(last) if last is not None and last.isdigit() else None
+
+        def subscribe():
+            with self.flask_app.app_context():
+                return feed.get_feed(self.flask_app).subscribe(
+                        last, notify=lambda: loop.call_soon_threadsafe(wake.set))
+
+        sub = await loop.run_in_executor(self.executor, subscribe)
+        gone = asyncio.ensure_future(receive())
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no')]})
+            await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n',
+                        'more_body': True})
+            while not gone.done():
+                wake.clear()
+                events = sub.pop_all()
+                if events:
+                    body = ''.join(feed.format_event(*e) for e in events)
+                    await send({'type': 'http.response.body',
+                                'body': body.encode('utf8'), 'more_body': True})
+                woken = asyncio.ensure_future(wake.wait())
+                done, _ = await asyncio.wait(
+                        {gone, woken}, timeout=keepalive,
+                        return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                if not done:
+                    await send({'type': 'http.response.body',
+                                'body': b': keepalive\n\n', 'more_body': True})
+        finally:
+            gone.cancel()
+            sub.close()
+
+
+def create_asgi_app(test_config=None):
+    flask_app = create_app(test_config)
+    # /api/stream costs no thread here, so the stats page may subscribe to it
+    flask_app.config.setdefault('FEED_LIVE', True)
+    return BeanserverASGI(
+            flask_app,
+            threads=flask_app.config.get('ASGI_THREADS', 16),
+            max_body=flask_app.config.get('ASGI_MAX_BODY', 1 << 20))
@@ -0,0 +1,160 @@
+import click
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from flask import abort, current_app, request, send_file, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Fingerprinted static files. `flask build-assets` copies everything under
+# static/ to ASSETS_DIR (static/dist) with a content hash in its name, plus
+# .gz and .br siblings of the text files, and writes a manifest mapping the
+# original paths to the hashed ones. Templates link through asset_url(), which
+# falls back to the plain /static/ URL for files not in the manifest (or when
+# nothing has been built), so a checkout works without a build step.
+#
+# A hashed name never changes content, so /static/dist/ responses are cached
+# forever (Cache-Control: immutable).
+
+MANIFEST = 'manifest.json'
+
+COMPRESSIBLE = {'.js', '.css', '.svg', '.json', '.webmanifest', '.html', '.txt', '.ico', '.map'}
+
+# bar traces are all that plot.js draws, so a partial bundle such as
+# plotly-basic can be dropped into static/lib and selected with PLOTLY_JS
+PLOTLY_JS = 'lib/plotly-2.24.1.min.js'
+
+
+def assets_dir(app=None):
+    app = app or current_app
+    return app.config.get('ASSETS_DIR', os.path.join(app.static_folder, 'dist'))
+
+
+def hashed_name(path, digest):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{digest[:12]}{ext}"
+
+
+def build(src, dest, gzip_level=9, br_quality=11):
+    '''
+    Fingerprints every file under `src` (except `dest` itself) into `dest`.
+    Earlier builds are left in place, so pages already served keep working.
+    Returns the manifest.
+    '''
+    dest = os.path.abspath(dest)
+    manifest = {}
+    for root, dirs, files in os.walk(src):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != dest)
+        for fname in sorted(files):
+            path = os.path.join(root, fname)
+            rel = os.path.relpath(path, src).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            target = hashed_name(rel, hashlib.sha256(data).hexdigest())
+            manifest[rel] = target
+
+            out = os.path.join(dest, target)
+            if os.path.exists(out):
+                continue
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            if os.path.splitext(fname)[1] in COMPRESSIBLE:
+                # only kept if they save something
+                packed = gzip.compress(data, compresslevel=gzip_level, mtime=0)
+                if len(packed) < len(data):
+                    _write(out + '.gz', packed)
+                if brotli is not None:
+                    packed = brotli.compress(data, quality=br_quality)
+                    if len(packed) < len(data):
+                        _write(out + '.br', packed)
+            # the plain file last, as build() skips files that exist
+            shutil.copyfile(path, out + '.part')
+            os.replace(out + '.part', out)
+
+    _write(os.path.join(dest, MANIFEST), json.dumps(manifest, indent=1, sort_keys=True).encode())
+    return manifest
+
+def _write(path, data):
+    with open(path + '.part', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.part', path)
+
+
+class Manifest:
+    '''The manifest of ASSETS_DIR, reloaded whenever it is rebuilt.'''
+    def __init__(self, folder):
+        self.path = os.path.join(folder, MANIFEST)
+        self.mtime = None
+        self.entries = {}
+
+    def get(self, path):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self.mtime:
+            entries = {}
+            if mtime is not None:
+                with open(self.path) as f:
+                    entries = json.load(f)
+            self.entries, self.mtime = entries, mtime
+        return self.entries.get(path)
+
+
+def asset_url(path):
+    '''URL of the static file `path`, fingerprinted if it has been built.'''
+    hashed = current_app.extensions['beanserver.assets'].get(path)
+    if hashed is None:
+        return url_for('static', filename=path)
+    return url_for('dist_asset', filename=hashed)
+
+
+def send_asset(filename):
+    folder = assets_dir()
+    path = safe_join(folder, filename)
+    if path is None or filename == MANIFEST or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    accepted = request.accept_encodings
+    encoding = None
+    for enc, ext in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[enc] and os.path.isfile(path + ext):
+            path, encoding = path + ext, enc
+            break
+
+    rv = send_file(path, mimetype=mimetype, max_age=current_app.config.get('ASSETS_MAX_AGE', 31536000))
+    if encoding is not None:
+        rv.headers['Content-Encoding'] = encoding
+    rv.vary.add('Accept-Encoding')
+    rv.cache_control.public = True
+    rv.cache_control.immutable = True
+    return rv
+
+
+@click.command('build-assets')
+def build_assets_command():
+    '''Fingerprint and precompress the static files.'''
+    cfg = current_app.config
+    dest = assets_dir()
+    manifest = build(current_app.static_folder, dest,
+                     gzip_level=cfg.get('ASSETS_GZIP_LEVEL', 9),
+                     br_quality=cfg.get('ASSETS_BR_QUALITY', 11))
+    click.echo(f"Built {len(manifest)} assets into {dest}"
+               + ('' if brotli is not None else ' (no brotli, .gz only)'))
+
+
+def init_app(app):
+    app.config.setdefault('PLOTLY_JS', PLOTLY_JS)
+    app.extensions['beanserver.assets'] = Manifest(assets_dir(app))
+    app.add_template_global(asset_url)
+    app.cli.add_command(build_assets_command)
+    # more specific than the static route, so it takes precedence under /static
+    app.add_url_rule(app.static_url_path + '/dist/<path:filename>', 'dist_asset', send_asset)
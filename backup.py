@@ -0,0 +1,157 @@
+import click
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from flask import current_app
+
+from beanserver import scheduler
+
+
+# Consistent snapshots of the primary database, taken with the online backup
+# API a few pages at a time, so that writers are never locked out for longer
+# than one step.
+
+SUFFIXES = ('.db', '.db.gz')
+
+_lock = threading.Lock()
+
+
+class _Restarting(Exception):
+    pass
+
+
+def snapshot(src, dest_dir, pages=256, sleep=0.01, compress=False,
+             max_restarts=8, logger=None):
+    '''
+    Copies the database at `src` into a new timestamped file in `dest_dir`,
+    and returns its path. The copy is written under a unique temporary name
+    and only renamed into place once complete. Names carry microseconds and
+    the process id, so snapshots taken at once by different workers never
+    overwrite each other, and still sort oldest first.
+
+    A write to `src` between two steps restarts the copy from the first
+    page. After `max_restarts` of them the copy is finished in one step
+    instead, which holds a read transaction throughout; under WAL writers
+    carry on regardless.
+    '''
+    os.makedirs(dest_dir, exist_ok=True)
+    now = time.time()
+    name = "beans-%s.%06dZ-%d" % (time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)),
+                                  int(now % 1 * 1e6), os.getpid())
+    fd, part = tempfile.mkstemp(prefix=name, suffix=".db.part", dir=dest_dir)
+    os.close(fd)
+
+    source = sqlite3.connect(f"file:{src}?mode=ro", uri=True)
+    target = sqlite3.connect(part)
+    try:
+        restarts = 0
+        left = None
+        def progress(status, remaining, total):
+            nonlocal restarts, left
+            # a restarted copy never gets closer to the end
+            if left is not None and remaining >= left:
+                restarts += 1
+                if restarts > max_restarts:
+                    raise _Restarting
+            left = remaining
+        try:
+            source.backup(target, pages=pages, progress=progress, sleep=sleep)
+        except _Restarting:
+            if logger is not None:
+                logger.warning(f"Backup of {src} restarted {max_restarts} times "
+                               "under writes, copying it in one step")
+            source.backup(target)
+        # the copy is a standalone file, not a WAL database
+        target.execute("PRAGMA journal_mode=DELETE")
+        ok, = target.execute("PRAGMA quick_check").fetchone()
+        if ok != 'ok':
+            raise sqlite3.DatabaseError(f"Snapshot of {src} failed quick_check: {ok}")
+    except BaseException:
+        target.close()
+        os.remove(part)
+        raise
+    finally:
+        source.close()
+    target.close()
+
+    if compress:
+        with open(part, 'rb') as f, gzip.open(part + '.gz', 'wb', compresslevel=6) as z:
+            shutil.copyfileobj(f, z, 1 << 20)
+        os.remove(part)
+        part, dest = part + '.gz', os.path.join(dest_dir, name + '.db.gz')
+    else:
+        dest = os.path.join(dest_dir, name + '.db')
+    os.replace(part, dest)
+    return dest
+
+
+def snapshots(dest_dir):
+    '''Completed snapshots in `dest_dir`, oldest first.'''
+    if not os.path.isdir(dest_dir):
+        return []
+    return sorted(os.path.join(dest_dir, f) for f in os.listdir(dest_dir)
+                  if f.startswith('beans-') and f.endswith(SUFFIXES))
+
+
+def rotate(dest_dir, keep):
+    '''Deletes all but the newest `keep` snapshots. Returns the deleted paths.'''
+    old = snapshots(dest_dir)[:-keep] if keep > 0 else []
+    for path in old:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # rotated by another worker
+            pass
+    return old
+
+
+def backup_dir(app=None):
+    app = app or current_app
+    return app.config.get('BACKUP_DIR', os.path.join(app.instance_path, 'backups'))
+
+
+def run():
+    '''Takes a snapshot of PRIMARYDB and rotates the backup directory.'''
+    cfg = current_app.config
+    dest_dir = backup_dir()
+    with _lock:
+        path = snapshot(cfg['PRIMARYDB'], dest_dir,
+                        pages=cfg.get('BACKUP_PAGES', 256),
+                        sleep=cfg.get('BACKUP_SLEEP', 0.01),
+                        compress=cfg.get('BACKUP_COMPRESS', False),
+                        max_restarts=cfg.get('BACKUP_MAX_RESTARTS', 8),
+                        logger=current_app.logger)
+        removed = rotate(dest_dir, cfg.get('BACKUP_KEEP', 7))
+    current_app.logger.info(f"Backed up database to {path}, removed {len(removed)} old snapshots")
+    return path
+
+
+def latest(max_age=None):
+    '''
+    Returns the newest snapshot, first taking a new one if there is none or
+    the newest is older than `max_age` seconds.
+    '''
+    existing = snapshots(backup_dir())
+    if existing and (max_age is None
+                     or time.time() - os.path.getmtime(existing[-1]) < max_age):
+        return existing[-1]
+    return run()
+
+
+@click.command('backup-db')
+def backup_db_command():
+    '''Take a snapshot of the primary database.'''
+    click.echo(run())
+
+
+def init_app(app):
+    app.cli.add_command(backup_db_command)
+    interval = app.config.get('BACKUP_INTERVAL')
+    if interval:
+        # one snapshot per interval, not one per worker
+        scheduler.every(app, interval, run, 'backup',
+                        lock=os.path.join(backup_dir(app), '.schedule.lock'))
@@ -0,0 +1,4 @@
+# Benchmarks of the API against synthetic databases.
+#
+#   python -m beanserver.bench --users 200 --years 3 --out results.json
+#   python -m beanserver.bench --compare results.json --out new.json
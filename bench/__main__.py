@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+
+from beanserver.bench import data, run
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(prog='python -m beanserver.bench',
+                                description='Benchmark the API on a synthetic database.')
+    p.add_argument('--folder', help='Where to build the databases (default: a temporary folder)')
+    p.add_argument('--users', type=int, default=100)
+    p.add_argument('--years', type=float, default=2.0)
+    p.add_argument('--taps-per-day', type=float, default=2.0,
+                   help='Mean taps of an active user on a term-time weekday')
+    p.add_argument('--mix', default='', help="Drink weights, e.g. 'espresso2=5,tea=0'")
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--config', action='append', default=[], metavar='KEY=JSON',
+                   help='App config override, e.g. CACHE_SIZE=0 (repeatable)')
+    p.add_argument('--drivers', default='client,http')
+    p.add_argument('--scenarios', default=','.join(run.SCENARIOS))
+    p.add_argument('--iterations', type=int, default=200,
+                   help='Requests per scenario through the test client')
+    p.add_argument('--concurrency', type=int, default=8,
+                   help='Concurrent connections of the HTTP driver')
+    p.add_argument('--duration', type=float, default=5.0,
+                   help='Seconds per scenario of the HTTP driver')
+    p.add_argument('--url', help='Load an already running server instead of an in-process one '
+                                 '(the HTTP driver only; its users are read from /api/listusers)')
+    p.add_argument('--out', help='Write the results as JSON to this file')
+    p.add_argument('--compare', help='Compare against an earlier results file')
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = {}
+    for item in args.config:
+        key, _, value = item.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    unknown = set(scenarios) - set(run.SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    drivers = [d for d in args.drivers.split(',') if d]
+
+    folder = args.folder or tempfile.mkdtemp(prefix='beanbench-')
+    t = time.perf_counter()
+    app, n = data.build(folder, users=args.users, years=args.years,
+                        taps_per_day=args.taps_per_day, mix=data.parse_mix(args.mix),
+                        seed=args.seed, config=config)
+    print(f"Built {n} transactions for {args.users} users in {time.perf_counter() - t:.1f}s "
+          f"({folder})", file=sys.stderr)
+    with app.app_context():
+        from beanserver.db import open_db
+        crsids = [r[0] for r in open_db().execute("SELECT crsid FROM users")]
+
+    results = []
+    for driver in drivers:
+        for scenario in scenarios:
+            if driver == 'client':
+                res = run.drive_client(app, scenario, crsids,
+                                       iterations=args.iterations, seed=args.seed)
+            elif driver == 'http' and args.url:
+                res = run.drive_http(args.url, scenario, _remote_users(args.url),
+                                     concurrency=args.concurrency,
+                                     duration=args.duration, seed=args.seed)
+            elif driver == 'http':
+                with run.Server(app) as server:
+                    res = run.drive_http(server.url, scenario, crsids,
+                                         concurrency=args.concurrency,
+                                         duration=args.duration, seed=args.seed)
+            else:
+                sys.exit(f"Unknown driver {driver}")
+            res = dict(driver=driver, scenario=scenario, **res)
+            results.append(res)
+            print(f"{driver:6} {scenario:18} p50 {res['p50_ms']}ms p99 {res['p99_ms']}ms "
+                  f"{res['throughput_rps']} req/s, {res['errors']} errors, "
+                  f"peak RSS {res['peak_rss_mb']}MB", file=sys.stderr)
+
+    report = {
+            "meta": {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+                "revision": _revision(),
+                },
+            "dataset": {"users": args.users, "years": args.years,
+                        "taps_per_day": args.taps_per_day, "mix": args.mix,
+                        "seed": args.seed, "transactions": n},
+            "config": config,
+            "settings": {"iterations": args.iterations, "concurrency": args.concurrency,
+                         "duration": args.duration, "url": args.url},
+            "results": results,
+            }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            for line in run.compare(json.load(f), report):
+                print(line)
+
+
+def _remote_users(url):
+    import urllib.request
+    with urllib.request.urlopen(url.rstrip('/') + '/api/listusers') as f:
+        return list(json.load(f)["users"])
+
+
+def _revision():
+    head = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.git', 'HEAD')
+    try:
+        with open(head) as f:
+            ref = f.read().strip()
+        if ref.startswith('ref: '):
+            with open(os.path.join(os.path.dirname(head), ref[5:])) as f:
+                return f.read().strip()
+        return ref
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import calendar
+import datetime as dt
+import math
+import os
+import random
+import sqlite3
+
+from beanserver import create_app
+from beanserver.db import init_db
+
+
+# Synthetic coffee databases. Taps follow a weekday/term-time pattern with a
+# morning and an after-lunch peak, and every user settles their debt with a
+# Payment row about once a month.
+
+# (type, ncoffee, debit in pence, weight)
+DRINKS = [
+        ('espresso', 1, 30, 10),
+        ('espresso2', 2, 50, 30),
+        ('americano', 1, 30, 8),
+        ('americano2', 2, 50, 12),
+        ('cappuccino', 1, 40, 10),
+        ('cappuccino2', 2, 60, 20),
+        ('tea', 0, 10, 10),
+        ]
+
+# fraction of taps landing in each hour of the day
+HOURS = [0, 0, 0, 0, 0, 0, 0, 1, 4, 10, 12, 8, 5, 6, 10, 9, 6, 4, 2, 1, 1, 1, 0, 0]
+
+
+def parse_mix(spec):
+    '''Parses 'espresso2=5,tea=1' into weights overriding DRINKS.'''
+    weights = {}
+    for part in filter(None, spec.split(',')):
+        name, _, w = part.partition('=')
+        weights[name.strip()] = float(w)
+    unknown = set(weights) - {d[0] for d in DRINKS}
+    if unknown:
+        raise ValueError(f"Unknown drink types: {', '.join(sorted(unknown))}")
+    return weights
+
+
+def in_term(day):
+    '''Rough Cambridge full terms, when the machine is busiest.'''
+    md = (day.month, day.day)
+    return ((10, 1) <= md <= (12, 10)) or ((1, 12) <= md <= (3, 20)) \
+            or ((4, 20) <= md <= (6, 20))
+
+
+def generate(conn, users=100, years=2.0, taps_per_day=2.0, mix=None,
+             seed=1, end=None):
+    '''
+    Fills a freshly created database with `users` users and `years` of taps,
+    ending at `end` (default now). `taps_per_day` is the mean for an active
+    user on a term-time weekday. Returns the number of transactions written.
+    '''
+    rng = random.Random(seed)
+    end = end or dt.datetime.utcnow().replace(microsecond=0)
+    start = end - dt.timedelta(days=int(years * 365))
+    weights = dict((d[0], d[3]) for d in DRINKS)
+    weights.update(mix or {})
+    drinks = [d for d in DRINKS if weights[d[0]] > 0]
+    drink_weights = [weights[d[0]] for d in drinks]
+
+    crsids = [f"{chr(97 + i % 26)}{chr(97 + i // 26 % 26)}{i:03d}" for i in range(users)]
+    # a few heavy drinkers, a long tail of occasional ones
+    appetite = {c: rng.lognormvariate(0, 0.8) for c in crsids}
+    rfids = {c: (700000000000 + i if rng.random() < 0.9 else None)
+             for i, c in enumerate(crsids)}
+    debt = dict.fromkeys(crsids, 0)
+
+    conn.executemany("INSERT INTO users (crsid, rfid, debt) VALUES (?, ?, 0)",
+                     list(rfids.items()))
+    rows = []
+    n = 0
+    day = start
+    while day < end:
+        base = taps_per_day * (1.0 if in_term(day) else 0.4) \
+                * (0.3 if day.weekday() >= 5 else 1.0)
+        midnight = calendar.timegm(day.date().timetuple())
+        for crsid in crsids:
+            for _ in range(_poisson(rng, base * appetite[crsid] / 2)):
+                hour = rng.choices(range(24), HOURS)[0]
+                ts = midnight + hour * 3600 + rng.randrange(3600)
+                ty, ncoffee, debit, _w = rng.choices(drinks, drink_weights)[0]
+                rows.append((ts, crsid, rfids[crsid], ty, debit, ncoffee))
+                debt[crsid] += debit
+            if day.day == 1 and debt[crsid] > 0 and rng.random() < 0.8:
+                rows.append((midnight + 12 * 3600, crsid, -1, 'Payment', -debt[crsid], 0))
+                debt[crsid] = 0
+        if len(rows) > 50000:
+            n += _flush(conn, rows)
+        day += dt.timedelta(days=1)
+    n += _flush(conn, rows)
+    conn.executemany("UPDATE users SET debt = ? WHERE crsid = ?",
+                     [(v, k) for k, v in debt.items()])
+    conn.commit()
+    return n
+
+
+def _poisson(rng, lam):
+    # Knuth's method, fine for the small means used here
+    limit, k, p = math.exp(-lam), 0, rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+def _flush(conn, rows):
+    rows.sort()
+    conn.executemany(
+            "INSERT INTO transactions (ts, crsid, rfid, type, debit, ncoffee) \
+                    VALUES (?, ?, ?, ?, ?, ?)", rows)
+    n = len(rows)
+    rows.clear()
+    return n
+
+
+def build(folder, **kwargs):
+    '''
+    Creates primary and secondary databases in `folder` from
+    create_database.sql and the migrations, fills the primary, and returns
+    an app configured to use them plus the number of transactions written.
+    '''
+    os.makedirs(folder, exist_ok=True)
+    config = {
+            'PRIMARYDB': os.path.join(folder, 'primary.db'),
+            'SECONDARYDB': os.path.join(folder, 'secondary.db'),
+            'BOT_PASSWORD': 'bench',
+            'PAY_PASSWORD': 'bench',
+            'TAP_PASSWORD': 'bench',
+            }
+    config.update(kwargs.pop('config', {}))
+    app = create_app(config)
+    with app.app_context():
+        init_db()
+    conn = sqlite3.connect(config['PRIMARYDB'])
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    n = generate(conn, **kwargs)
+    conn.execute("ANALYZE")
+    conn.close()
+    return app, n
@@ -0,0 +1,187 @@
+import http.client
+import json
+import random
+import resource
+import sys
+import threading
+import time
+import urllib.parse
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+
+# Request mixes. Each scenario turns (rng, crsids) into the method, path and
+# body of one request, so that consecutive requests vary the way real
+# clients do.
+
+def _crsid(rng, crsids):
+    return rng.choice(crsids)
+
+SCENARIOS = {
+        'leaderboard': lambda rng, c: ('GET', '/api/leaderboard/', None),
+        'leaderboard_week': lambda rng, c: ('GET', '/api/leaderboard/sinceday/6', None),
+        'leaderboard_windows': lambda rng, c: (
+            'GET', '/api/leaderboard/windows?windows=all,sinceday:6', None),
+        'leaderboard_after': lambda rng, c: (
+            'GET', f"/api/leaderboard/after/{rng.randint(2023, 2025)}-0{rng.randint(1, 9)}-01", None),
+        'userstats': lambda rng, c: ('GET', f"/api/userstats/{_crsid(rng, c)}", None),
+        'userstats_all': lambda rng, c: ('GET', '/api/userstats/?crsids=all', None),
+        'timeseries': lambda rng, c: ('GET', '/api/timeseries', None),
+        'timeseries_user': lambda rng, c: ('GET', f"/api/timeseries?crsid={_crsid(rng, c)}", None),
+        'histogram': lambda rng, c: ('GET', '/api/histogram?bin=day&tod=3600', None),
+        'balance': lambda rng, c: ('GET', f"/api/balance/{_crsid(rng, c)}", None),
+        'listusers': lambda rng, c: ('GET', '/api/listusers', None),
+        'payment': lambda rng, c: ('POST', '/api/newpayment', {
+            'form': {'crsid': _crsid(rng, c), 'password': 'bench',
+                     'payment': f"{rng.randint(1, 20)}.00"}}),
+        'taps': lambda rng, c: ('POST', '/api/taps', {
+            'json': {'password': 'bench', 'taps': [
+                {'crsid': _crsid(rng, c), 'type': 'espresso2', 'debit': 50, 'ncoffee': 2}]}}),
+        }
+
+
+def peak_rss_mb():
+    '''Peak resident set size of this process so far.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def summarise(latencies, errors, elapsed):
+    '''Latency percentiles (ms) and throughput of one run.'''
+    lat = sorted(latencies)
+
+    def pct(p):
+        return round(lat[min(len(lat) - 1, int(p / 100 * len(lat)))] * 1000, 3) if lat else None
+
+    return {
+            "requests": len(lat),
+            "errors": errors,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_rps": round(len(lat) / elapsed, 1) if elapsed > 0 else None,
+            "mean_ms": round(sum(lat) / len(lat) * 1000, 3) if lat else None,
+            "p50_ms": pct(50),
+            "p90_ms": pct(90),
+            "p99_ms": pct(99),
+            "max_ms": round(lat[-1] * 1000, 3) if lat else None,
+            "peak_rss_mb": peak_rss_mb(),
+            }
+
+
+# Drivers
+
+def drive_client(app, scenario, crsids, iterations=200, seed=1):
+    '''Sends `iterations` requests one at a time through the Flask test client.'''
+    rng = random.Random(seed)
+    client = app.test_client()
+    make = SCENARIOS[scenario]
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        method, path, body = make(rng, crsids)
+        t = time.perf_counter()
+        if body is None:
+            rv = client.open(path, method=method)
+        elif 'json' in body:
+            rv = client.open(path, method=method, json=body['json'])
+        else:
+            rv = client.open(path, method=method, data=body['form'])
+        rv.get_data()
+        latencies.append(time.perf_counter() - t)
+        # newpayment answers 400 even on success, so only count server errors
+        errors += rv.status_code >= 500
+    return summarise(latencies, errors, time.perf_counter() - start)
+
+
+class _KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Server:
+    '''The app on a threaded werkzeug server on a free local port.'''
+    def __init__(self, app):
+        self.httpd = make_server('127.0.0.1', 0, app, threaded=True,
+                                 request_handler=_KeepAliveHandler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+
+
+def drive_http(url, scenario, crsids, concurrency=8, duration=5.0, seed=1):
+    '''
+    Sends requests from `concurrency` threads, each over its own keep-alive
+    connection, for `duration` seconds.
+    '''
+    target = urllib.parse.urlsplit(url)
+    make = SCENARIOS[scenario]
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(i):
+        rng = random.Random(seed + i)
+        conn = http.client.HTTPConnection(target.hostname, target.port, timeout=60)
+        mine, failed = [], 0
+        while time.perf_counter() < deadline:
+            method, path, body = make(rng, crsids)
+            headers = {'Accept-Encoding': 'gzip, br'}
+            data = None
+            if body is not None and 'json' in body:
+                data = json.dumps(body['json']).encode()
+                headers['Content-Type'] = 'application/json'
+            elif body is not None:
+                data = urllib.parse.urlencode(body['form']).encode()
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            t = time.perf_counter()
+            try:
+                conn.request(method, target.path.rstrip('/') + path, body=data, headers=headers)
+                rv = conn.getresponse()
+                rv.read()
+                mine.append(time.perf_counter() - t)
+                failed += rv.status >= 500
+                if rv.getheader('Connection', '').lower() == 'close':
+                    conn.close()
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    res = summarise(latencies, errors[0], time.perf_counter() - start)
+    res["concurrency"] = concurrency
+    return res
+
+
+def compare(old, new):
+    '''Lines comparing the p50/p99 and throughput of two result files.'''
+    before = {(r["driver"], r["scenario"]): r for r in old["results"]}
+    lines = []
+    for r in new["results"]:
+        o = before.get((r["driver"], r["scenario"]))
+        if o is None:
+            continue
+
+        def ratio(key):
+            if not o.get(key) or r.get(key) is None:
+                return '   n/a'
+            return f"{r[key] / o[key]:6.2f}x"
+
+        lines.append(f"{r['driver']:6} {r['scenario']:18} p50 {ratio('p50_ms')} "
+                     f"p99 {ratio('p99_ms')} throughput {ratio('throughput_rps')}")
+    return lines
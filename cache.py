@@ -0,0 +1,100 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+from flask import Response, after_this_request, current_app, request
+
+from beanserver.db import generation
+
+
+class ResponseCache:
+    '''
+    LRU cache of serialised responses. Every entry remembers the database
+    generation it was computed at, and is discarded once that has moved on
+    or the entry is older than `ttl` seconds.
+    '''
+    def __init__(self, size=256, ttl=60.0):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, key, gen):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            entry_gen, expires, value = entry
+            if entry_gen != gen or expires < time.monotonic():
+                del self._entries[key]
+                self.stats["invalidations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key, gen, value):
+        with self._lock:
+            self._entries[key] = (gen, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries),
+                        size=self.size, ttl=self.ttl)
+
+
+def init_app(app):
+    app.extensions['beanserver.cache'] = ResponseCache(
+            size=app.config.get('CACHE_SIZE', 256),
+            ttl=app.config.get('CACHE_TTL', 60.0))
+
+def cached(view=None, *, extra=None):
+    '''
+    Serves the view from the response cache while neither transactions nor
+    users have changed. Keyed on the endpoint and its normalised arguments,
+    plus whatever `extra(**kwargs)` returns, such as the start of a time
+    window that moves with the clock.
+    '''
+    if view is None:
+        return functools.partial(cached, extra=extra)
+
+    @functools.wraps(view)
+    def wrapped(**kwargs):
+        cache = current_app.extensions['beanserver.cache']
+        gen = generation()
+        if cache.size <= 0 or gen is None:
+            return view(**kwargs)
+
+        gen = tuple(sorted(gen.items()))
+        key = (request.endpoint,
+               tuple(sorted(kwargs.items())),
+               tuple(sorted(request.args.items(multi=True))),
+               request.headers.get('Accept'),
+               extra(**kwargs) if extra is not None else None)
+        hit = cache.get(key, gen)
+        if hit is not None:
+            body, status, headers = hit
+            return Response(body, status, headers)
+
+        rv = current_app.make_response(view(**kwargs))
+        if not rv.is_streamed and rv.status_code < 300:
+            # registered after the view's own after_this_request hooks (which
+            # add headers like Vary), but runs before the app's after_request
+            # hooks, so the stored body is uncompressed
+            @after_this_request
+            def store(rv):
+                cache.put(key, gen, (rv.get_data(), rv.status_code, list(rv.headers)))
+                return rv
+        return rv
+    return wrapped
@@ -0,0 +1,51 @@
+import gzip
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE = {
+        'application/json',
+        'text/html',
+        'text/tab-separated-values',
+        }
+
+
+def compress_response(rv):
+    '''
+    Compresses large buffered responses with brotli (if installed) or gzip,
+    whichever the client accepts.
+    '''
+    cfg = current_app.config
+    if (rv.status_code != 200
+            or rv.is_streamed
+            or rv.direct_passthrough
+            or 'Content-Encoding' in rv.headers
+            or rv.mimetype not in COMPRESSIBLE):
+        return rv
+    rv.vary.add('Accept-Encoding')
+
+    body = rv.get_data()
+    if len(body) < cfg.get('COMPRESS_MIN_SIZE', 1024):
+        return rv
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        body = brotli.compress(body, quality=cfg.get('COMPRESS_BR_QUALITY', 5))
+        encoding = 'br'
+    elif accepted['gzip']:
+        body = gzip.compress(body, compresslevel=cfg.get('COMPRESS_GZIP_LEVEL', 6))
+        encoding = 'gzip'
+    else:
+        return rv
+
+    rv.set_data(body)
+    rv.headers['Content-Encoding'] = encoding
+    return rv
+
+
+def init_app(app):
+    app.after_request(compress_response)
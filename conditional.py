@@ -0,0 +1,63 @@
+import datetime as dt
+import functools
+import hashlib
+import sqlite3
+from flask import current_app, request
+from werkzeug.http import is_resource_modified
+
+from beanserver.db import open_db, generation
+
+
+def validator(*extra):
+    '''
+    Returns an (etag, last_modified) pair describing the current state of the
+    transactions and users tables as seen by this request, or None if the
+    database predates the generation table.
+    '''
+    gen = generation()
+    if gen is None:
+        return None
+    try:
+        max_rowid, mtime = open_db().execute(
+                "SELECT (SELECT max(rowid) FROM transactions), \
+                        (SELECT max(mtime) FROM generation)").fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+    state = [request.full_path, request.headers.get('Accept'), max_rowid] + sorted(gen.items()) + list(extra)
+    etag = hashlib.sha1(repr(state).encode('utf8')).hexdigest()[:20]
+    last_modified = None
+    if mtime is not None:
+        last_modified = dt.datetime.fromtimestamp(mtime, dt.timezone.utc)
+    return etag, last_modified
+
+
+def conditional(view=None, *, extra=None):
+    '''
+    Answers If-None-Match / If-Modified-Since with 304 Not Modified, without
+    running the view, while the data behind it is unchanged. `extra` returns
+    anything else the response depends on, such as today's date.
+    '''
+    if view is None:
+        return functools.partial(conditional, extra=extra)
+
+    @functools.wraps(view)
+    def wrapped(**kwargs):
+        v = validator(*(extra() if extra is not None else ()))
+        if v is None:
+            return view(**kwargs)
+        etag, last_modified = v
+
+        if not is_resource_modified(request.environ, etag=etag,
+                                    last_modified=last_modified):
+            rv = current_app.response_class(status=304)
+        else:
+            rv = current_app.make_response(view(**kwargs))
+            if rv.status_code != 200 or rv.is_streamed:
+                return rv
+        # weak, as compression may change the representation
+        rv.set_etag(etag, weak=True)
+        rv.last_modified = last_modified
+        rv.cache_control.no_cache = True
+        return rv
+    return wrapped
@@ -7,9 +7,16 @@
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS transactions;
 DROP TABLE IF EXISTS transactionlog;
+DROP TABLE IF EXISTS daily_totals;
+DROP TABLE IF EXISTS generation;
+DROP TABLE IF EXISTS ledger_checkpoints;
+DROP TABLE IF EXISTS ledger_discrepancies;
+DROP TABLE IF EXISTS ingest_keys;
 DROP TRIGGER IF EXISTS update_transactions;
 DROP TRIGGER IF EXISTS insert_transactions;
 DROP TRIGGER IF EXISTS delete_transactions;
+-- migrations/ are re-applied from scratch
+PRAGMA user_version = 0;
 
 CREATE TABLE users (
 	crsid TEXT PRIMARY KEY,
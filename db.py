@@ -1,19 +1,29 @@
 import sqlite3
+from contextlib import contextmanager
 from flask import g, current_app
 import os
+import queue
+import re
+import threading
+import time
 import click
 
 #DB construction
 def init_db():
     cfg =current_app.config
-    with current_app.open_resorce('create_database.sql') as f:
-        sqlite3.connect(cfg['PRIMARYDB']).executescript(f.read().decode('utf8'))
-        sqlite3.connect(cfg['SECONDARYDB']).executescript(f.read().decode('utf8'))
+    with current_app.open_resource('create_database.sql') as f:
+        script = f.read().decode('utf8')
+    for path in (cfg['PRIMARYDB'], cfg['SECONDARYDB']):
+        conn = sqlite3.connect(path)
+        conn.executescript(script)
+        migrate_db(conn)
+        conn.close()
 
 @click.command('init-db')
 def init_db_command():
     '''Clear existing data and create new tables.'''
-    if open_db() is not None:
+    cfg = current_app.config
+    if os.path.isfile(cfg['PRIMARYDB']) or os.path.isfile(cfg['SECONDARYDB']):
         proceed = click.confirm(f'''WARNING
 This operation will delete existing databases located at
 {current_app.config['PRIMARYDB']} {current_app.config['SECONDARYDB']}
@@ -21,32 +31,452 @@ Are you sure you want to proceed?''', abort=True)
     init_db()
     click.echo('Created new databases.')
 
+
+# Schema migrations
+# migrations/NNNN_name.sql is applied once to databases whose
+# PRAGMA user_version is below NNNN, and must not destroy data.
+def list_migrations():
+    folder = os.path.join(current_app.root_path, 'migrations')
+    res = []
+    for fname in sorted(os.listdir(folder)):
+        if fname.endswith('.sql'):
+            res.append((int(fname.split('_', 1)[0]), fname))
+    return res
+
+def migrate_db(conn):
+    '''Brings the schema of `conn` up to date, returning the migrations applied.'''
+    version, = conn.execute("PRAGMA user_version").fetchone()
+    applied = []
+    for v, fname in list_migrations():
+        if v <= version:
+            continue
+        with current_app.open_resource(os.path.join('migrations', fname)) as f:
+            script = f.read().decode('utf8')
+        try:
+            conn.executescript(
+                    f"BEGIN;\n{script}\nPRAGMA user_version = {v};\nCOMMIT;")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        applied.append(fname)
+    return applied
+
+@click.command('migrate-db')
+def migrate_db_command():
+    '''Apply pending schema migrations without touching existing data.'''
+    cfg = current_app.config
+    for path in (cfg['PRIMARYDB'], cfg['SECONDARYDB']):
+        if not os.path.isfile(path):
+            click.echo(f'{path}: not found, skipping')
+            continue
+        conn = sqlite3.connect(path, timeout=30)
+        applied = migrate_db(conn)
+        version, = conn.execute("PRAGMA user_version").fetchone()
+        conn.close()
+        click.echo(f'{path}: applied {len(applied)} migration(s), now at version {version}')
+        for fname in applied:
+            click.echo(f'  {fname}')
+
+
+# Representative statements from api.py, for checking index usage
+QUERY_PLANS = {
+        # two windows, as on the stats page (see api.leaderboard_sql)
+        'leaderboard': ("WITH parts (crsid, w0, w1) AS ("
+                        "SELECT crsid, sum(shots), sum(CASE WHEN day >= :d1 THEN shots END) "
+                        "FROM daily_totals WHERE day >= :first GROUP BY crsid "
+                        "UNION ALL SELECT crsid, "
+                        "sum(CASE WHEN ts > :b0 AND ts < :d0 THEN ncoffee END), "
+                        "sum(CASE WHEN ts > :b1 AND ts < :d1 THEN ncoffee END) "
+                        "FROM transactions WHERE (ts > :b0 AND ts < :d0) OR (ts > :b1 AND ts < :d1) "
+                        "GROUP BY crsid) "
+                        "SELECT crsid, sum(w0), sum(w1) FROM parts GROUP BY crsid",
+                        {'b0': 0, 'd0': 86400, 'b1': 0, 'd1': 86400, 'first': 86400}),
+        'userstats': ("SELECT sum(ncoffee), sum(debit) FROM transactions "
+                      "WHERE crsid=? AND ts > ?", ('', 0)),
+        'userstats_types': ("SELECT type,count(ts) FROM transactions "
+                            "WHERE crsid=? AND ts > ? GROUP BY type", ('', 0)),
+        'balance': ("SELECT IFNULL(SUM(debit), 0) FROM transactions "
+                    "WHERE crsid = ?", ('',)),
+        'timeseries': ("SELECT DATETIME(ts,'unixepoch'), type, crsid FROM transactions "
+                       "ORDER BY ts", ()),
+        'timeseries_user': ("SELECT DATETIME(ts,'unixepoch'), type, debit FROM transactions "
+                            "WHERE crsid=? ORDER BY ts", ('',)),
+        }
+
+def explain(conn, sql, params=()):
+    '''Returns the EXPLAIN QUERY PLAN detail lines for a statement.'''
+    # EXPLAIN never reads the schema cookie, so make sure ours is current
+    conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+    return [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+@click.command('explain-db')
+def explain_db_command():
+    '''Show the query plans of the hot API queries.'''
+    conn = open_db()
+    # scans of subqueries and CTEs are fine, only tables are flagged
+    tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for name, (sql, params) in QUERY_PLANS.items():
+        click.echo(f'{name}:')
+        for line in explain(conn, sql, params):
+            m = re.fullmatch(r'SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?', line)
+            flag = ''
+            if m and m.group(1) in tables:
+                flag = '  <-- full scan' + (f' of index {m.group(2)}' if m.group(2) else '')
+            click.echo(f'    {line}{flag}')
+
+def database_unavailable(e):
+    current_app.logger.warning(f"Database unavailable: {e}")
+    retry = current_app.config.get('DB_RETRY_AFTER', 1)
+    return {"success": False, "reason": "Database busy, retry later"}, 503, \
+            {'Retry-After': str(retry)}
+
 def init_app(app):
+    app.register_error_handler(DatabaseUnavailable, database_unavailable)
+    app.extensions['beanserver.pools'] = {}
+    app.extensions['beanserver.health'] = {}
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(explain_db_command)
 
-def open_db():
-    cfg =current_app.config
-    g.db = None
-    try:
-        if (os.path.isfile(cfg['PRIMARYDB'])):
-            g.db = sqlite3.connect(cfg['PRIMARYDB'])
-            g.db_idx = 1
-        elif (os.path.isfile(cfg['SECONDARYDB'])):
-            g.db = sqlite3.connect(cfg['SECONDARYDB'])
-            g.db_idx = 2
+
+# Instrumentation
+# Pools given an observer hand out connections whose cursors time every
+# statement from execute() until its rows are used up (or the cursor is
+# closed or dropped), then call observer(conn, sql, params, seconds, rows).
+class InstrumentedCursor(sqlite3.Cursor):
+    _sql = None
+
+    def _start(self, sql, params):
+        self._finish()
+        self._sql, self._params, self._rows, self._elapsed = sql, params, 0, 0.0
+
+    def _finish(self):
+        if self._sql is not None:
+            sql, self._sql = self._sql, None
+            observer = getattr(self.connection, 'observer', None)
+            if observer is not None:
+                observer(self.connection, sql, self._params, self._elapsed, self._rows)
+
+    def _timed(self, fn, *args):
+        t = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._elapsed += time.perf_counter() - t
+
+    def execute(self, sql, params=()):
+        self._start(sql, params)
+        return self._timed(super().execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        self._start(sql, None)
+        res = self._timed(super().executemany, sql, seq_of_params)
+        self._rows = max(self.rowcount, 0)
+        return res
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
         else:
-            raise Exception(f"Databases miscofigured- could not open %s or %s" %
-                            (cfg['PRIMARYDB'], cfg['SECONDARYDB']))
-    except sqlite3.OperationalError:
-        return None
-    
-    return g.db
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, self.arraysize if size is None else size)
+        self._rows += len(rows)
+        if len(rows) < (self.arraysize if size is None else size):
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self._timed(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+        self._rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+class InstrumentedConnection(sqlite3.Connection):
+    observer = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # the C shortcuts would bypass the cursor's execute
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+# Connection pooling
+class ConnectionPool:
+    '''
+    A bounded pool of long-lived connections to a single database file.
+    Connections are opened lazily, configured once when they are created and
+    health-checked every time they are handed out. Read-only pools open the
+    file with `mode=ro`, so they can never take the write lock.
+    '''
+    def __init__(self, path, size=4, timeout=5.0, pragmas=(), readonly=False,
+                 observer=None):
+        self.path = path
+        self.observer = observer
+        self.readonly = readonly
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = list(pragmas)
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "waits": 0, "opened": 0, "discarded": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _connect(self):
+        factory = sqlite3.Connection if self.observer is None else InstrumentedConnection
+        if self.readonly:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True,
+                                   check_same_thread=False, factory=factory)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False, factory=factory)
+        if self.observer is not None:
+            conn.observer = self.observer
+        for p in self.pragmas:
+            conn.execute(p)
+        self._count("opened")
+        return conn
+
+    @staticmethod
+    def _healthy(conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        if not self._slots.acquire(blocking=False):
+            self._count("waits")
+            if not self._slots.acquire(timeout=self.timeout):
+                raise sqlite3.OperationalError(
+                        f"Timed out waiting for a connection to {self.path}")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._healthy(conn):
+                    self._count("hits")
+                    return conn
+                self._count("discarded")
+                conn.close()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error:
+            self._count("discarded")
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _pragmas(cfg, write):
+    pragmas = {
+            'busy_timeout': cfg.get('DB_BUSY_TIMEOUT', 5000),
+            'cache_size': cfg.get('DB_CACHE_SIZE', -16000),
+            'mmap_size': cfg.get('DB_MMAP_SIZE', 64 * 1024 * 1024),
+            }
+    if write:
+        pragmas['journal_mode'] = cfg.get('DB_JOURNAL_MODE', 'WAL')
+        pragmas['synchronous'] = cfg.get('DB_SYNCHRONOUS', 'NORMAL')
+    pragmas.update(cfg.get('DB_PRAGMAS', {}))
+    return [f"PRAGMA {k}={v}" for k, v in pragmas.items()]
+
+def get_pool(app, path, write=False):
+    '''
+    Returns the reader pool (DB_POOL_SIZE read-only connections) or the
+    writer pool (a single read-write connection) for `path`.
+    '''
+    pools = app.extensions['beanserver.pools']
+    key = f"{path}:{'rw' if write else 'ro'}"
+    pool = pools.get(key)
+    if pool is None:
+        cfg = app.config
+        if not write:
+            # readers cannot change the (persistent) journal mode, so make
+            # sure the writer has configured the file first
+            writer = get_pool(app, path, write=True)
+            writer.release(writer.acquire())
+        pool = pools.setdefault(key, ConnectionPool(
+            path,
+            size=1 if write else cfg.get('DB_POOL_SIZE', 4),
+            timeout=cfg.get('DB_POOL_TIMEOUT', 5.0),
+            pragmas=_pragmas(cfg, write),
+            readonly=not write,
+            observer=app.extensions.get('beanserver.query_observer')))
+    return pool
+
+def pool_stats(app):
+    return {key: dict(pool.stats, size=pool.size)
+            for key, pool in app.extensions['beanserver.pools'].items()}
+
+# Failover
+# A database file failing with an error that retrying will not fix is marked
+# unhealthy for DB_FAILOVER_COOLDOWN seconds. Reads skip the primary while it
+# is unhealthy and the secondary exists; writes always go to the primary.
+FATAL_ERRORS = ('SQLITE_CORRUPT', 'SQLITE_NOTADB', 'SQLITE_IOERR', 'SQLITE_CANTOPEN',
+                'SQLITE_FULL')
+
+def is_fatal(e):
+    # errors without an sqlite error code, such as the ProgrammingError of a
+    # wrong binding count, are bugs in a query, not a damaged file
+    name = getattr(e, 'sqlite_errorname', None)
+    return name is not None and name.startswith(FATAL_ERRORS)
+
+def mark_unhealthy(app, path, error):
+    cooldown = app.config.get('DB_FAILOVER_COOLDOWN', 30.0)
+    app.extensions['beanserver.health'][path] = {
+            "until": time.monotonic() + cooldown,
+            "since": int(time.time()),
+            "error": str(error),
+            }
+    app.logger.error(f"Database {path} marked unhealthy for {cooldown}s: {error}")
+    # connections to it may be wedged, open new ones once it recovers
+    for mode in ('ro', 'rw'):
+        pool = app.extensions['beanserver.pools'].get(f"{path}:{mode}")
+        if pool is not None:
+            pool.close()
+
+def healthy(app, path):
+    health = app.extensions['beanserver.health'].get(path)
+    return health is None or health["until"] < time.monotonic()
+
+def health_stats(app):
+    now = time.monotonic()
+    return {path: {"since": h["since"], "error": h["error"],
+                   "retry_in": max(0.0, round(h["until"] - now, 1))}
+            for path, h in app.extensions['beanserver.health'].items()
+            if h["until"] > now}
+
+class DatabaseUnavailable(sqlite3.OperationalError):
+    '''
+    No connection could be had right now: the pool timed out (the single
+    writer is held elsewhere), or the file is locked. Retrying later helps.
+    Requests failing with it are answered with 503 and Retry-After.
+    '''
+
+def open_db(write=False):
+    '''
+    Returns this request's connection, checking one out of the pools on first
+    use. Readers get a read-only connection; `write=True` hands out the single
+    writer connection, which is held until the request is torn down.
+    Raises DatabaseUnavailable if the pool has no connection to give within
+    DB_POOL_TIMEOUT seconds.
+    '''
+    key = 'db_writer' if write else 'db'
+    if key in g:
+        return g.get(key)
+
+    cfg =current_app.config
+    files = [(path, idx) for idx, path in
+             enumerate((cfg['PRIMARYDB'], cfg['SECONDARYDB']), start=1)
+             if os.path.isfile(path)]
+    if not files:
+        raise Exception(f"Databases miscofigured- could not open %s or %s" %
+                        (cfg['PRIMARYDB'], cfg['SECONDARYDB']))
+    if write:
+        files = files[:1]
+    else:
+        files = [f for f in files if healthy(current_app, f[0])] or files
+
+    for path, idx in files:
+        try:
+            pool = get_pool(current_app, path, write)
+            conn = pool.acquire()
+        except sqlite3.DatabaseError as e:
+            if not is_fatal(e):
+                raise DatabaseUnavailable(f"No connection to {path}: {e}") from e
+            mark_unhealthy(current_app, path, e)
+            error = e
+            continue
+        setattr(g, key, conn)
+        setattr(g, key + '_pool', pool)
+        g.db_idx = idx
+        return conn
+    raise error
 
-def close_db(_):
-    db = g.pop('db',None)
-    if db is not None:
-        db.close()
+@contextmanager
+def batch_writer():
+    '''
+    The writer connection, checked out for the `with` block only. Jobs working
+    through many batches take it once per batch, so that payments and taps
+    waiting on the single writer get it between batches rather than after the
+    whole job. The connection of a request already holding it is reused.
+    '''
+    if 'db_writer' in g:
+        yield g.db_writer
+        return
+    with current_app.app_context():
+        yield open_db(write=True)
 
+def generation():
+    '''
+    Returns the change counters of the transactions and users tables (and of
+    the crsids and cards alone, as `directory`) as they were at the start of
+    this request, or None if the database predates them.
+    '''
+    if 'db_generation' not in g:
+        db = open_db()
+        try:
+            g.db_generation = dict(db.execute(
+                "SELECT tbl, n FROM generation").fetchall())
+        except sqlite3.OperationalError:
+            g.db_generation = None
+    return g.db_generation
 
-        
+def close_db(e):
+    if isinstance(e, sqlite3.DatabaseError) and is_fatal(e) and g.get('db_idx') == 1:
+        # fail the remaining requests over to the secondary
+        mark_unhealthy(current_app, current_app.config['PRIMARYDB'], e)
+    for key in ('db', 'db_writer'):
+        db = g.pop(key, None)
+        pool = g.pop(key + '_pool', None)
+        if db is not None:
+            pool.release(db)
@@ -0,0 +1,75 @@
+import threading
+from flask import current_app, g
+
+from beanserver.db import open_db, generation
+
+
+class UserDirectory:
+    '''
+    In-memory copy of the users table: crsid -> rfid (or None for users
+    without a card) and rfid -> crsid. It is reloaded whenever the users
+    change counter moves, so lookups are free of SQL between user writes.
+    '''
+    def __init__(self):
+        self.rfid_of = {}
+        self.crsid_of = {}
+        self._version = None
+        self._lock = threading.Lock()
+        self.stats = {"loads": 0, "lookups": 0, "invalidations": 0}
+
+    def refresh(self, db, version):
+        '''Reloads from `db` unless already at `version` (None always reloads).'''
+        if version is not None and version == self._version:
+            return
+        with self._lock:
+            if version is not None and version == self._version:
+                return
+            rows = db.execute(
+                    "SELECT crsid, rfid FROM users ORDER BY crsid").fetchall()
+            # swap in complete maps so concurrent readers never see a partial load
+            self.rfid_of = dict(rows)
+            self.crsid_of = {rfid: crsid for crsid, rfid in rows if rfid is not None}
+            self._version = version
+            self.stats["loads"] += 1
+
+    def invalidate(self):
+        '''Forces a reload on the next lookup.'''
+        self._version = None
+        self.stats["invalidations"] += 1
+
+    def exists(self, crsid):
+        self.stats["lookups"] += 1
+        return crsid in self.rfid_of
+
+    def rfid(self, crsid):
+        self.stats["lookups"] += 1
+        return self.rfid_of.get(crsid)
+
+    def crsid(self, rfid):
+        self.stats["lookups"] += 1
+        return self.crsid_of.get(rfid)
+
+    def listing(self):
+        '''The /listusers payload: crsid -> whether a card is associated.'''
+        return {crsid: rfid is not None for crsid, rfid in self.rfid_of.items()}
+
+    def info(self):
+        return dict(self.stats, users=len(self.rfid_of), cards=len(self.crsid_of))
+
+
+def get_directory():
+    '''Returns this worker's user directory, brought up to date for this request.'''
+    directory = current_app.extensions['beanserver.directory']
+    db = open_db()
+    gen = generation()
+    # the directory counter skips debt updates; older databases only have users
+    version = None if gen is None else (g.db_idx, gen.get('directory', gen.get('users')))
+    directory.refresh(db, version)
+    return directory
+
+def invalidate():
+    current_app.extensions['beanserver.directory'].invalidate()
+
+
+def init_app(app):
+    app.extensions['beanserver.directory'] = UserDirectory()
@@ -0,0 +1,176 @@
+import json
+import threading
+from collections import deque
+from flask import current_app
+
+from beanserver import scheduler
+from beanserver.db import open_db
+
+
+# Change feed of the transactions table, tailed from the transactionlog audit
+# table by id. One poller per worker fans every change out to all of the
+# connected /api/stream clients, so a client costs nothing in the database.
+
+LOG_COLUMNS = "id, operation, ts, ts_new, crsid, crsid_new, type, type_new, \
+        debit, debit_new, ncoffee, ncoffee_new"
+
+
+def _event(row):
+    '''Turns a transactionlog row into a `tx` event, with its leaderboard delta.'''
+    (rowid, op, ts, ts_new, crsid, crsid_new, ty, ty_new,
+            debit, debit_new, ncoffee, ncoffee_new) = row
+    shots = {}
+    if op in ('DELETE', 'UPDATE'):
+        shots[crsid] = shots.get(crsid, 0) - (ncoffee or 0)
+    if op in ('INSERT', 'UPDATE'):
+        shots[crsid_new] = shots.get(crsid_new, 0) + (ncoffee_new or 0)
+    data = {"op": op.lower(), "shots": {k: v for k, v in shots.items() if v}}
+    if op != 'DELETE':
+        data["new"] = {"ts": ts_new, "crsid": crsid_new, "type": ty_new,
+                       "debit": debit_new, "ncoffee": ncoffee_new}
+    if op != 'INSERT':
+        data["old"] = {"ts": ts, "crsid": crsid, "type": ty,
+                       "debit": debit, "ncoffee": ncoffee}
+    return rowid, 'tx', data
+
+
+def format_event(eid, name, data):
+    '''Serialises an event in text/event-stream framing.'''
+    return f"id: {eid}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+class Subscription:
+    '''
+    Events for one client. Delivery never blocks the feed: a client which
+    falls `maxsize` events behind is sent a `reset` event and its backlog is
+    dropped, after which it should refetch its data.
+    '''
+    def __init__(self, feed, maxsize, notify=None):
+        self.feed = feed
+        self.events = deque()
+        self.maxsize = maxsize
+        self.ready = threading.Condition()
+        self.notify = notify
+        self.closed = False
+
+    def push(self, event):
+        with self.ready:
+            if len(self.events) >= self.maxsize:
+                self.events.clear()
+                self.feed.stats["overflows"] += 1
+                event = (event[0], 'reset', {"reason": "client fell behind"})
+            self.events.append(event)
+            self.ready.notify()
+        if self.notify is not None:
+            self.notify()
+
+    def pop_all(self):
+        with self.ready:
+            events, self.events = list(self.events), deque()
+            return events
+
+    def wait(self, timeout):
+        '''Blocks until an event is queued or `timeout` seconds have passed.'''
+        with self.ready:
+            if not self.events:
+                self.ready.wait(timeout)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.feed.unsubscribe(self)
+
+    def stream(self, keepalive):
+        '''Generator of text/event-stream chunks, for synchronous servers.'''
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                self.wait(keepalive)
+                events = self.pop_all()
+                if not events:
+                    yield ": keepalive\n\n"
+                for event in events:
+                    yield format_event(*event)
+        finally:
+            self.close()
+
+
+class ChangeFeed:
+    '''
+    Polls transactionlog every `interval` seconds for rows past the last one
+    seen and publishes them to every subscriber. The newest `backlog` events
+    are kept so that reconnecting clients (Last-Event-ID) can catch up.
+    '''
+    def __init__(self, app, interval=1.0, backlog=256, queue_size=64):
+        self.interval = interval
+        self.queue_size = queue_size
+        self.recent = deque(maxlen=backlog)
+        self.subscribers = set()
+        self.last = None
+        self._lock = threading.Lock()
+        self.stats = {"polls": 0, "events": 0, "subscribers": 0,
+                      "overflows": 0, "resumed": 0}
+        self.stop = scheduler.every(app, interval, self.poll, 'beanserver-feed')
+
+    def poll(self):
+        db = open_db()
+        if self.last is None:
+            self.last, = db.execute(
+                    "SELECT coalesce(max(id), 0) FROM transactionlog").fetchone()
+            return
+        rows = db.execute(
+                f"SELECT {LOG_COLUMNS} FROM transactionlog \
+                        WHERE id > ? ORDER BY id LIMIT 1000",
+                (self.last,)).fetchall()
+        self.stats["polls"] += 1
+        if not rows:
+            return
+        self.last = rows[-1][0]
+        events = [_event(r) for r in rows]
+        with self._lock:
+            self.recent.extend(events)
+            subscribers = list(self.subscribers)
+        self.stats["events"] += len(events)
+        for sub in subscribers:
+            for event in events:
+                sub.push(event)
+
+    def subscribe(self, last_event_id=None, notify=None):
+        sub = Subscription(self, self.queue_size, notify)
+        with self._lock:
+            self.subscribers.add(sub)
+            self.stats["subscribers"] = len(self.subscribers)
+            if last_event_id is not None and last_event_id < (self.last or 0):
+                if self.recent and self.recent[0][0] <= last_event_id + 1:
+                    sub.events.extend(e for e in self.recent if e[0] > last_event_id)
+                    self.stats["resumed"] += 1
+                else:
+                    # some of what the client missed is no longer held
+                    sub.events.append((self.last, 'reset', {"reason": "missed events"}))
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self.subscribers.discard(sub)
+            self.stats["subscribers"] = len(self.subscribers)
+
+    def info(self):
+        return dict(self.stats, last=self.last, backlog=len(self.recent))
+
+
+_start_lock = threading.Lock()
+
+def get_feed(app=None):
+    '''Returns this worker's change feed, starting its poller on first use.'''
+    app = app or current_app._get_current_object()
+    with _start_lock:
+        feed = app.extensions.get('beanserver.feed')
+        if feed is None:
+            feed = app.extensions['beanserver.feed'] = ChangeFeed(
+                    app,
+                    interval=app.config.get('FEED_INTERVAL', 1.0),
+                    backlog=app.config.get('FEED_BACKLOG', 256),
+                    queue_size=app.config.get('FEED_QUEUE', 64))
+            # start from the current end of the log
+            feed.poll()
+    return feed
@@ -0,0 +1,115 @@
+import importlib
+import importlib.util
+import json
+import struct
+import sys
+from array import array
+
+# pyarrow is optional and slow to import, so it is only loaded by the first
+# Arrow response
+HAVE_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+
+# Columnar encodings of a time series table. Timestamps are raw unix times,
+# and the low-cardinality text columns are dictionary encoded.
+
+DICTIONARY_COLUMNS = {'type', 'crsid'}
+
+MIMETYPES = {
+        'json': 'application/json',
+        'columns': 'application/json',
+        'packed': 'application/x-beanserver-packed',
+        'arrow': 'application/vnd.apache.arrow.stream',
+        }
+
+
+def available():
+    '''Returns the output formats usable in this environment.'''
+    return [f for f in MIMETYPES if f != 'arrow' or HAVE_PYARROW]
+
+def negotiate(requested, accept):
+    '''
+    Picks an output format from the `format=` argument, falling back to the
+    Accept header. Returns None if the requested format is unavailable.
+
+    JSON wins unless a binary type is preferred strictly over it, so `*/*` or
+    no Accept header at all keeps existing clients on JSON.
+    '''
+    if requested is not None:
+        return requested if requested in available() else None
+    best, best_q = 'json', accept.quality('application/json')
+    for f in available():
+        if f in ('packed', 'arrow') and accept.quality(MIMETYPES[f]) > best_q:
+            best, best_q = f, accept.quality(MIMETYPES[f])
+    return best
+
+
+def _dictionary_encode(values):
+    dictionary = {}
+    codes = array('H', (dictionary.setdefault(v, len(dictionary)) for v in values))
+    return list(dictionary), codes
+
+def _columns(hdr, rows):
+    '''Splits rows into (name, dictionary or None, array) triples.'''
+    res = []
+    for i, name in enumerate(hdr):
+        values = [r[i] for r in rows]
+        if name in DICTIONARY_COLUMNS:
+            dictionary, codes = _dictionary_encode(values)
+            res.append((name, dictionary, codes))
+        else:
+            res.append((name, None, array('q', values)))
+    return res
+
+
+def encode_columns(hdr, rows, meta={}):
+    '''JSON object holding one array per column.'''
+    cols = {}
+    for name, dictionary, values in _columns(hdr, rows):
+        if dictionary is None:
+            cols[name] = values.tolist()
+        else:
+            cols[name] = {"dictionary": dictionary, "codes": values.tolist()}
+    return dict(meta, length=len(rows), columns=cols)
+
+
+def encode_packed(hdr, rows, meta={}):
+    '''
+    Binary layout: the magic b'BEAN1', a little-endian uint32 header length,
+    a JSON header describing the columns, then every column as a packed
+    little-endian array (int64 values, or uint16 dictionary codes) in the
+    order they are listed in the header.
+    '''
+    header = dict(meta, length=len(rows), columns=[])
+    payload = []
+    for name, dictionary, values in _columns(hdr, rows):
+        col = {"name": name, "dtype": "int64" if dictionary is None else "uint16"}
+        if dictionary is not None:
+            col["dictionary"] = dictionary
+        header["columns"].append(col)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        payload.append(values.tobytes())
+    header = json.dumps(header).encode('utf8')
+    return b''.join([b'BEAN1', struct.pack('<I', len(header)), header] + payload)
+
+
+def encode_arrow(hdr, rows, meta={}):
+    '''Arrow IPC stream with a single record batch.'''
+    pyarrow = importlib.import_module('pyarrow')
+    arrays = []
+    for name, dictionary, values in _columns(hdr, rows):
+        if dictionary is not None:
+            arrays.append(pyarrow.DictionaryArray.from_arrays(
+                pyarrow.array(values, pyarrow.uint16()),
+                pyarrow.array(dictionary, pyarrow.string())))
+        elif name == 'timestamp':
+            arrays.append(pyarrow.array(values, pyarrow.timestamp('s', tz='UTC')))
+        else:
+            arrays.append(pyarrow.array(values, pyarrow.int64()))
+    batch = pyarrow.RecordBatch.from_arrays(arrays, names=hdr)
+    batch = batch.replace_schema_metadata({k: json.dumps(v) for k, v in meta.items()})
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
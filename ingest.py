@@ -0,0 +1,202 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+from beanserver.db import DatabaseUnavailable, is_fatal, open_db
+
+
+TAP_FIELDS = {
+        'type': str,
+        'debit': int,
+        'ncoffee': int,
+        }
+
+
+def validate_tap(tap):
+    '''Returns an error message for a malformed tap, or None.'''
+    if not isinstance(tap, dict):
+        return "tap must be an object"
+    if ('rfid' in tap) == ('crsid' in tap):
+        return "tap needs exactly one of rfid, crsid"
+    if 'rfid' in tap and not isinstance(tap['rfid'], int):
+        return "rfid must be an integer"
+    if 'crsid' in tap and not isinstance(tap['crsid'], str):
+        return "crsid must be a string"
+    for k, ty in TAP_FIELDS.items():
+        if not isinstance(tap.get(k), ty) or isinstance(tap.get(k), bool):
+            return f"{k} must be of type {ty.__name__}"
+    if 'ts' in tap and not isinstance(tap['ts'], int):
+        return "ts must be a unix time"
+    if 'key' in tap and not (isinstance(tap['key'], str) and 0 < len(tap['key']) <= 64):
+        return "key must be a string of at most 64 characters"
+    return None
+
+
+def _record(db, tap):
+    key = tap.get('key')
+    if key is not None:
+        found = db.execute(
+                "SELECT result FROM ingest_keys WHERE key = ?", (key,)).fetchone()
+        if found is not None:
+            return dict(json.loads(found[0]), duplicate=True)
+
+    if 'crsid' in tap:
+        found = db.execute(
+                "SELECT crsid, rfid FROM users WHERE crsid = ?",
+                (tap['crsid'].strip().lower(),)).fetchone()
+    else:
+        found = db.execute(
+                "SELECT crsid, rfid FROM users WHERE rfid = ?",
+                (tap['rfid'],)).fetchone()
+    if found is None:
+        # not remembered against the key: a retry after registering the
+        # card should go through
+        return {"status": "unknown_user"}
+    crsid, rfid = found
+
+    db.execute(
+        "UPDATE users SET debt = debt + ? WHERE crsid = ?",
+        (tap['debit'], crsid))
+    cur = db.execute(
+        "INSERT INTO transactions (ts, crsid, rfid, type, debit, ncoffee) VALUES (?, ?, ?, ?, ?, ?)",
+        (tap.get('ts', int(time.time())), crsid, tap.get('rfid', rfid),
+         tap['type'], tap['debit'], tap['ncoffee']))
+    # the id /api/timeseries pages by, not the rowid, which can be reused
+    tx_id, = db.execute(
+        "SELECT id FROM transaction_ids WHERE tx = ?", (cur.lastrowid,)).fetchone()
+    result = {"status": "ok", "crsid": crsid, "id": tx_id}
+
+    if key is not None:
+        db.execute(
+            "INSERT INTO ingest_keys (key, ts, result) VALUES (?, strftime('%s', 'now'), ?)",
+            (key, json.dumps(result)))
+    return result
+
+
+class _Request:
+    def __init__(self, taps):
+        self.taps = taps
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+        # queued -> taken by the writer, or queued -> cancelled by a timeout
+        self.state = 'queued'
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.state == 'queued':
+                self.state = 'taken'
+            return self.state == 'taken'
+
+    def cancel(self):
+        with self.lock:
+            if self.state == 'queued':
+                self.state = 'cancelled'
+            return self.state == 'cancelled'
+
+
+class GroupCommitWriter:
+    '''
+    Single writer thread that drains queued tap requests and commits up to
+    `max_batch` of them in one transaction. Each request runs in its own
+    savepoint, so one failing request does not undo the others.
+    '''
+    def __init__(self, app, max_batch=256, linger=0.002, key_ttl=7 * 86400):
+        self.app = app
+        self.max_batch = max_batch
+        self.linger = linger
+        self.key_ttl = key_ttl
+        self._queue = queue.Queue()
+        self._last_prune = 0
+        self.stats = {"requests": 0, "taps": 0, "batches": 0}
+        threading.Thread(target=self._run, name='ingest', daemon=True).start()
+
+    def submit(self, taps, timeout):
+        '''
+        Queues taps and waits for their results. Returns None on timeout, in
+        which case none of the taps is recorded: a request the writer has
+        already started on is waited for instead.
+        '''
+        req = _Request(taps)
+        self._queue.put(req)
+        if not req.done.wait(timeout):
+            if req.cancel():
+                return None
+            req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.results
+
+    def _drain(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get(
+                    timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [req for req in self._drain() if req.take()]
+            if not batch:
+                continue
+            try:
+                with self.app.app_context():
+                    self._commit(open_db(write=True), batch)
+            except Exception as e:
+                if isinstance(e, sqlite3.OperationalError) and not is_fatal(e) \
+                        and not isinstance(e, DatabaseUnavailable):
+                    # locked or busy: worth a retry, so the client gets a 503
+                    e = DatabaseUnavailable(f"Could not commit taps: {e}")
+                self.app.logger.exception("Failed to commit ingested taps")
+                for req in batch:
+                    req.results, req.error = None, e
+            for req in batch:
+                req.done.set()
+
+    def _commit(self, db, batch):
+        db.execute("BEGIN IMMEDIATE TRANSACTION;")
+        try:
+            for req in batch:
+                db.execute("SAVEPOINT tap_request;")
+                try:
+                    req.results = [_record(db, tap) for tap in req.taps]
+                    db.execute("RELEASE tap_request;")
+                except Exception as e:
+                    db.execute("ROLLBACK TO tap_request;")
+                    db.execute("RELEASE tap_request;")
+                    req.results, req.error = None, e
+            if time.time() - self._last_prune > 3600:
+                db.execute(
+                    "DELETE FROM ingest_keys WHERE ts < strftime('%s', 'now') - ?",
+                    (self.key_ttl,))
+                self._last_prune = time.time()
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        self.stats["batches"] += 1
+        self.stats["requests"] += len(batch)
+        self.stats["taps"] += sum(len(req.taps) for req in batch)
+
+
+_lock = threading.Lock()
+
+def get_writer(app):
+    '''Returns this worker's writer, starting it on first use.'''
+    with _lock:
+        writer = app.extensions.get('beanserver.ingest')
+        if writer is None:
+            cfg = app.config
+            writer = app.extensions['beanserver.ingest'] = GroupCommitWriter(
+                    app,
+                    max_batch=cfg.get('INGEST_MAX_BATCH', 256),
+                    linger=cfg.get('INGEST_LINGER', 0.002),
+                    key_ttl=cfg.get('INGEST_KEY_TTL', 7 * 86400))
+        return writer
@@ -0,0 +1,36 @@
+def verify(db, crsid):
+    '''
+    Returns (debt, debit_sum) for a user, or None if they are not registered.
+    debit_sum is the user's latest checkpoint plus the debits recorded after
+    it, so the cost is bounded by the rows since the last checkpoint. Both
+    numbers come from one statement, and so from one snapshot.
+    '''
+    return db.execute(
+            "SELECT u.debt, IFNULL(c.debit_sum, 0) + IFNULL(( \
+                    SELECT sum(debit) FROM transactions \
+                    WHERE crsid = u.crsid AND rowid > IFNULL(c.upto, 0)), 0) \
+            FROM users u LEFT JOIN ledger_checkpoints c ON c.crsid = u.crsid \
+            WHERE u.crsid = ?",
+            (crsid,)).fetchone()
+
+
+def checkpoint(db, crsid, min_rows=1):
+    '''
+    Moves a user's checkpoint up to their latest transaction, if at least
+    `min_rows` have been recorded since the last one. Needs the writer
+    connection; the caller commits. Returns the number of checkpoints written.
+    '''
+    return db.execute(
+            "INSERT INTO ledger_checkpoints (crsid, upto, debit_sum, ts) \
+                    SELECT t.crsid, max(t.rowid), IFNULL(c.debit_sum, 0) + sum(t.debit), \
+                            strftime('%s', 'now') \
+                    FROM transactions t \
+                    LEFT JOIN ledger_checkpoints c ON c.crsid = t.crsid \
+                    WHERE t.crsid = ? AND t.rowid > IFNULL(c.upto, 0) \
+                    GROUP BY t.crsid \
+                    HAVING count(*) >= ? \
+            ON CONFLICT (crsid) DO UPDATE SET \
+                    upto = excluded.upto, \
+                    debit_sum = excluded.debit_sum, \
+                    ts = excluded.ts",
+            (crsid, min_rows)).rowcount
@@ -0,0 +1,264 @@
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from flask import current_app, g, has_request_context, request, template_rendered, \
+        before_render_template
+
+from beanserver.db import explain, pool_stats
+
+
+# Per-worker request, template and SQL timings, served in the Prometheus
+# text format at /metrics. Every worker process keeps its own numbers.
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.series = {}
+
+    def observe(self, values, x):
+        s = self.series.get(values)
+        if s is None:
+            s = self.series.setdefault(values, [[0] * len(self.buckets), 0.0, 0])
+        for i, b in enumerate(self.buckets):
+            if x <= b:
+                s[0][i] += 1
+        s[1] += x
+        s[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for values, (counts, total, n) in sorted(self.series.items()):
+            labels = _labels(self.labels, values)
+            for b, c in zip(self.buckets, counts):
+                yield f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{b}"}} {c}'
+            yield f'{self.name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {n}'
+            yield f"{self.name}_sum{{{labels}}} {total:.6f}"
+            yield f"{self.name}_count{{{labels}}} {n}"
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name, self.help, self.labels = name, help, labels
+        self.series = {}
+
+    def inc(self, values, x=1):
+        self.series[values] = self.series.get(values, 0) + x
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for values, x in sorted(self.series.items()):
+            yield f"{self.name}{{{_labels(self.labels, values)}}} {x}"
+
+
+def _labels(names, values):
+    return ','.join(f'{k}="{_escape(v)}"' for k, v in zip(names, values))
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def statement_label(sql):
+    '''
+    Whitespace-normalised and shortened SQL, used as the statement label.
+    Numeric literals become `?`, so that a value formatted into the SQL
+    cannot add a new series per request.
+    '''
+    sql = re.sub(r'\s+', ' ', sql).strip()
+    sql = re.sub(r'(?<![\w.])\d+(?:\.\d+)?\b', '?', sql)
+    return sql if len(sql) <= 160 else sql[:157] + '...'
+
+
+class Metrics:
+    def __init__(self, logger, slow_query=0.1, slow_log=50):
+        self.logger = logger
+        self.slow_query = slow_query
+        self.slow = deque(maxlen=slow_log)
+        self._lock = threading.Lock()
+        self.requests = Histogram(
+                'beanserver_request_seconds', 'Time to handle a request.',
+                ('endpoint', 'method', 'status'))
+        self.phases = Histogram(
+                'beanserver_request_phase_seconds',
+                'Time each request spent running SQL, rendering templates and serialising JSON.',
+                ('endpoint', 'phase'))
+        self.queries = Histogram(
+                'beanserver_query_seconds',
+                'Time from executing a statement until its rows are used up.',
+                ('statement',))
+        self.rows = Counter('beanserver_query_rows_total', 'Rows returned or changed by a statement.',
+                            ('statement',))
+        self.templates = Histogram('beanserver_template_seconds', 'Time to render a template.',
+                                   ('template',))
+        self.slow_queries = Counter('beanserver_slow_queries_total',
+                                    'Statements slower than METRICS_SLOW_QUERY seconds.',
+                                    ('endpoint',))
+
+    def observe_query(self, conn, sql, params, seconds, rows):
+        if sql.lstrip().upper().startswith('EXPLAIN'):
+            return
+        endpoint = request.endpoint if has_request_context() else 'background'
+        label = statement_label(sql)
+        with self._lock:
+            self.queries.observe((label,), seconds)
+            self.rows.inc((label,), rows)
+        if has_request_context():
+            g.metrics_sql = g.get('metrics_sql', 0.0) + seconds
+        if seconds >= self.slow_query:
+            self.slow_query_found(conn, endpoint, sql, params, seconds, rows)
+
+    def slow_query_found(self, conn, endpoint, sql, params, seconds, rows):
+        try:
+            plan = explain(conn, sql, params) if params is not None else []
+        except Exception as e:
+            plan = [f"(no plan: {e})"]
+        entry = {"ts": int(time.time()), "endpoint": endpoint, "seconds": round(seconds, 4),
+                 "rows": rows, "sql": statement_label(sql), "plan": plan}
+        with self._lock:
+            self.slow_queries.inc((endpoint,))
+            self.slow.append(entry)
+        self.logger.warning(
+                f"Slow query in {endpoint} ({seconds * 1000:.1f} ms, {rows} rows): "
+                f"{entry['sql']}" + ''.join(f"\n    {line}" for line in plan))
+
+    def add_phase(self, name, seconds):
+        '''Adds to the time the current request spent in phase `name`.'''
+        if has_request_context():
+            phases = g.setdefault('metrics_phases', {})
+            phases[name] = phases.get(name, 0.0) + seconds
+
+    def render(self, app):
+        with self._lock:
+            lines = []
+            for metric in (self.requests, self.phases, self.queries, self.rows,
+                           self.templates, self.slow_queries):
+                lines += metric.render()
+        lines += _stats_lines(app)
+        return '\n'.join(lines) + '\n'
+
+
+def _stats_lines(app):
+    '''Counters kept by the pools, response cache and ingest writer.'''
+    def counters(prefix, help, label, stats):
+        if not stats:
+            return []
+        out = []
+        keys = sorted({k for s in stats.values() for k, v in s.items()
+                       if isinstance(v, (int, float)) and not isinstance(v, bool)})
+        for key in keys:
+            out.append(f"# HELP {prefix}_{key} {help} ({key}).")
+            out.append(f"# TYPE {prefix}_{key} gauge")
+            for name, s in sorted(stats.items()):
+                if key in s:
+                    out.append(f'{prefix}_{key}{{{label}="{_escape(name)}"}} {s[key]}')
+        return out
+
+    lines = counters('beanserver_db_pool', 'Connection pool counter', 'pool', pool_stats(app))
+    for ext, prefix in (('beanserver.cache', 'beanserver_cache'),
+                        ('beanserver.directory', 'beanserver_directory'),
+                        ('beanserver.ingest', 'beanserver_ingest'),
+                        ('beanserver.feed', 'beanserver_feed')):
+        obj = app.extensions.get(ext)
+        if obj is None:
+            continue
+        stats = obj.info() if hasattr(obj, 'info') else obj.stats
+        lines += counters(prefix, 'Worker counter', 'worker', {str(os.getpid()): stats})
+    return lines
+
+
+# Request lifecycle hooks
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    rate = current_app.config.get('METRICS_PROFILE_RATE', 0)
+    if rate and random.random() < rate:
+        g.metrics_profile = cProfile.Profile()
+        g.metrics_profile.enable()
+
+def _record(status):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    metrics = current_app.extensions['beanserver.metrics']
+    endpoint = request.endpoint or 'unknown'
+    phases = g.pop('metrics_phases', {})
+    phases['sql'] = g.pop('metrics_sql', 0.0)
+    with metrics._lock:
+        metrics.requests.observe((endpoint, request.method, str(status)), elapsed)
+        for phase, seconds in phases.items():
+            metrics.phases.observe((endpoint, phase), seconds)
+
+    profile = g.pop('metrics_profile', None)
+    if profile is not None:
+        profile.disable()
+        if elapsed >= current_app.config.get('METRICS_PROFILE_SLOW', 0.5):
+            folder = current_app.config.get(
+                    'METRICS_PROFILE_DIR', os.path.join(current_app.instance_path, 'profiles'))
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, f"{endpoint}-{int(time.time())}-{elapsed * 1000:.0f}ms.prof")
+            profile.dump_stats(path)
+            current_app.logger.warning(f"Slow request to {request.path} profiled in {path}")
+
+def _after_request(rv):
+    _record(rv.status_code)
+    return rv
+
+def _teardown_request(exc):
+    # requests which raised never reach after_request
+    if exc is not None:
+        _record(500)
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('metrics_templates', []).append(time.perf_counter())
+
+def _template_rendered(sender, template, context, **extra):
+    stack = g.get('metrics_templates')
+    if not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    metrics = sender.extensions['beanserver.metrics']
+    with metrics._lock:
+        metrics.templates.observe((template.name or 'string',), elapsed)
+    if not stack:
+        # nested includes are part of their parent's time
+        metrics.add_phase('template', elapsed)
+
+
+def init_app(app):
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    metrics = Metrics(app.logger, slow_query=app.config.get('METRICS_SLOW_QUERY', 0.1),
+                      slow_log=app.config.get('METRICS_SLOW_LOG', 50))
+    app.extensions['beanserver.metrics'] = metrics
+    app.extensions['beanserver.query_observer'] = metrics.observe_query
+
+    app.before_request(_before_request)
+    # registered early, so it runs after the other after_request hooks
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_rendered, app)
+
+    json_provider = type(app.json)
+
+    class TimedJSONProvider(json_provider):
+        def dumps(self, obj, **kwargs):
+            t = time.perf_counter()
+            try:
+                return super().dumps(obj, **kwargs)
+            finally:
+                metrics.add_phase('json', time.perf_counter() - t)
+
+    app.json = TimedJSONProvider(app)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return metrics.render(app), 200, {'Content-Type': 'text/plain; version=0.0.4'}
@@ -0,0 +1,13 @@
+-- ------------------------
+-- Covering indexes for the hot read paths
+-- -------------------
+
+-- per-user lookups: user_stats, get_balance, timeseries?crsid=
+CREATE INDEX IF NOT EXISTS idx_transactions_crsid_ts
+	ON transactions (crsid, ts, ncoffee, debit, type);
+
+-- time-ordered scans: leaderboards, timeseries
+CREATE INDEX IF NOT EXISTS idx_transactions_ts
+	ON transactions (ts, crsid, ncoffee, type, debit);
+
+ANALYZE transactions;
@@ -0,0 +1,65 @@
+-- ------------------------
+-- Per-user, per-day rollup of transactions, for the leaderboards
+-- -------------------
+
+CREATE TABLE IF NOT EXISTS daily_totals (
+	day INTEGER NOT NULL, -- unix time of 00:00 UTC
+	crsid TEXT NOT NULL,
+	shots INTEGER NOT NULL DEFAULT 0,
+	spend INTEGER NOT NULL DEFAULT 0,
+	n INTEGER NOT NULL DEFAULT 0, -- number of transactions
+	PRIMARY KEY (day, crsid)
+	) WITHOUT ROWID;
+
+DROP TRIGGER IF EXISTS rollup_insert_transactions;
+DROP TRIGGER IF EXISTS rollup_update_transactions;
+DROP TRIGGER IF EXISTS rollup_delete_transactions;
+
+
+CREATE TRIGGER rollup_insert_transactions AFTER INSERT ON transactions
+BEGIN
+	INSERT INTO daily_totals (day, crsid, shots, spend, n)
+	VALUES (CAST(new.ts AS INTEGER) / 86400 * 86400, new.crsid, new.ncoffee, new.debit, 1)
+	ON CONFLICT (day, crsid) DO UPDATE SET
+		shots = shots + excluded.shots,
+		spend = spend + excluded.spend,
+		n = n + 1;
+END;
+
+
+CREATE TRIGGER rollup_update_transactions AFTER UPDATE ON transactions
+BEGIN
+	UPDATE daily_totals SET
+		shots = shots - old.ncoffee,
+		spend = spend - old.debit,
+		n = n - 1
+	WHERE day = CAST(old.ts AS INTEGER) / 86400 * 86400 AND crsid = old.crsid;
+	INSERT INTO daily_totals (day, crsid, shots, spend, n)
+	VALUES (CAST(new.ts AS INTEGER) / 86400 * 86400, new.crsid, new.ncoffee, new.debit, 1)
+	ON CONFLICT (day, crsid) DO UPDATE SET
+		shots = shots + excluded.shots,
+		spend = spend + excluded.spend,
+		n = n + 1;
+	DELETE FROM daily_totals
+	WHERE day = CAST(old.ts AS INTEGER) / 86400 * 86400 AND crsid = old.crsid AND n = 0;
+END;
+
+
+CREATE TRIGGER rollup_delete_transactions AFTER DELETE ON transactions
+BEGIN
+	UPDATE daily_totals SET
+		shots = shots - old.ncoffee,
+		spend = spend - old.debit,
+		n = n - 1
+	WHERE day = CAST(old.ts AS INTEGER) / 86400 * 86400 AND crsid = old.crsid;
+	DELETE FROM daily_totals
+	WHERE day = CAST(old.ts AS INTEGER) / 86400 * 86400 AND crsid = old.crsid AND n = 0;
+END;
+
+
+-- backfill from the existing history
+DELETE FROM daily_totals;
+INSERT INTO daily_totals (day, crsid, shots, spend, n)
+	SELECT CAST(ts AS INTEGER) / 86400 * 86400, crsid, sum(ncoffee), sum(debit), count(*)
+	FROM transactions
+	GROUP BY 1, 2;
@@ -0,0 +1,48 @@
+-- ------------------------
+-- Change counters, bumped on every write to transactions and users.
+-- Readers compare them to decide whether cached results are still valid.
+-- -------------------
+
+CREATE TABLE IF NOT EXISTS generation (
+	tbl TEXT PRIMARY KEY,
+	n INTEGER NOT NULL DEFAULT 0
+	);
+
+INSERT OR IGNORE INTO generation (tbl, n) VALUES ('transactions', 0), ('users', 0);
+
+DROP TRIGGER IF EXISTS generation_insert_transactions;
+DROP TRIGGER IF EXISTS generation_update_transactions;
+DROP TRIGGER IF EXISTS generation_delete_transactions;
+DROP TRIGGER IF EXISTS generation_insert_users;
+DROP TRIGGER IF EXISTS generation_update_users;
+DROP TRIGGER IF EXISTS generation_delete_users;
+
+CREATE TRIGGER generation_insert_transactions AFTER INSERT ON transactions
+BEGIN
+	UPDATE generation SET n = n + 1 WHERE tbl = 'transactions';
+END;
+
+CREATE TRIGGER generation_update_transactions AFTER UPDATE ON transactions
+BEGIN
+	UPDATE generation SET n = n + 1 WHERE tbl = 'transactions';
+END;
+
+CREATE TRIGGER generation_delete_transactions AFTER DELETE ON transactions
+BEGIN
+	UPDATE generation SET n = n + 1 WHERE tbl = 'transactions';
+END;
+
+CREATE TRIGGER generation_insert_users AFTER INSERT ON users
+BEGIN
+	UPDATE generation SET n = n + 1 WHERE tbl = 'users';
+END;
+
+CREATE TRIGGER generation_update_users AFTER UPDATE ON users
+BEGIN
+	UPDATE generation SET n = n + 1 WHERE tbl = 'users';
+END;
+
+CREATE TRIGGER generation_delete_users AFTER DELETE ON users
+BEGIN
+	UPDATE generation SET n = n + 1 WHERE tbl = 'users';
+END;
@@ -0,0 +1,53 @@
+-- ------------------------
+-- Record when each change counter last moved, for HTTP Last-Modified
+-- -------------------
+
+ALTER TABLE generation ADD COLUMN mtime INTEGER;
+
+UPDATE generation SET mtime = (SELECT max(CAST(ts AS INTEGER)) FROM transactions)
+	WHERE tbl = 'transactions';
+UPDATE generation SET mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE mtime IS NULL;
+
+DROP TRIGGER IF EXISTS generation_insert_transactions;
+DROP TRIGGER IF EXISTS generation_update_transactions;
+DROP TRIGGER IF EXISTS generation_delete_transactions;
+DROP TRIGGER IF EXISTS generation_insert_users;
+DROP TRIGGER IF EXISTS generation_update_users;
+DROP TRIGGER IF EXISTS generation_delete_users;
+
+CREATE TRIGGER generation_insert_transactions AFTER INSERT ON transactions
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'transactions';
+END;
+
+CREATE TRIGGER generation_update_transactions AFTER UPDATE ON transactions
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'transactions';
+END;
+
+CREATE TRIGGER generation_delete_transactions AFTER DELETE ON transactions
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'transactions';
+END;
+
+CREATE TRIGGER generation_insert_users AFTER INSERT ON users
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'users';
+END;
+
+CREATE TRIGGER generation_update_users AFTER UPDATE ON users
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'users';
+END;
+
+CREATE TRIGGER generation_delete_users AFTER DELETE ON users
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'users';
+END;
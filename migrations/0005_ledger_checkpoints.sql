@@ -0,0 +1,38 @@
+-- ------------------------
+-- Per-user ledger checkpoints: the sum of a user's debits up to a known
+-- transactions rowid, so balance checks only need to add up later rows
+-- -------------------
+
+CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+	crsid TEXT PRIMARY KEY,
+	upto INTEGER NOT NULL, -- last transactions rowid included
+	debit_sum INTEGER NOT NULL,
+	ts DATETIME NOT NULL
+	);
+
+-- rows of one user in rowid order, for the rows after a checkpoint
+CREATE INDEX IF NOT EXISTS idx_transactions_crsid
+	ON transactions (crsid);
+
+DROP TRIGGER IF EXISTS ledger_insert_transactions;
+DROP TRIGGER IF EXISTS ledger_update_transactions;
+DROP TRIGGER IF EXISTS ledger_delete_transactions;
+
+-- a checkpoint no longer holds once a row it covers changes
+
+CREATE TRIGGER ledger_insert_transactions AFTER INSERT ON transactions
+BEGIN
+	DELETE FROM ledger_checkpoints WHERE crsid = new.crsid AND upto >= new.rowid;
+END;
+
+CREATE TRIGGER ledger_update_transactions AFTER UPDATE ON transactions
+BEGIN
+	DELETE FROM ledger_checkpoints
+	WHERE (crsid = old.crsid AND upto >= old.rowid)
+		OR (crsid = new.crsid AND upto >= new.rowid);
+END;
+
+CREATE TRIGGER ledger_delete_transactions AFTER DELETE ON transactions
+BEGIN
+	DELETE FROM ledger_checkpoints WHERE crsid = old.crsid AND upto >= old.rowid;
+END;
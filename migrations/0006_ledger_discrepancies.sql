@@ -0,0 +1,17 @@
+-- ------------------------
+-- Users whose debt disagreed with their ledger, as found by the
+-- reconciliation job
+-- -------------------
+
+CREATE TABLE IF NOT EXISTS ledger_discrepancies (
+	id INTEGER PRIMARY KEY,
+	crsid TEXT NOT NULL,
+	detected_ts DATETIME NOT NULL,
+	last_seen_ts DATETIME NOT NULL,
+	debt INTEGER,
+	debit_sum INTEGER,
+	resolved_ts DATETIME -- NULL while the mismatch persists
+	);
+
+CREATE INDEX IF NOT EXISTS idx_ledger_discrepancies_open
+	ON ledger_discrepancies (crsid) WHERE resolved_ts IS NULL;
@@ -0,0 +1,11 @@
+-- ------------------------
+-- Idempotency keys of ingested taps, so the box can safely retry
+-- -------------------
+
+CREATE TABLE IF NOT EXISTS ingest_keys (
+	key TEXT PRIMARY KEY,
+	ts DATETIME NOT NULL,
+	result TEXT NOT NULL -- JSON, as first returned
+	);
+
+CREATE INDEX IF NOT EXISTS idx_ingest_keys_ts ON ingest_keys (ts);
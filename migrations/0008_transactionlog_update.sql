@@ -0,0 +1,17 @@
+-- ------------------------
+-- The update trigger wrote new.debit into type_new and new.type into
+-- debit_new. Rows logged before this migration keep the swapped values.
+-- -------------------
+
+DROP TRIGGER IF EXISTS update_transactions;
+
+CREATE TRIGGER update_transactions AFTER UPDATE ON transactions
+BEGIN
+	INSERT INTO transactionlog
+	(log_ts, operation,
+		ts, rfid, crsid, type, debit, ncoffee,
+		ts_new, rfid_new, crsid_new, type_new, debit_new, ncoffee_new)
+	VALUES
+	(DATETIME('NOW'), 'UPDATE', old.ts, old.rfid, old.crsid, old.type, old.debit, old.ncoffee,
+			new.ts, new.rfid, new.crsid, new.type, new.debit, new.ncoffee);
+END;
@@ -0,0 +1,65 @@
+-- ------------------------
+-- Give transactionlog an explicit id, so that its rowids survive VACUUM and
+-- are never reused once old rows are archived (see archive.py)
+-- -------------------
+
+CREATE TABLE transactionlog_new(
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	log_ts DATETIME,
+	operation TEXT,
+	ts DATETIME,
+	ts_new DATETIME,
+	rfid DATETIME,
+	rfid_new DATETIME,
+	crsid TEXT,
+	crsid_new TEXT,
+	type TEXT,
+	type_new TEXT,
+	debit INTEGER,
+	debit_new INTEGER,
+	ncoffee INTEGER,
+	ncoffee_new INTEGER);
+
+INSERT INTO transactionlog_new (id, log_ts, operation, ts, ts_new, rfid, rfid_new,
+		crsid, crsid_new, type, type_new, debit, debit_new, ncoffee, ncoffee_new)
+	SELECT rowid, log_ts, operation, ts, ts_new, rfid, rfid_new,
+		crsid, crsid_new, type, type_new, debit, debit_new, ncoffee, ncoffee_new
+	FROM transactionlog;
+
+-- the triggers are recreated once the new table has its final name
+DROP TRIGGER IF EXISTS update_transactions;
+DROP TRIGGER IF EXISTS insert_transactions;
+DROP TRIGGER IF EXISTS delete_transactions;
+
+DROP TABLE transactionlog;
+ALTER TABLE transactionlog_new RENAME TO transactionlog;
+
+CREATE TRIGGER update_transactions AFTER UPDATE ON transactions
+BEGIN
+	INSERT INTO transactionlog
+	(log_ts, operation,
+		ts, rfid, crsid, type, debit, ncoffee,
+		ts_new, rfid_new, crsid_new, type_new, debit_new, ncoffee_new)
+	VALUES
+	(DATETIME('NOW'), 'UPDATE', old.ts, old.rfid, old.crsid, old.type, old.debit, old.ncoffee,
+			new.ts, new.rfid, new.crsid, new.type, new.debit, new.ncoffee);
+END;
+
+CREATE TRIGGER insert_transactions AFTER INSERT ON transactions
+BEGIN
+	INSERT INTO transactionlog
+	(log_ts, operation,
+		ts_new, rfid_new, crsid_new, type_new, debit_new, ncoffee_new)
+	VALUES
+	(DATETIME('NOW'), 'INSERT',
+			new.ts, new.rfid, new.crsid, new.type, new.debit, new.ncoffee);
+END;
+
+CREATE TRIGGER delete_transactions AFTER DELETE ON transactions
+BEGIN
+	INSERT INTO transactionlog
+	(log_ts, operation,
+		ts, rfid, crsid, type, debit, ncoffee)
+	VALUES
+	(DATETIME('NOW'), 'DELETE', old.ts, old.rfid, old.crsid, old.type, old.debit, old.ncoffee);
+END;
@@ -0,0 +1,11 @@
+-- ------------------------
+-- Per-user index on the daily rollup
+-- -------------------
+
+-- daily_totals is keyed by day first, so a leaderboard reaching far back had
+-- to read and sort the whole rollup to group it by crsid. This lets it walk
+-- each user's days in crsid order instead
+CREATE INDEX IF NOT EXISTS idx_daily_totals_crsid_day
+	ON daily_totals (crsid, day, shots);
+
+ANALYZE daily_totals;
@@ -0,0 +1,30 @@
+-- ------------------------
+-- A change counter for the user directory alone. Every tap updates
+-- users.debt, which moves the users counter, so the directory reloaded on
+-- every request; this one only moves when a crsid or card changes.
+-- -------------------
+
+INSERT OR IGNORE INTO generation (tbl, n, mtime)
+	VALUES ('directory', 0, CAST(strftime('%s', 'now') AS INTEGER));
+
+DROP TRIGGER IF EXISTS generation_insert_directory;
+DROP TRIGGER IF EXISTS generation_update_directory;
+DROP TRIGGER IF EXISTS generation_delete_directory;
+
+CREATE TRIGGER generation_insert_directory AFTER INSERT ON users
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'directory';
+END;
+
+CREATE TRIGGER generation_update_directory AFTER UPDATE OF crsid, rfid ON users
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'directory';
+END;
+
+CREATE TRIGGER generation_delete_directory AFTER DELETE ON users
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'directory';
+END;
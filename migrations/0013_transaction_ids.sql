@@ -0,0 +1,167 @@
+-- ------------------------
+-- Give transactions back the six columns the box inserts into positionally;
+-- the id column added by 0011 made `INSERT INTO transactions VALUES` fail.
+-- The never-reused ids that keyset cursors (/api/timeseries) need move to
+-- transaction_ids, which triggers keep in step with the rowids: a rowid
+-- freed by deleting the newest row and then reused gets a new id.
+-- -------------------
+
+CREATE TABLE transaction_ids (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	tx INTEGER NOT NULL UNIQUE -- rowid in transactions
+	);
+
+-- rowid is the id of 0011 where that ran, so the ids handed out so far hold
+INSERT INTO transaction_ids (id, tx) SELECT rowid, rowid FROM transactions;
+-- and so do ids of rows deleted since, whose number is kept in the sequence
+DELETE FROM sqlite_sequence WHERE name = 'transaction_ids';
+INSERT INTO sqlite_sequence (name, seq) SELECT 'transaction_ids', max(
+		coalesce((SELECT max(id) FROM transaction_ids), 0),
+		coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'transactions'), 0));
+
+CREATE TABLE transactions_new (
+	ts DATETIME NOT NULL,
+	crsid TEXT NOT NULL, -- trusted
+	rfid INTEGER, -- for convenience
+	type TEXT NOT NULL,
+	debit INTEGER NOT NULL,
+	ncoffee INTEGER NOT NULL
+	);
+
+INSERT INTO transactions_new (rowid, ts, crsid, rfid, type, debit, ncoffee)
+	SELECT rowid, ts, crsid, rfid, type, debit, ncoffee FROM transactions;
+
+-- takes its indexes and triggers with it, they are recreated below
+DROP TABLE transactions;
+ALTER TABLE transactions_new RENAME TO transactions;
+
+-- indexes
+CREATE INDEX IF NOT EXISTS idx_transactions_crsid_ts
+	ON transactions (crsid, ts, ncoffee, debit, type);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_ts
+	ON transactions (ts, crsid, ncoffee, type, debit);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_crsid
+	ON transactions (crsid);
+
+-- audit log
+CREATE TRIGGER insert_transactions AFTER INSERT ON transactions
+BEGIN
+	INSERT INTO transactionlog
+	(log_ts, operation,
+		ts_new, rfid_new, crsid_new, type_new, debit_new, ncoffee_new)
+	VALUES
+	(DATETIME('NOW'), 'INSERT',
+			new.ts, new.rfid, new.crsid, new.type, new.debit, new.ncoffee);
+END;
+
+CREATE TRIGGER update_transactions AFTER UPDATE ON transactions
+BEGIN
+	INSERT INTO transactionlog
+	(log_ts, operation,
+		ts, rfid, crsid, type, debit, ncoffee,
+		ts_new, rfid_new, crsid_new, type_new, debit_new, ncoffee_new)
+	VALUES
+	(DATETIME('NOW'), 'UPDATE', old.ts, old.rfid, old.crsid, old.type, old.debit, old.ncoffee,
+			new.ts, new.rfid, new.crsid, new.type, new.debit, new.ncoffee);
+END;
+
+CREATE TRIGGER delete_transactions AFTER DELETE ON transactions
+BEGIN
+	INSERT INTO transactionlog
+	(log_ts, operation,
+		ts, rfid, crsid, type, debit, ncoffee)
+	VALUES
+	(DATETIME('NOW'), 'DELETE', old.ts, old.rfid, old.crsid, old.type, old.debit, old.ncoffee);
+END;
+
+-- daily_totals rollup (0002)
+CREATE TRIGGER rollup_insert_transactions AFTER INSERT ON transactions
+BEGIN
+	INSERT INTO daily_totals (day, crsid, shots, spend, n)
+	VALUES (CAST(new.ts AS INTEGER) / 86400 * 86400, new.crsid, new.ncoffee, new.debit, 1)
+	ON CONFLICT (day, crsid) DO UPDATE SET
+		shots = shots + excluded.shots,
+		spend = spend + excluded.spend,
+		n = n + 1;
+END;
+
+CREATE TRIGGER rollup_update_transactions AFTER UPDATE ON transactions
+BEGIN
+	UPDATE daily_totals SET
+		shots = shots - old.ncoffee,
+		spend = spend - old.debit,
+		n = n - 1
+	WHERE day = CAST(old.ts AS INTEGER) / 86400 * 86400 AND crsid = old.crsid;
+	INSERT INTO daily_totals (day, crsid, shots, spend, n)
+	VALUES (CAST(new.ts AS INTEGER) / 86400 * 86400, new.crsid, new.ncoffee, new.debit, 1)
+	ON CONFLICT (day, crsid) DO UPDATE SET
+		shots = shots + excluded.shots,
+		spend = spend + excluded.spend,
+		n = n + 1;
+	DELETE FROM daily_totals
+	WHERE day = CAST(old.ts AS INTEGER) / 86400 * 86400 AND crsid = old.crsid AND n = 0;
+END;
+
+CREATE TRIGGER rollup_delete_transactions AFTER DELETE ON transactions
+BEGIN
+	UPDATE daily_totals SET
+		shots = shots - old.ncoffee,
+		spend = spend - old.debit,
+		n = n - 1
+	WHERE day = CAST(old.ts AS INTEGER) / 86400 * 86400 AND crsid = old.crsid;
+	DELETE FROM daily_totals
+	WHERE day = CAST(old.ts AS INTEGER) / 86400 * 86400 AND crsid = old.crsid AND n = 0;
+END;
+
+-- change counters (0004)
+CREATE TRIGGER generation_insert_transactions AFTER INSERT ON transactions
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'transactions';
+END;
+
+CREATE TRIGGER generation_update_transactions AFTER UPDATE ON transactions
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'transactions';
+END;
+
+CREATE TRIGGER generation_delete_transactions AFTER DELETE ON transactions
+BEGIN
+	UPDATE generation SET n = n + 1, mtime = CAST(strftime('%s', 'now') AS INTEGER)
+	WHERE tbl = 'transactions';
+END;
+
+-- ledger checkpoints (0005)
+CREATE TRIGGER ledger_insert_transactions AFTER INSERT ON transactions
+BEGIN
+	DELETE FROM ledger_checkpoints WHERE crsid = new.crsid AND upto >= new.rowid;
+END;
+
+CREATE TRIGGER ledger_update_transactions AFTER UPDATE ON transactions
+BEGIN
+	DELETE FROM ledger_checkpoints
+	WHERE (crsid = old.crsid AND upto >= old.rowid)
+		OR (crsid = new.crsid AND upto >= new.rowid);
+END;
+
+CREATE TRIGGER ledger_delete_transactions AFTER DELETE ON transactions
+BEGIN
+	DELETE FROM ledger_checkpoints WHERE crsid = old.crsid AND upto >= old.rowid;
+END;
+
+-- ids (above)
+CREATE TRIGGER ids_insert_transactions AFTER INSERT ON transactions
+BEGIN
+	INSERT INTO transaction_ids (tx) VALUES (new.rowid);
+END;
+
+CREATE TRIGGER ids_delete_transactions AFTER DELETE ON transactions
+BEGIN
+	DELETE FROM transaction_ids WHERE tx = old.rowid;
+END;
+
+ANALYZE transactions;
+ANALYZE transaction_ids;
@@ -0,0 +1,98 @@
+import click
+from flask import current_app
+
+from beanserver import ledger, scheduler
+from beanserver.db import batch_writer
+
+
+def reconcile(batch_size=100, min_rows=1):
+    '''
+    Verifies the ledger of every user, `batch_size` users per write
+    transaction. Mismatches are recorded in ledger_discrepancies (and marked
+    resolved once they go away), consistent users are checkpointed. The
+    writer is checked out for one batch at a time.
+    '''
+    stats = {"checked": 0, "inconsistent": 0, "resolved": 0, "checkpointed": 0}
+    last = ''
+    while True:
+        with batch_writer() as db:
+            crsids = _reconcile_batch(db, last, batch_size, min_rows, stats)
+        if len(crsids) == 0:
+            break
+        last = crsids[-1]
+    return stats
+
+def _reconcile_batch(db, last, batch_size, min_rows, stats):
+    '''Reconciles the users after `last`. Returns their crsids.'''
+    crsids = [r[0] for r in db.execute(
+        "SELECT crsid FROM users WHERE crsid > ? ORDER BY crsid LIMIT ?",
+        (last, batch_size))]
+    if len(crsids) == 0:
+        return crsids
+    db.execute("BEGIN IMMEDIATE TRANSACTION;")
+    try:
+        for crsid in crsids:
+            stats["checked"] += 1
+            debt, debit_sum = ledger.verify(db, crsid)
+            found = db.execute(
+                    "SELECT id FROM ledger_discrepancies \
+                            WHERE crsid = ? AND resolved_ts IS NULL",
+                    (crsid,)).fetchone()
+
+            if debt != debit_sum:
+                stats["inconsistent"] += 1
+                if found is None:
+                    current_app.logger.error(
+                            f"Broken account: {crsid} checksums do not match, debt={debt}, sum(debit)={debit_sum}")
+                    db.execute(
+                        "INSERT INTO ledger_discrepancies \
+                                (crsid, detected_ts, last_seen_ts, debt, debit_sum) \
+                                VALUES (?, strftime('%s', 'now'), strftime('%s', 'now'), ?, ?)",
+                        (crsid, debt, debit_sum))
+                else:
+                    db.execute(
+                        "UPDATE ledger_discrepancies \
+                                SET last_seen_ts = strftime('%s', 'now'), debt = ?, debit_sum = ? \
+                                WHERE id = ?",
+                        (debt, debit_sum, found[0]))
+                continue
+
+            if found is not None:
+                stats["resolved"] += 1
+                db.execute(
+                    "UPDATE ledger_discrepancies SET resolved_ts = strftime('%s', 'now') \
+                            WHERE id = ?",
+                    (found[0],))
+            stats["checkpointed"] += ledger.checkpoint(db, crsid, min_rows)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return crsids
+
+
+def run():
+    cfg = current_app.config
+    stats = reconcile(batch_size=cfg.get('RECONCILE_BATCH', 100),
+                      min_rows=cfg.get('LEDGER_CHECKPOINT_ROWS', 50))
+    current_app.logger.info(f"Reconciled ledgers: {stats}")
+    return stats
+
+
+@click.command('reconcile')
+@click.option('--min-rows', default=1, show_default=True,
+              help='Only checkpoint users with at least this many new transactions.')
+def reconcile_command(min_rows):
+    '''Verify every ledger, record discrepancies and checkpoint the rest.'''
+    stats = reconcile(batch_size=current_app.config.get('RECONCILE_BATCH', 100),
+                      min_rows=min_rows)
+    click.echo(', '.join(f'{k}: {v}' for k, v in stats.items()))
+
+
+def init_app(app):
+    app.cli.add_command(reconcile_command)
+    interval = app.config.get('RECONCILE_INTERVAL')
+    if interval:
+        # one worker reconciles, the others would only repeat its writes
+        scheduler.every(app, interval, run, 'reconcile',
+                        lock=app.config['PRIMARYDB'] + '.reconcile.lock')
@@ -0,0 +1,91 @@
+import click
+import os
+import sqlite3
+import threading
+from flask import current_app
+
+from beanserver import scheduler
+from beanserver.db import healthy, is_fatal, mark_unhealthy
+
+
+# Keeps SECONDARYDB a recent copy of PRIMARYDB, for open_db to fail over to.
+# Copies go through the online backup API, and are skipped while the primary
+# is unchanged or fails its integrity check, so a corrupted primary is never
+# shipped over a good secondary.
+
+_lock = threading.Lock()
+
+
+def signature(path):
+    '''Size and modification time of a database and its WAL.'''
+    sig = []
+    for f in (path, path + '-wal'):
+        try:
+            st = os.stat(f)
+            sig.append((st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            sig.append(None)
+    return tuple(sig)
+
+
+def replicate(src, dest, pages=1024, sleep=0.01):
+    '''Checks `src` and copies it over `dest`. Raises if the check fails.'''
+    source = sqlite3.connect(f"file:{src}?mode=ro", uri=True)
+    try:
+        ok, = source.execute("PRAGMA quick_check").fetchone()
+        if ok != 'ok':
+            e = sqlite3.DatabaseError(f"{src} failed quick_check: {ok}")
+            e.sqlite_errorname = 'SQLITE_CORRUPT'
+            raise e
+        target = sqlite3.connect(dest, timeout=30)
+        try:
+            source.backup(target, pages=pages, sleep=sleep)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+def run(force=False):
+    '''
+    Replicates the primary to the secondary if it changed since the last run.
+    Returns whether a copy was made.
+    '''
+    app = current_app._get_current_object()
+    cfg = app.config
+    state = app.extensions.setdefault('beanserver.replication', {"copies": 0, "skipped": 0})
+    src, dest = cfg['PRIMARYDB'], cfg['SECONDARYDB']
+    with _lock:
+        sig = signature(src)
+        # an unhealthy primary is rechecked even if unchanged
+        if not force and sig == state.get("signature") and healthy(app, src):
+            state["skipped"] += 1
+            return False
+        try:
+            replicate(src, dest,
+                      pages=cfg.get('REPLICATION_PAGES', 1024),
+                      sleep=cfg.get('REPLICATION_SLEEP', 0.01))
+        except sqlite3.DatabaseError as e:
+            state["error"] = str(e)
+            if is_fatal(e):
+                mark_unhealthy(app, src, e)
+            raise
+        state.update(signature=sig, error=None, copies=state["copies"] + 1)
+    app.logger.info(f"Replicated {src} to {dest}")
+    return True
+
+
+@click.command('replicate-db')
+def replicate_db_command():
+    '''Copy the primary database over the secondary.'''
+    run(force=True)
+    click.echo(f"Replicated {current_app.config['PRIMARYDB']} to {current_app.config['SECONDARYDB']}")
+
+
+def init_app(app):
+    app.cli.add_command(replicate_db_command)
+    interval = app.config.get('REPLICATION_INTERVAL')
+    if interval:
+        # one worker copies, so copies never race each other into the file
+        scheduler.every(app, interval, run, 'replication',
+                        lock=app.config['SECONDARYDB'] + '.replication.lock')
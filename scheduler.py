@@ -0,0 +1,54 @@
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def every(app, interval, fn, name, lock=None):
+    '''
+    Calls fn() inside an app context every `interval` seconds on a daemon
+    thread of this worker. Errors are logged and do not stop the schedule.
+    Returns an Event which stops the thread when set.
+
+    With `lock` (a file path), only one process runs the job: ticks are
+    skipped until this process takes an exclusive lock on the file, which it
+    then holds until it exits, when another worker's next tick takes over.
+    '''
+    stop = threading.Event()
+
+    def run():
+        held = None
+        while not stop.wait(interval):
+            if lock is not None and held is None:
+                held = try_lock(lock)
+                if held is None:
+                    continue
+                app.logger.info(f"Scheduled job {name} runs in process {os.getpid()}")
+            with app.app_context():
+                try:
+                    fn()
+                except Exception:
+                    app.logger.exception(f"Scheduled job {name} failed")
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return stop
+
+
+def try_lock(path):
+    '''
+    Takes an exclusive lock on `path` without waiting. Returns the open file
+    holding it, or None if another process has it. Without fcntl (on Windows)
+    the lock always succeeds.
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    f = open(path, 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+    return f
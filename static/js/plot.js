@@ -1,21 +1,23 @@
 async function get_csv_data(url) {
   const res = await fetch(url);
+  const decoder = new TextDecoder();
 
   const rows = [];
   let curr_row = '';
   for await (const chunk_bytes of res.body) {
-    chunk = String.fromCharCode(...chunk_bytes);
-    for (c of chunk){
-      if (c === '\n' && curr_row.length > 0) {
-        rows.push(curr_row.split('\t'));
-        curr_row = '';
-      } else {
-        curr_row += c;
+    const lines = (curr_row + decoder.decode(chunk_bytes, {stream: true})).split('\n');
+    curr_row = lines.pop();
+    lines.forEach( l => {
+      if (l.length > 0) {
+        rows.push(l.split('\t'));
       }
-    }
+    });
+  }
+  if (curr_row.length > 0) {
+    rows.push(curr_row.split('\t'));
   }
   return rows;
-} 
+}
 
 // Getting DOM elements
 //
@@ -25,6 +27,16 @@ const timehist = document.getElementById('time-plot');
 const leaderDiv = document.getElementById("leaderboard");
 const leaderDivWeekly = document.getElementById("weekly_leaderboard");
 
+// the data on display, kept up to date from the /api/stream change feed
+const live = {
+  leaderboard: null,
+  weekly: null,
+  traces: null,
+  timedata: null,
+  beantypes: null,
+  layouts: null,
+};
+
 
 const gli_anni = ["2023", "2024", "2025", "2026", "2027", "2028"];
 
@@ -110,6 +122,7 @@ async function make_plots(data) {
       type: 'linear'
     },
     showlegend: true,
+    uirevision: 'live',
     legend: {
       x: 0,
       y: 1,
@@ -129,9 +142,11 @@ async function make_plots(data) {
     //},
     yaxis: {
       autorange: 'reversed',
+      type: 'date',
       tickformat: '%H'
     },
   autosize:false,
+    uirevision: 'live',
     margin:{
       b:0,
       t:0,
@@ -144,8 +159,9 @@ async function make_plots(data) {
 
   };
 
+  const day_ms = 1000*3600*24;
   const traces = ['Cappuccino', 'Americano', 'Espresso', 'Tea'].map( s => {
-    return {'x': [],'users': [],'name': s, 'type': 'histogram', 'xbins': {'size': 1000*3600*24}};
+    return {'x': [], 'y': [], 'name': s, 'type': 'bar', 'width': day_ms, 'offset': 0};
   });
 
 
@@ -161,35 +177,43 @@ async function make_plots(data) {
     "tea": traces[3]
   };
 
-  const timedata = {'y': [],
-    'type': 'histogram',
-   // 'xbins': {'size': 1000*3600}
+  const timedata = {'x': [], 'y': [],
+    'type': 'bar',
+    'orientation': 'h',
+    'width': data["timeofday"]["bucket"]*1000,
+    'offset': 0
   }
 
-  const typeID = await data["headers"].indexOf("type");
-  const timeID = await data["headers"].indexOf("timestamp");
-  const userID = await data["headers"].indexOf("crsid");
+  // the server bins by drink type, so add up the types sharing a trace
+  function add_counts(table, headers, bin_of) {
+    const binID = 0;  // "bin" or "bucket"
+    const typeID = headers.indexOf("type");
+    const countID = headers.indexOf("count");
+    table.forEach( row => {
+      const trace = bin_of(row[typeID]);
+      if (trace === undefined) {
+        return;
+      }
+      const n = trace.counts.get(row[binID]) || 0;
+      trace.counts.set(row[binID], n + row[countID]);
+    });
+  }
 
-  (await data["table"]).forEach( row => {
-    if (row[typeID] in beantypes){
-      beantypes[row[typeID]].x.push(row[timeID]);
-      beantypes[row[typeID]].users.push(row[userID]);
-      timedata.y.push("1970-01-01 "+row[timeID].split(' ')[1]);
-    }
-  });
+  traces.forEach( t => { t.counts = new Map(); });
+  timedata.counts = new Map();
+  add_counts(data["table"], data["headers"], ty => beantypes[ty]);
+  add_counts(data["timeofday"]["table"], data["timeofday"]["headers"],
+    ty => (ty in beantypes) ? timedata : undefined);
+
+  live.traces = traces;
+  live.timedata = timedata;
+  live.beantypes = beantypes;
+  live.layouts = [flavour_hist_layout, time_hist_layout];
+  fill_traces();
 
   Plotly.newPlot(mainplot, traces, flavour_hist_layout);
   Plotly.newPlot(timehist, [timedata], time_hist_layout);
 
-  // register event handlers
-  // 
-  window.addEventListener('resize', resize_all);
-  
-  const menu = document.getElementById('menu');
-  if (menu !== null){
-    menu.addEventListener('transitionend', resize_all);
-  }
-  
 //    function adjust_histogram(start, end) {
 //      traces.forEach( d => {d.xbins = {'start': start, 'end': end, 'size': 1000*3600*24};});
 //    }
@@ -209,6 +233,21 @@ async function make_plots(data) {
 }
 
 
+function fill_traces() {
+  live.traces.forEach( t => {
+    t.x = []; t.y = [];
+    [...t.counts.keys()].sort((a, b) => a - b).forEach( bin => {
+      t.x.push(bin*1000); t.y.push(t.counts.get(bin));
+    });
+  });
+  const td = live.timedata;
+  td.x = []; td.y = [];
+  [...td.counts.keys()].sort((a, b) => a - b).forEach( bucket => {
+    td.y.push(bucket*1000); td.x.push(td.counts.get(bucket));
+  });
+}
+
+
   function resize_all() {
     Plotly.relayout(mainplot, {width: mainplot.offsetWidth});
     Plotly.relayout(timehist, {width: timehist.offsetWidth});
@@ -233,22 +272,146 @@ async function make_leaderboard(res){
 
 
 
-async function init() {
+async function render_leaderboards() {
+  leaderDivWeekly.innerHTML = await make_leaderboard( live.weekly );
+  document.getElementById('weekly').setAttribute("title",
+    "Shots since " + live.weekly['datesince'])
+  leaderDiv.innerHTML = await make_leaderboard( live.leaderboard );
+}
 
-  const res_leader = await fetch("/api/leaderboard");
-  const res_week = await fetch("/api/leaderboard/sinceday/6");
-  const res_ts = await fetch("/api/timeseries");
 
-  let data_week = await res_week.json();
-  leaderDivWeekly.innerHTML = await make_leaderboard( data_week );
-  document.getElementById('weekly').setAttribute("title",
-    "Shots since " + data_week['datesince'])
-  leaderDiv.innerHTML = await make_leaderboard( await res_leader.json());
+async function load_all() {
 
+  // both leaderboards come from one query
+  const res_boards = await fetch("/api/leaderboard/windows?windows=all,sinceday:6");
+  const res_hist = await fetch("/api/histogram?bin=day&tod=3600");
 
-  await make_plots(await res_ts.json());
+  const boards = (await res_boards.json())["windows"] || {};
+  live.weekly = boards["sinceday:6"] || {"success": false};
+  live.leaderboard = boards["all"] || {"success": false};
+  await render_leaderboards();
+
+  await make_plots(await res_hist.json());
+}
+
+
+// Live updates
+//
+
+function add_shots(res, crsid, n) {
+  if (!res["success"] || res["data"] === undefined || n === 0) {
+    return;
+  }
+  let row = res["data"].find( r => r["crsid"] === crsid );
+  if (row === undefined) {
+    row = {"crsid": crsid, "shots": 0};
+    res["data"].push(row);
+  }
+  row["shots"] += n;
+  res["data"].sort( (a, b) => b["shots"] - a["shots"] );
+}
 
+function count_tx(t, sign) {
+  const trace = live.beantypes[t["type"]];
+  if (trace === undefined) {
+    return;
+  }
+  const ts = Number(t["ts"]);
+  const day = ts - ts % 86400;
+  trace.counts.set(day, (trace.counts.get(day) || 0) + sign);
+  const bucket = live.timedata["width"]/1000;
+  const tod = Math.floor(ts % 86400 / bucket) * bucket;
+  live.timedata.counts.set(tod, (live.timedata.counts.get(tod) || 0) + sign);
+}
+
+function apply_tx(tx) {
+  Object.entries(tx["shots"]).forEach( ([crsid, n]) => add_shots(live.leaderboard, crsid, n) );
+
+  const since = Date.parse(live.weekly["datesince"])/1000;
+  if (tx["old"] !== undefined && Number(tx["old"]["ts"]) >= since) {
+    add_shots(live.weekly, tx["old"]["crsid"], -tx["old"]["ncoffee"]);
+  }
+  if (tx["new"] !== undefined && Number(tx["new"]["ts"]) >= since) {
+    add_shots(live.weekly, tx["new"]["crsid"], tx["new"]["ncoffee"]);
+  }
+
+  if (tx["old"] !== undefined) {
+    count_tx(tx["old"], -1);
+  }
+  if (tx["new"] !== undefined) {
+    count_tx(tx["new"], 1);
+  }
+}
+
+let redraw_pending = false;
+function schedule_redraw() {
+  if (redraw_pending) {
+    return;
+  }
+  redraw_pending = true;
+  setTimeout( async () => {
+    redraw_pending = false;
+    await render_leaderboards();
+    fill_traces();
+    Plotly.react(mainplot, live.traces, live.layouts[0]);
+    Plotly.react(timehist, [live.timedata], live.layouts[1]);
+  }, 250);
+}
+
+// Live updates hold a connection open, which only the ASGI server can afford
+// for every open tab; elsewhere the page polls the leaderboards' ETag and
+// reloads when it changes.
+const feed = document.currentScript.dataset;
+
+function poll_changes(seconds) {
+  let etag = null;
+  setInterval( async () => {
+    if (document.hidden) {
+      return;
+    }
+    // revalidated with If-None-Match, so an unchanged board costs a 304
+    const res = await fetch("/api/leaderboard/windows?windows=all,sinceday:6",
+                            {cache: "no-cache"});
+    const tag = res.headers.get("ETag");
+    if (etag !== null && tag !== etag) {
+      await load_all();
+    }
+    etag = tag;
+  }, seconds * 1000);
+}
+
+function follow_changes() {
+  if (feed.live !== "true" || typeof EventSource === 'undefined') {
+    poll_changes(Number(feed.poll) || 60);
+    return;
+  }
+  const source = new EventSource("/api/stream");
+  source.addEventListener('tx', e => {
+    if (live.traces === null) {
+      return;
+    }
+    apply_tx(JSON.parse(e.data));
+    schedule_redraw();
+  });
+  // the server could not send everything we missed
+  source.addEventListener('reset', () => load_all());
+}
+
+
+async function init() {
+
+  await load_all();
+
+  // register event handlers
+  // 
+  window.addEventListener('resize', resize_all);
   
+  const menu = document.getElementById('menu');
+  if (menu !== null){
+    menu.addEventListener('transitionend', resize_all);
+  }
+
+  follow_changes();
 }
 
 
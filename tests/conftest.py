@@ -0,0 +1,60 @@
+import importlib.util
+import os
+import sqlite3
+import sys
+import time
+
+import pytest
+
+# The repository is the beanserver package itself, so make it importable
+# under that name wherever it is checked out.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if 'beanserver' not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+            'beanserver', os.path.join(ROOT, '__init__.py'),
+            submodule_search_locations=[ROOT])
+    sys.modules['beanserver'] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules['beanserver'])
+
+from beanserver import create_app
+from beanserver.db import init_db
+
+USERS = [('aaa001', 1001), ('bbb002', 1002), ('ccc003', None)]
+
+
+def make_app(folder, **config):
+    cfg = {
+            'TESTING': True,
+            'PRIMARYDB': os.path.join(folder, 'primary.db'),
+            'SECONDARYDB': os.path.join(folder, 'secondary.db'),
+            'BOT_PASSWORD': 'bot',
+            'PAY_PASSWORD': 'pay',
+            'TAP_PASSWORD': 'tap',
+            'METRICS_ENABLED': False,
+            }
+    cfg.update(config)
+    app = create_app(cfg)
+    with app.app_context():
+        init_db()
+    conn = sqlite3.connect(cfg['PRIMARYDB'])
+    conn.executemany("INSERT INTO users (crsid, rfid, debt) VALUES (?, ?, 0)", USERS)
+    now = int(time.time())
+    # one tap a day for the last 20 days, alternating between two users
+    for i in range(20):
+        crsid = USERS[i % 2][0]
+        conn.execute("INSERT INTO transactions (ts, crsid, rfid, type, debit, ncoffee) \
+                VALUES (?, ?, ?, 'espresso2', 50, 2)", (now - i * 86400 - 60, crsid, 1))
+        conn.execute("UPDATE users SET debt = debt + 50 WHERE crsid = ?", (crsid,))
+    conn.commit()
+    conn.close()
+    return app
+
+
+@pytest.fixture
+def app(tmp_path):
+    return make_app(str(tmp_path))
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
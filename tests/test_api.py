@@ -0,0 +1,24 @@
+import sqlite3
+
+
+def test_cursor_survives_deleting_newest(app, client):
+    page = client.get('/api/timeseries?since_cursor=0').json
+    cursor = page['next_cursor']
+    conn = sqlite3.connect(app.config['PRIMARYDB'])
+    conn.execute("DELETE FROM transactions WHERE rowid = ?", (int(cursor),))
+    conn.execute("INSERT INTO transactions (ts, crsid, rfid, type, debit, ncoffee) \
+            VALUES (strftime('%s', 'now'), 'aaa001', 1, 'tea', 10, 0)")
+    conn.commit()
+    conn.close()
+    page = client.get(f'/api/timeseries?since_cursor={cursor}').json
+    assert page['table'] and page['table'][0][1] == 'tea'
+
+
+def test_box_can_insert_positionally(app, client):
+    conn = sqlite3.connect(app.config['PRIMARYDB'])
+    conn.execute("INSERT INTO transactions VALUES (strftime('%s', 'now'), 'bbb002', 1002, 'tea', 10, 0)")
+    conn.commit()
+    conn.close()
+    page = client.get('/api/timeseries?since_cursor=20').json
+    assert page['next_cursor'] == '21'
+    assert page['table'][0][1:] == ['tea', 'bbb002']
@@ -0,0 +1,45 @@
+import os
+import sqlite3
+import threading
+
+from beanserver import archive
+from beanserver.db import get_pool
+
+from conftest import make_app
+
+
+def age_log(app):
+    conn = sqlite3.connect(app.config['PRIMARYDB'])
+    conn.execute("UPDATE transactionlog SET log_ts = '2020-01-01 00:00:00'")
+    n, = conn.execute("SELECT count(*) FROM transactionlog").fetchone()
+    conn.commit()
+    conn.close()
+    return n
+
+
+def test_writer_is_released_between_batches(tmp_path, monkeypatch):
+    app = make_app(str(tmp_path), DB_POOL_TIMEOUT=0.1, ARCHIVE_BATCH=5)
+    n = age_log(app)
+    pool = get_pool(app, app.config['PRIMARYDB'], write=True)
+    free = []
+    writer = archive.batch_writer
+    def spy():
+        # another thread can check the writer out before each batch
+        t = threading.Thread(target=lambda: free.append(pool.release(pool.acquire())))
+        t.start()
+        t.join()
+        return writer()
+    monkeypatch.setattr(archive, 'batch_writer', spy)
+    with app.app_context():
+        moved = archive.run()
+    assert moved == {2020: n}
+    assert len(free) > n // 5
+
+
+def test_scheduled_in_one_worker(app, monkeypatch):
+    calls = []
+    monkeypatch.setattr(archive.scheduler, 'every',
+                        lambda app, interval, fn, name, lock=None: calls.append(lock))
+    app.config['ARCHIVE_INTERVAL'] = 60
+    archive.init_app(app)
+    assert calls == [os.path.join(archive.archive_dir(app), '.schedule.lock')]
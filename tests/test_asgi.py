@@ -0,0 +1,59 @@
+import asyncio
+
+from beanserver.asgi import BeanserverASGI, create_asgi_app
+
+from conftest import make_app
+
+
+def call(asgi, scope, messages):
+    sent = []
+    async def receive():
+        return messages.pop(0)
+    async def send(message):
+        sent.append(message)
+    asyncio.run(asgi(scope, receive, send))
+    return sent
+
+
+def get(asgi, path, query=b''):
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query,
+             'headers': [], 'http_version': '1.1', 'scheme': 'http'}
+    return call(asgi, scope, [{'type': 'http.request', 'body': b''}])
+
+
+def test_streams_many_chunks(tmp_path):
+    asgi = BeanserverASGI(make_app(str(tmp_path), STREAM_CHUNK_ROWS=3), threads=4)
+    # repeated, so the chunks land on threads that served other requests
+    for _ in range(5):
+        sent = get(asgi, '/api/timeseries', b'stream=tsv')
+        assert sent[0]['status'] == 200
+        chunks = [m['body'] for m in sent[1:] if m['body']]
+        assert len(chunks) > 2
+        lines = b''.join(chunks).decode().splitlines()
+        assert len(lines) == 21
+        assert sent[-1] == {'type': 'http.response.body', 'body': b''}
+
+
+def test_websocket_is_refused(app):
+    sent = call(BeanserverASGI(app), {'type': 'websocket', 'path': '/'},
+                [{'type': 'websocket.connect'}])
+    assert sent == [{'type': 'websocket.close', 'code': 1000}]
+
+
+def test_stats_page_streams_only_under_asgi(tmp_path):
+    app = make_app(str(tmp_path))
+    assert b'data-live="false"' in app.test_client().get('/stats').data
+    asgi = create_asgi_app(dict(app.config))
+    assert b'data-live="true"' in asgi.flask_app.test_client().get('/stats').data
+
+
+def test_lifespan(app):
+    asgi = BeanserverASGI(app)
+    sent = call(asgi, {'type': 'lifespan'},
+                [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+    assert sent == [{'type': 'lifespan.startup.complete'},
+                    {'type': 'lifespan.shutdown.complete'}]
+
+
+def test_unknown_scope_is_turned_down(app):
+    assert call(BeanserverASGI(app), {'type': 'webtransport'}, []) == []
@@ -0,0 +1,58 @@
+import functools
+import os
+import sqlite3
+
+from beanserver import backup, scheduler
+
+
+def test_snapshots_in_the_same_second_are_kept(app, tmp_path):
+    dest = str(tmp_path / 'backups')
+    paths = [backup.snapshot(app.config['PRIMARYDB'], dest) for _ in range(3)]
+    assert len(set(paths)) == 3
+    assert backup.snapshots(dest) == paths
+    assert sorted(os.listdir(dest)) == sorted(os.path.basename(p) for p in paths)
+
+
+def test_schedule_lock_is_exclusive(tmp_path):
+    path = str(tmp_path / 'backups' / '.schedule.lock')
+    held = scheduler.try_lock(path)
+    assert held is not None
+    if scheduler.fcntl is not None:
+        assert scheduler.try_lock(path) is None
+    held.close()
+    assert scheduler.try_lock(path) is not None
+
+
+def test_snapshot_under_steady_writes_finishes(app, tmp_path, monkeypatch):
+    src = app.config['PRIMARYDB']
+    writer = sqlite3.connect(src)
+    writer.executemany("INSERT INTO transactions (ts, crsid, rfid, type, debit, ncoffee) \
+            VALUES (?, 'aaa001', 1001, 'espresso2', 50, 2)", [(i,) for i in range(5000)])
+    writer.commit()
+
+    class Tapped(sqlite3.Connection):
+        '''A source written to after every backup step.'''
+        def backup(self, target, progress=None, **kwargs):
+            def step(*args):
+                writer.execute("INSERT INTO transactions (ts, crsid, rfid, type, debit, ncoffee) \
+                        VALUES (0, 'aaa001', 1001, 'espresso2', 50, 2)")
+                writer.commit()
+                if progress is not None:
+                    progress(*args)
+            return super().backup(target, progress=step, **kwargs)
+    monkeypatch.setattr(sqlite3, 'connect', functools.partial(sqlite3.connect, factory=Tapped))
+
+    warnings = []
+    class Logger:
+        def warning(self, msg):
+            warnings.append(msg)
+    path = backup.snapshot(src, str(tmp_path / 'backups'), pages=8,
+                           max_restarts=3, logger=Logger())
+    monkeypatch.undo()
+
+    assert len(warnings) == 1
+    copy = sqlite3.connect(path)
+    n, = copy.execute("SELECT count(*) FROM transactions").fetchone()
+    copy.close()
+    assert n >= 5020
+    writer.close()
@@ -0,0 +1,40 @@
+import time
+
+
+def cache_stats(app):
+    return app.extensions['beanserver.cache'].info()
+
+
+def test_hit_keeps_vary(app, client):
+    miss = client.get('/api/timeseries')
+    hit = client.get('/api/timeseries')
+    assert cache_stats(app)['hits'] == 1
+    assert 'Accept' in miss.vary
+    assert 'Accept' in hit.vary
+    assert hit.get_data() == miss.get_data()
+
+
+def test_hit_is_invalidated_by_writes(app, client):
+    before = client.get('/api/balance/aaa001').json
+    client.post('/api/newpayment', data={'crsid': 'aaa001', 'password': 'pay', 'payment': '1.00'})
+    after = client.get('/api/balance/aaa001').json
+    assert after['debt'] == before['debt'] - 100
+
+
+def test_interval_window_is_not_frozen(client):
+    first = client.get('/api/leaderboard/interval/1d').json['datesince']
+    time.sleep(1.1)
+    second = client.get('/api/leaderboard/interval/1d').json['datesince']
+    assert second > first
+
+    first = client.get('/api/leaderboard/windows?windows=interval:1d').json
+    time.sleep(1.1)
+    second = client.get('/api/leaderboard/windows?windows=interval:1d').json
+    assert second['windows']['interval:1d']['datesince'] > first['windows']['interval:1d']['datesince']
+
+
+def test_interval_leaderboard_is_not_cached(app, client):
+    before = cache_stats(app)
+    for _ in range(3):
+        assert client.get('/api/leaderboard/interval/1d').json['success']
+    assert cache_stats(app) == before
@@ -0,0 +1,59 @@
+import sqlite3
+
+import pytest
+
+from beanserver.db import DatabaseUnavailable, get_pool, is_fatal, open_db
+
+from conftest import make_app
+
+
+def test_busy_writer_raises(tmp_path):
+    app = make_app(str(tmp_path), DB_POOL_TIMEOUT=0.05)
+    pool = get_pool(app, app.config['PRIMARYDB'], write=True)
+    held = pool.acquire()
+    try:
+        with app.test_request_context(), pytest.raises(DatabaseUnavailable):
+            open_db(write=True)
+    finally:
+        pool.release(held)
+
+
+def test_busy_writer_is_503(tmp_path):
+    app = make_app(str(tmp_path), DB_POOL_TIMEOUT=0.05)
+    pool = get_pool(app, app.config['PRIMARYDB'], write=True)
+    held = pool.acquire()
+    try:
+        rv = app.test_client().post('/api/newuser', data={'crsid': 'new001', 'password': 'bot'})
+    finally:
+        pool.release(held)
+    assert rv.status_code == 503
+    assert rv.headers['Retry-After'] == '1'
+    assert rv.json['success'] is False
+
+    rv = app.test_client().post('/api/newuser', data={'crsid': 'new001', 'password': 'bot'})
+    assert rv.status_code == 201
+
+
+def test_explain_flags_index_scans(app):
+    with app.app_context():
+        out = app.test_cli_runner().invoke(args=['explain-db']).output
+    lines = out.splitlines()
+    timeseries = lines[lines.index('timeseries:') + 1]
+    assert timeseries.endswith('<-- full scan of index idx_transactions_ts')
+    user = lines[lines.index('timeseries_user:') + 1]
+    assert 'full scan' not in user
+
+
+def test_query_bug_does_not_fail_over(app):
+    # the request context passes the error on to close_db when it is popped
+    with pytest.raises(sqlite3.ProgrammingError), app.test_request_context():
+        open_db().execute("SELECT ?", ())
+    assert app.extensions['beanserver.health'] == {}
+
+
+def test_fatal_errors():
+    corrupt = sqlite3.DatabaseError("database disk image is malformed")
+    corrupt.sqlite_errorname = 'SQLITE_CORRUPT'
+    assert is_fatal(corrupt)
+    assert not is_fatal(sqlite3.ProgrammingError("Incorrect number of bindings supplied"))
+    assert not is_fatal(sqlite3.OperationalError("database is locked"))
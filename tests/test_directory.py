@@ -0,0 +1,28 @@
+import sqlite3
+
+
+def loads(app):
+    return app.extensions['beanserver.directory'].info()['loads']
+
+
+def test_debits_keep_the_directory(app, client):
+    assert client.get('/api/existsuser/aaa001').json
+    before = loads(app)
+    for _ in range(3):
+        client.post('/api/taps', json={'password': 'tap', 'taps': [
+            {'rfid': 1001, 'type': 'espresso2', 'debit': 50, 'ncoffee': 2}]})
+        client.post('/api/newpayment', data={'crsid': 'bbb002', 'password': 'pay', 'payment': '1.00'})
+        client.get('/api/existsuser/aaa001')
+    assert loads(app) == before
+
+
+def test_card_change_reloads_the_directory(app, client):
+    client.get('/api/existsuser/ccc003')
+    before = loads(app)
+    conn = sqlite3.connect(app.config['PRIMARYDB'])
+    conn.execute("UPDATE users SET rfid = 1003 WHERE crsid = 'ccc003'")
+    conn.commit()
+    conn.close()
+    client.get('/api/existsuser/ccc003')
+    assert loads(app) == before + 1
+    assert app.extensions['beanserver.directory'].crsid(1003) == 'ccc003'
@@ -0,0 +1,17 @@
+import pytest
+
+
+@pytest.mark.parametrize('accept', [None, '*/*', 'application/json, */*;q=0.5',
+                                    'application/x-beanserver-packed, application/json'])
+def test_json_by_default(client, accept):
+    headers = {} if accept is None else {'Accept': accept}
+    rv = client.get('/api/timeseries', headers=headers)
+    assert rv.mimetype == 'application/json'
+    assert rv.json['table']
+
+
+def test_packed_when_preferred(client):
+    rv = client.get('/api/timeseries', headers={
+        'Accept': 'application/x-beanserver-packed, application/json;q=0.5'})
+    assert rv.mimetype == 'application/x-beanserver-packed'
+    assert rv.get_data().startswith(b'BEAN1')
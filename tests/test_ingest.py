@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+import time
+
+from beanserver.db import get_pool
+from beanserver.ingest import GroupCommitWriter
+
+from conftest import make_app
+
+
+def tap(**kw):
+    return dict({'crsid': 'aaa001', 'type': 'espresso2', 'debit': 50, 'ncoffee': 2}, **kw)
+
+def post(client, *taps):
+    return client.post('/api/taps', json={'password': 'tap', 'taps': list(taps)})
+
+def count(app, **where):
+    conn = sqlite3.connect(app.config['PRIMARYDB'])
+    cond = " AND ".join(f"{k} = ?" for k in where) or "1"
+    n, = conn.execute(f"SELECT count(*) FROM transactions WHERE {cond}",
+                      tuple(where.values())).fetchone()
+    conn.close()
+    return n
+
+
+def test_duplicate_key_is_charged_once(app, client):
+    debt = client.get('/api/balance/aaa001').json['debt']
+    first = post(client, tap(key='box1-1')).json['results'][0]
+    again = post(client, tap(key='box1-1')).json['results'][0]
+    assert first['status'] == 'ok' and 'duplicate' not in first
+    assert again == dict(first, duplicate=True)
+    assert client.get('/api/balance/aaa001').json['debt'] == debt + 50
+
+
+def test_unknown_user(app, client):
+    rv = post(client, tap(crsid='zzz999'), {'rfid': 4242, 'type': 'tea', 'debit': 10, 'ncoffee': 0})
+    assert rv.json['results'] == [{'status': 'unknown_user'}] * 2
+    assert count(app, crsid='zzz999') == 0
+
+
+def test_failing_request_in_mixed_batch(app):
+    writer = GroupCommitWriter(app, linger=0.3)
+    results = {}
+    def submit(name, *taps):
+        try:
+            results[name] = writer.submit(list(taps), 10)
+        except sqlite3.Error as e:
+            results[name] = e
+    threads = [threading.Thread(target=submit, args=('good', tap(type='tea'))),
+               threading.Thread(target=submit, args=('bad', tap(type='mocha'), tap(ncoffee=None)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert writer.stats['batches'] == 1
+    assert results['good'][0]['status'] == 'ok'
+    assert isinstance(results['bad'], sqlite3.IntegrityError)
+    assert count(app, type='tea') == 1
+    # the whole failing request is undone, not just its bad tap
+    assert count(app, type='mocha') == 0
+
+
+def test_timed_out_request_is_not_recorded(app):
+    writer = GroupCommitWriter(app, linger=0.3)
+    first = threading.Thread(target=writer.submit, args=([tap(type='tea')], 10))
+    first.start()
+    time.sleep(0.05)
+    # picked up by the lingering batch, but not started on when it times out
+    assert writer.submit([tap(type='mocha')], 0.05) is None
+    first.join()
+    assert count(app, type='tea') == 1
+    assert count(app, type='mocha') == 0
+
+
+def test_busy_writer_is_503(tmp_path):
+    app = make_app(str(tmp_path), DB_POOL_TIMEOUT=0.05)
+    pool = get_pool(app, app.config['PRIMARYDB'], write=True)
+    held = pool.acquire()
+    try:
+        rv = post(app.test_client(), tap(key='box1-2'))
+    finally:
+        pool.release(held)
+    assert rv.status_code == 503
+    assert rv.headers['Retry-After'] == '1'
+    assert count(app, type='espresso2', crsid='aaa001') == 10
+
+    assert post(app.test_client(), tap(key='box1-2')).json['results'][0]['status'] == 'ok'
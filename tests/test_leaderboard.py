@@ -0,0 +1,66 @@
+import datetime as dt
+import random
+import sqlite3
+import time
+
+import pytest
+
+from beanserver.api import leaderboards_dt
+
+DAY = 86400
+
+
+@pytest.fixture
+def taps(app):
+    '''Taps around midnights over the last month, then edited and deleted.'''
+    rng = random.Random(4)
+    today = int(time.time()) // DAY * DAY
+    conn = sqlite3.connect(app.config['PRIMARYDB'])
+    for _ in range(400):
+        midnight = today - rng.randrange(30) * DAY
+        ts = midnight + rng.choice([-1, 0, 1, rng.randrange(DAY)])
+        conn.execute("INSERT INTO transactions (ts, crsid, rfid, type, debit, ncoffee) \
+                VALUES (?, ?, 1, 'espresso2', 50, ?)",
+                (ts, rng.choice(['aaa001', 'bbb002', 'ccc003']), rng.randrange(4)))
+    # moved across days and between users, and removed, through the triggers
+    conn.execute("UPDATE transactions SET ts = ts - 86399, crsid = 'ccc003' WHERE rowid % 7 = 0")
+    conn.execute("UPDATE transactions SET ncoffee = ncoffee + 1 WHERE rowid % 11 = 0")
+    conn.execute("DELETE FROM transactions WHERE rowid % 13 = 0")
+    conn.commit()
+    conn.close()
+    return today
+
+
+def raw_leaderboard(app, begin):
+    '''The original query, straight from transactions.'''
+    conn = sqlite3.connect(app.config['PRIMARYDB'])
+    rows = conn.execute("SELECT crsid, sum(ncoffee) FROM transactions \
+            WHERE ts > ? GROUP BY crsid", (begin.strftime('%s'),)).fetchall()
+    conn.close()
+    return dict(rows)
+
+
+def begins(today):
+    for days in (0, 1, 6, 7, 29, 400):
+        for offset in (-1, 0, 1, 3600):
+            yield dt.datetime.fromtimestamp(today - days * DAY + offset)
+    yield dt.datetime.fromtimestamp(time.time() - 6.5 * DAY)
+
+
+def test_rollup_matches_transactions(app, taps):
+    with app.test_request_context():
+        for begin in begins(taps):
+            board, = leaderboards_dt([begin])
+            assert {r['crsid']: r['shots'] for r in board} == raw_leaderboard(app, begin), begin
+
+
+def test_windows_match_transactions(app, client, taps):
+    midnight = dt.datetime.fromtimestamp(taps - 3 * DAY)
+    windows = ['all', 'sinceday:6', 'interval:1d', 'interval:7d2h',
+               'after:' + midnight.strftime('%Y-%m-%dT%H:%M:%S'),
+               'after:' + (midnight - dt.timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%S')]
+    res = client.get('/api/leaderboard/windows?windows=' + ','.join(windows)).json
+    assert sorted(res['windows']) == sorted(windows)
+    for name, board in res['windows'].items():
+        begin = dt.datetime.strptime(board['datesince'], '%Y-%m-%dT%H:%M:%S')
+        assert {r['crsid']: r['shots'] for r in board['data']} == raw_leaderboard(app, begin), name
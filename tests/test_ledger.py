@@ -0,0 +1,97 @@
+import random
+import sqlite3
+
+from beanserver import ledger, reconcile
+from beanserver.db import open_db
+
+CRSIDS = ['aaa001', 'bbb002', 'ccc003']
+
+
+def assert_parity(app):
+    '''Checkpoint plus later debits equal the user's full sum of debits.'''
+    with app.test_request_context():
+        db = open_db()
+        for crsid in CRSIDS:
+            full, = db.execute("SELECT IFNULL(sum(debit), 0) FROM transactions \
+                    WHERE crsid = ?", (crsid,)).fetchone()
+            assert ledger.verify(db, crsid)[1] == full, crsid
+
+
+def checkpoint_all(app):
+    # the edits below bypass users.debt; settle it, or reconcile would
+    # refuse to checkpoint the inconsistent accounts
+    conn = sqlite3.connect(app.config['PRIMARYDB'])
+    conn.execute("UPDATE users SET debt = (SELECT IFNULL(sum(debit), 0) \
+            FROM transactions WHERE crsid = users.crsid)")
+    conn.commit()
+    with app.app_context():
+        reconcile.reconcile(batch_size=2, min_rows=1)
+    assert conn.execute("SELECT count(*) FROM ledger_checkpoints").fetchone() == \
+        conn.execute("SELECT count(DISTINCT crsid) FROM transactions").fetchone()
+    conn.close()
+
+
+def test_checkpoints_match_full_sums(app):
+    rng = random.Random(11)
+    conn = sqlite3.connect(app.config['PRIMARYDB'])
+    def tap(n=1):
+        for _ in range(n):
+            conn.execute("INSERT INTO transactions (ts, crsid, rfid, type, debit, ncoffee) \
+                    VALUES (strftime('%s', 'now'), ?, 1, 'espresso2', ?, 2)",
+                    (rng.choice(CRSIDS), rng.choice([50, 60, -500])))
+        conn.commit()
+
+    checkpoint_all(app)
+    assert_parity(app)
+
+    tap(30)
+    assert_parity(app)
+    checkpoint_all(app)
+
+    # edits to rows a checkpoint covers: debit, owner, and removal
+    for edit in ("UPDATE transactions SET debit = debit + 7 WHERE rowid % 5 = 0",
+                 "UPDATE transactions SET crsid = 'ccc003' WHERE rowid % 9 = 0",
+                 "DELETE FROM transactions WHERE rowid % 8 = 0"):
+        checkpoint_all(app)
+        conn.execute(edit)
+        conn.commit()
+        assert_parity(app)
+
+    # the newest row deleted after a checkpoint, and its rowid reused
+    checkpoint_all(app)
+    conn.execute("DELETE FROM transactions WHERE rowid = (SELECT max(rowid) FROM transactions)")
+    conn.commit()
+    tap()
+    assert_parity(app)
+    checkpoint_all(app)
+    tap(5)
+    assert_parity(app)
+
+    # a row put back into a gap below a checkpoint
+    checkpoint_all(app)
+    conn.execute("INSERT INTO transactions (rowid, ts, crsid, rfid, type, debit, ncoffee) \
+            VALUES (8, 0, 'aaa001', 1, 'espresso2', 50, 2)")
+    conn.commit()
+    assert_parity(app)
+    conn.close()
+
+
+def test_balance_matches_full_sum(app, client):
+    checkpoint_all(app)
+    for _ in range(3):
+        client.post('/api/taps', json={'password': 'tap', 'taps': [
+            {'crsid': 'aaa001', 'type': 'espresso2', 'debit': 50, 'ncoffee': 2}]})
+    client.post('/api/newpayment', data={'crsid': 'aaa001', 'password': 'pay', 'payment': '2.00'})
+    conn = sqlite3.connect(app.config['PRIMARYDB'])
+    full, = conn.execute("SELECT sum(debit) FROM transactions WHERE crsid = 'aaa001'").fetchone()
+    conn.close()
+    assert client.get('/api/balance/aaa001').json == {'success': True, 'debt': full}
+
+
+def test_balance_of_user_missing_from_stale_directory(app, client):
+    assert client.get('/api/balance/aaa001').json['success']
+    # listed by this worker's directory, but not in the users table
+    app.extensions['beanserver.directory'].rfid_of['zzz999'] = None
+    rv = client.get('/api/balance/zzz999')
+    assert rv.status_code == 201
+    assert rv.json == {'success': False, 'reason': "CRSID 'zzz999' is not registered"}
@@ -0,0 +1,19 @@
+from beanserver.metrics import statement_label
+
+from conftest import make_app
+
+
+def test_statement_label_hides_numbers():
+    assert statement_label("SELECT a, x2 FROM t\n  WHERE ts % 86400 > 3.5 LIMIT 10") \
+            == "SELECT a, x2 FROM t WHERE ts % ? > ? LIMIT ?"
+
+
+def test_query_parameters_add_no_series(tmp_path):
+    app = make_app(str(tmp_path), METRICS_ENABLED=True)
+    client = app.test_client()
+    for n in (1, 2, 3, 7):
+        assert client.get(f'/api/timeseries?since_cursor=0&limit={n}').status_code == 200
+        assert client.get(f'/api/histogram?tod={n * 600}').status_code == 200
+    labels = app.extensions['beanserver.metrics'].queries.series
+    assert len([l for (l,) in labels if 'ORDER BY id LIMIT' in l]) == 1
+    assert len([l for (l,) in labels if 'AS bucket' in l]) == 1
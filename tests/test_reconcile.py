@@ -0,0 +1,34 @@
+import threading
+
+from beanserver import reconcile
+from beanserver.db import get_pool
+
+from conftest import make_app
+
+
+def test_writer_is_released_between_batches(tmp_path, monkeypatch):
+    app = make_app(str(tmp_path), DB_POOL_TIMEOUT=0.1)
+    pool = get_pool(app, app.config['PRIMARYDB'], write=True)
+    free = []
+    writer = reconcile.batch_writer
+    def spy():
+        # another thread can check the writer out before each batch
+        t = threading.Thread(target=lambda: free.append(pool.release(pool.acquire())))
+        t.start()
+        t.join()
+        return writer()
+    monkeypatch.setattr(reconcile, 'batch_writer', spy)
+    with app.app_context():
+        stats = reconcile.reconcile(batch_size=1)
+    assert stats['checked'] == 3 and stats['inconsistent'] == 0
+    # three batches of one user, and the empty one that ends the run
+    assert len(free) == 4
+
+
+def test_scheduled_in_one_worker(app, monkeypatch):
+    calls = []
+    monkeypatch.setattr(reconcile.scheduler, 'every',
+                        lambda app, interval, fn, name, lock=None: calls.append(lock))
+    app.config['RECONCILE_INTERVAL'] = 60
+    reconcile.init_app(app)
+    assert calls == [app.config['PRIMARYDB'] + '.reconcile.lock']
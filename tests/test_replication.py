@@ -0,0 +1,37 @@
+import sqlite3
+
+import pytest
+
+from beanserver import replication
+from beanserver.db import is_fatal
+
+
+def test_copies_primary(app):
+    with app.app_context():
+        assert replication.run(force=True)
+    conn = sqlite3.connect(app.config['SECONDARYDB'])
+    assert conn.execute("SELECT count(*) FROM transactions").fetchone() == (20,)
+    conn.close()
+
+
+def test_failed_check_is_fatal(tmp_path, monkeypatch):
+    class Source:
+        def execute(self, q):
+            return self
+        def fetchone(self):
+            return ('*** in database main ***\nPage 3: btreeInitPage() returns error code 11',)
+        def close(self):
+            pass
+    monkeypatch.setattr(replication.sqlite3, 'connect', lambda *a, **kw: Source())
+    with pytest.raises(sqlite3.DatabaseError) as e:
+        replication.replicate('primary.db', str(tmp_path / 'secondary.db'))
+    assert is_fatal(e.value)
+
+
+def test_scheduled_in_one_worker(app, monkeypatch):
+    calls = []
+    monkeypatch.setattr(replication.scheduler, 'every',
+                        lambda app, interval, fn, name, lock=None: calls.append(lock))
+    app.config['REPLICATION_INTERVAL'] = 60
+    replication.init_app(app)
+    assert calls == [app.config['SECONDARYDB'] + '.replication.lock']